@@ -0,0 +1,93 @@
+import asyncio
+import collections
+import threading
+
+# queue：超出上限的连接排队等待空位；reject：立即关闭
+ADMISSION_MODES = ('queue', 'reject')
+
+
+class ConnectionLimiter:
+    """并发连接数限制，超出 limit 时排队等待或立即拒绝
+
+    可被多个事件循环线程共享（用作进程级的全局限制）：
+    释放的名额直接转交给最早排队的连接，通过 call_soon_threadsafe 唤醒它所在的事件循环
+    """
+
+    def __init__(self, limit, mode='queue', max_queue=1024, queue_timeout=5.0):
+        if mode not in ADMISSION_MODES:
+            raise ValueError(f"未知的准入模式: {mode}")
+        self.limit = limit
+        self.mode = mode
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        # 排队中的 (事件循环, future)，左端为最早排队
+        self.waiters = collections.deque()
+        self._lock = threading.Lock()
+
+    def stats(self):
+        return {
+            'limit': self.limit,
+            'active': self.active,
+            'waiting': len(self.waiters),
+            'admitted': self.admitted,
+            'queued': self.queued,
+            'rejected': self.rejected,
+        }
+
+    async def acquire(self):
+        """取得一个连接名额，返回 False 表示被拒绝（队列已满或排队超时）"""
+        with self._lock:
+            if self.active < self.limit:
+                self.active += 1
+                self.admitted += 1
+                return True
+            if self.mode == 'reject' or len(self.waiters) >= self.max_queue:
+                self.rejected += 1
+                return False
+            loop = asyncio.get_running_loop()
+            waiter = (loop, loop.create_future())
+            self.waiters.append(waiter)
+            self.queued += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter[1]), self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            with self._lock:
+                try:
+                    self.waiters.remove(waiter)
+                    granted = False
+                except ValueError:
+                    # 名额已转交给本连接，但唤醒还未执行
+                    granted = True
+                if not granted:
+                    self.rejected += 1
+            if granted:
+                self.release()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            return False
+        with self._lock:
+            self.admitted += 1
+        return True
+
+    def release(self):
+        """归还名额：有排队的连接时直接转交给它，否则计数减一"""
+        with self._lock:
+            if not self.waiters:
+                self.active -= 1
+                return
+            loop, future = self.waiters.popleft()
+        try:
+            loop.call_soon_threadsafe(self._grant, future)
+        except RuntimeError:
+            # 排队者所在的事件循环已关闭，名额交给下一个
+            self.release()
+
+    def _grant(self, future):
+        if future.done():
+            self.release()
+        else:
+            future.set_result(None)
@@ -0,0 +1,50 @@
+"""SOCKS5 握手解析微基准：在仓库根目录运行 python -m benchmarks.bench_handshake"""
+import argparse
+import socket
+import time
+
+from socks5_parser import Socks5RequestParser
+
+GREETING = b'\x05\x01\x00'
+REQUESTS = {
+    'ipv4': b'\x05\x01\x00\x01' + socket.inet_aton('93.184.216.34') + (443).to_bytes(2, 'big'),
+    'ipv6': b'\x05\x01\x00\x04' + socket.inet_pton(socket.AF_INET6, '2606:2800:220:1::1') + (443).to_bytes(2, 'big'),
+    'domain': b'\x05\x01\x00\x03\x0bexample.com' + (443).to_bytes(2, 'big'),
+}
+
+
+def split_chunks(data, mode):
+    """pipelined：问候和请求一次到达；split：问候和请求分两次到达；bytewise：逐字节到达"""
+    if mode == 'pipelined':
+        return [data]
+    if mode == 'split':
+        return [data[:len(GREETING)], data[len(GREETING):]]
+    return [data[i:i + 1] for i in range(len(data))]
+
+
+def bench(chunks, count):
+    """返回每秒完成的握手解析次数"""
+    started = time.perf_counter()
+    for _ in range(count):
+        parser = Socks5RequestParser()
+        for chunk in chunks:
+            parser.feed(chunk)
+    elapsed = time.perf_counter() - started
+    assert parser.done
+    return count / elapsed
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument('--count', type=int, default=200000, help="每种组合的握手次数")
+    args = arg_parser.parse_args()
+    for mode in ('pipelined', 'split', 'bytewise'):
+        for name, request in REQUESTS.items():
+            chunks = split_chunks(GREETING + request, mode)
+            count = args.count if mode != 'bytewise' else args.count // 10
+            rate = bench(chunks, count)
+            print(f"{mode:<10} {name:<7} {rate:>12,.0f} 次/秒")
+
+
+if __name__ == '__main__':
+    main()
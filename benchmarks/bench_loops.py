@@ -0,0 +1,103 @@
+"""对比 asyncio 与 uvloop 事件循环下的代理性能：在仓库根目录运行 python -m benchmarks.bench_loops
+
+上游和回显目标运行在独立进程中，代理运行在本进程的 LoopEngine 上，负载由本进程的另一个事件循环产生
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from benchmarks.fake_servers import start_fake_servers, stop_fake_servers
+from benchmarks.loadgen import open_tunnel
+from loop_engine import LOOP_POLICIES
+from proxy_manager import ProxyManager
+
+
+async def one_connection(proxy_port, echo_port):
+    reader, writer = await open_tunnel(proxy_port, echo_port)
+    writer.write(b'x')
+    await reader.readexactly(1)
+    writer.close()
+
+
+async def connection_rate(proxy_port, echo_port, total, concurrency):
+    """每秒完成的 握手 + CONNECT + 1 字节往返 次数"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded():
+        async with semaphore:
+            await one_connection(proxy_port, echo_port)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(bounded() for _ in range(total)))
+    return total / (time.perf_counter() - started)
+
+
+async def throughput(proxy_port, echo_port, megabytes, streams):
+    """多条隧道同时回显 megabytes MB 数据的总吞吐（MB/s，单方向）"""
+    chunk = b'x' * (1024 * 1024)
+
+    async def one_stream():
+        reader, writer = await open_tunnel(proxy_port, echo_port)
+
+        async def send():
+            for _ in range(megabytes):
+                writer.write(chunk)
+                await writer.drain()
+
+        async def receive():
+            remaining = megabytes * len(chunk)
+            while remaining:
+                data = await reader.read(1024 * 1024)
+                if not data:
+                    raise ConnectionError("隧道提前关闭")
+                remaining -= len(data)
+
+        await asyncio.gather(send(), receive())
+        writer.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one_stream() for _ in range(streams)))
+    return megabytes * streams / (time.perf_counter() - started)
+
+
+def run_engine(policy, ports, args):
+    manager = ProxyManager(loop_count=args.loops, loop_policy=policy, pool_size=4)
+    proxy_port = args.port
+    try:
+        if not manager.start_proxy_for_port(proxy_port, '127.0.0.1', ports['upstream_port']):
+            raise RuntimeError(f"无法启动端口 {proxy_port}")
+        echo_port = ports['echo_port']
+        asyncio.run(connection_rate(proxy_port, echo_port, 200, 20))  # 预热
+        return {
+            'engine': manager.engine.loop_policy,
+            'conns_per_sec': round(asyncio.run(
+                connection_rate(proxy_port, echo_port, args.connections, args.concurrency)), 1),
+            'throughput_mb_s': round(asyncio.run(
+                throughput(proxy_port, echo_port, args.megabytes, args.streams)), 1),
+        }
+    finally:
+        manager.stop_all_proxies()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--engines', default='asyncio,uvloop', help="逗号分隔，可选 " + ", ".join(LOOP_POLICIES))
+    parser.add_argument('--port', type=int, default=23080)
+    parser.add_argument('--loops', type=int, default=1)
+    parser.add_argument('--connections', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--megabytes', type=int, default=256, help="每条隧道回显的数据量")
+    parser.add_argument('--streams', type=int, default=4)
+    args = parser.parse_args()
+
+    process, conn, ports = start_fake_servers()
+    try:
+        results = [run_engine(policy, ports, args) for policy in args.engines.split(',')]
+    finally:
+        stop_fake_servers(process, conn)
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""代理端到端基准测试：在仓库根目录运行 python -m benchmarks.bench_proxy
+
+启动本地 SOCKS5 上游（可选认证和注入延迟）和回显/丢弃目标，在 N 个代理端口上各运行 M 个并发客户端，
+以 JSON 输出每秒连接数、p50/p99 首字节时间和吞吐（Gbps），附带当前提交以便跨提交对比
+"""
+import argparse
+import asyncio
+import json
+import platform
+import subprocess
+import time
+
+from benchmarks.fake_servers import start_fake_servers, start_in_thread, stop_fake_servers
+from benchmarks.loadgen import connection_phase, throughput_phase
+from loop_engine import LOOP_POLICIES
+from proxy_manager import ProxyManager
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run(args, ports):
+    auth = args.auth.split(':', 1) if args.auth else (None, None)
+    manager = ProxyManager(loop_count=args.loops, worker_count=args.workers, loop_policy=args.engine,
+                           pool_size=args.pool_size)
+    proxy_ports = list(range(args.port, args.port + args.ports))
+    target = ports['echo_port'] if args.target == 'echo' else ports['sink_port']
+    try:
+        assignments = [(port, '127.0.0.1', ports['upstream_port'], auth[0], auth[1]) for port in proxy_ports]
+        results = manager.start_ports(assignments)
+        failed = [port for port, ok in results.items() if not ok]
+        if failed:
+            raise RuntimeError(f"无法启动端口 {failed}")
+        if args.warmup:
+            asyncio.run(connection_phase(proxy_ports, target, args.clients, args.warmup))
+        report = {
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'engine': manager.engine.loop_policy,
+            'loops': args.loops,
+            'workers': args.workers,
+            'ports': args.ports,
+            'clients_per_port': args.clients,
+            'target': args.target,
+            'upstream_auth': bool(args.auth),
+            'upstream_latency_ms': args.latency,
+            'servers': args.servers,
+        }
+        report.update(asyncio.run(connection_phase(proxy_ports, target, args.clients, args.duration,
+                                                   args.payload)))
+        if args.throughput_duration:
+            report['throughput'] = asyncio.run(throughput_phase(
+                proxy_ports, target, args.stream_clients, args.throughput_duration, args.target == 'echo'))
+        return report
+    finally:
+        manager.stop_all_proxies()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--engine', default='asyncio', choices=LOOP_POLICIES)
+    parser.add_argument('--loops', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--port', type=int, default=24080, help="第一个代理端口")
+    parser.add_argument('--ports', type=int, default=4, help="代理端口数 N")
+    parser.add_argument('--clients', type=int, default=16, help="每个端口的并发客户端数 M")
+    parser.add_argument('--duration', type=float, default=5.0, help="建连测试时长（秒）")
+    parser.add_argument('--warmup', type=float, default=1.0, help="预热时长（秒），0 表示不预热")
+    parser.add_argument('--payload', type=int, default=64, help="每个连接发送的请求字节数")
+    parser.add_argument('--target', default='echo', choices=('echo', 'sink'))
+    parser.add_argument('--throughput-duration', type=float, default=5.0, help="吞吐测试时长（秒），0 表示跳过")
+    parser.add_argument('--stream-clients', type=int, default=1, help="吞吐测试时每个端口的隧道数")
+    parser.add_argument('--auth', help="上游要求的认证，格式 username:password")
+    parser.add_argument('--latency', type=float, default=0.0, help="上游应答 CONNECT 前注入的延迟（毫秒）")
+    parser.add_argument('--pool-size', type=int, default=0, help="每个端口的上游预连接数")
+    parser.add_argument('--servers', default='thread', choices=('thread', 'process'),
+                        help="上游和目标运行在本进程的后台线程中还是独立进程中")
+    parser.add_argument('--output', help="把 JSON 结果追加写入该文件（每行一条）")
+    args = parser.parse_args()
+
+    auth = tuple(args.auth.split(':', 1)) if args.auth else None
+    latency = args.latency / 1000
+    if args.servers == 'thread':
+        ports, stop = start_in_thread(auth, latency)
+    else:
+        process, conn, ports = start_fake_servers(auth, latency)
+
+        def stop():
+            stop_fake_servers(process, conn)
+    try:
+        report = run(args, ports)
+    finally:
+        stop()
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(report, ensure_ascii=False) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+"""基准测试用的本地服务：SOCKS5 上游（可选认证和注入延迟）、回显目标和丢弃目标
+
+可以在本进程的后台线程中运行（start_in_thread），也可以在独立进程中运行（start_fake_servers）
+"""
+import asyncio
+import multiprocessing
+import socket
+import threading
+
+READ_SIZE = 256 * 1024
+
+
+async def _pipe(reader, writer):
+    try:
+        while True:
+            data = await reader.read(READ_SIZE)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+        if writer.can_write_eof():
+            writer.write_eof()
+    except (ConnectionError, OSError):
+        pass
+
+
+async def _read_socks5_address(reader):
+    atyp = (await reader.readexactly(1))[0]
+    if atyp == 1:
+        host = socket.inet_ntoa(await reader.readexactly(4))
+    elif atyp == 4:
+        host = socket.inet_ntop(socket.AF_INET6, await reader.readexactly(16))
+    else:
+        host = (await reader.readexactly((await reader.readexactly(1))[0])).decode('idna')
+    return host, int.from_bytes(await reader.readexactly(2), 'big')
+
+
+class FakeServers:
+    """一组本地测试服务
+
+    auth 为 (username, password) 时上游要求用户名/密码认证；
+    latency 为上游在应答 CONNECT 前额外等待的秒数，用于模拟远端上游
+    """
+
+    def __init__(self, auth=None, latency=0.0):
+        self.auth = auth
+        self.latency = latency
+        self.ports = {}
+        self.servers = []
+        self.connections = set()
+
+    async def start(self):
+        for name, handler in (('upstream_port', self.handle_upstream),
+                              ('echo_port', self.handle_echo),
+                              ('sink_port', self.handle_sink)):
+            server = await asyncio.start_server(handler, '127.0.0.1', 0, backlog=4096)
+            self.servers.append(server)
+            self.ports[name] = server.sockets[0].getsockname()[1]
+        return self.ports
+
+    async def close(self):
+        for server in self.servers:
+            server.close()
+        for writer in list(self.connections):
+            writer.transport.abort()
+        await asyncio.sleep(0.1)
+
+    async def _authenticate(self, reader, writer):
+        _, count = await reader.readexactly(2)
+        methods = await reader.readexactly(count)
+        if not self.auth:
+            writer.write(b'\x05\x00')
+            return True
+        if 2 not in methods:
+            writer.write(b'\x05\xff')
+            return False
+        writer.write(b'\x05\x02')
+        await reader.readexactly(1)
+        username = await reader.readexactly((await reader.readexactly(1))[0])
+        password = await reader.readexactly((await reader.readexactly(1))[0])
+        ok = (username.decode(), password.decode()) == tuple(self.auth)
+        writer.write(b'\x01\x00' if ok else b'\x01\x01')
+        return ok
+
+    async def handle_upstream(self, reader, writer):
+        """SOCKS5 上游，只支持 CONNECT"""
+        self.connections.add(writer)
+        try:
+            if not await self._authenticate(reader, writer):
+                return
+            await reader.readexactly(3)
+            host, port = await _read_socks5_address(reader)
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            try:
+                target_reader, target_writer = await asyncio.open_connection(host, port)
+            except OSError:
+                writer.write(b'\x05\x05\x00\x01' + bytes(6))
+                return
+            writer.write(b'\x05\x00\x00\x01' + bytes(6))
+            self.connections.add(target_writer)
+            await asyncio.gather(_pipe(reader, target_writer), _pipe(target_reader, writer))
+            target_writer.close()
+            self.connections.discard(target_writer)
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            pass
+        finally:
+            writer.close()
+            self.connections.discard(writer)
+
+    async def handle_echo(self, reader, writer):
+        self.connections.add(writer)
+        await _pipe(reader, writer)
+        writer.close()
+        self.connections.discard(writer)
+
+    async def handle_sink(self, reader, writer):
+        """丢弃收到的全部数据，只在首次收到数据时回复 1 字节，便于测量首字节时间"""
+        self.connections.add(writer)
+        replied = False
+        try:
+            while True:
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    break
+                if not replied:
+                    writer.write(b'k')
+                    replied = True
+        except (ConnectionError, OSError):
+            pass
+        writer.close()
+        self.connections.discard(writer)
+
+
+def start_in_thread(auth=None, latency=0.0):
+    """在本进程的后台线程中运行测试服务，返回 (ports, stop)"""
+    loop = asyncio.new_event_loop()
+    servers = FakeServers(auth, latency)
+    thread = threading.Thread(target=loop.run_forever, name='benchmark-fake-servers', daemon=True)
+    thread.start()
+    ports = asyncio.run_coroutine_threadsafe(servers.start(), loop).result()
+
+    def stop():
+        asyncio.run_coroutine_threadsafe(servers.close(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout=3)
+        loop.close()
+
+    return ports, stop
+
+
+async def _serve(conn, auth, latency):
+    servers = FakeServers(auth, latency)
+    conn.send(await servers.start())
+    # 主进程关闭管道即退出
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, _wait_closed, conn)
+    await servers.close()
+
+
+def _wait_closed(conn):
+    try:
+        conn.recv()
+    except EOFError:
+        pass
+
+
+def _main(conn, auth, latency):
+    asyncio.run(_serve(conn, auth, latency))
+
+
+def start_fake_servers(auth=None, latency=0.0):
+    """在子进程中运行测试服务，返回 (process, conn, ports)"""
+    parent_conn, child_conn = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_main, args=(child_conn, auth, latency), daemon=True)
+    process.start()
+    child_conn.close()
+    return process, parent_conn, parent_conn.recv()
+
+
+def stop_fake_servers(process, conn):
+    conn.close()
+    process.join(timeout=3)
+    if process.is_alive():
+        process.terminate()
@@ -0,0 +1,138 @@
+"""负载生成：对 N 个代理端口各发起 M 个并发客户端，统计建连速率、首字节时间和吞吐"""
+import asyncio
+import socket
+import time
+
+CONNECT_REPLY_SIZE = 10
+CHUNK_SIZE = 256 * 1024
+
+
+def percentile(samples, fraction):
+    """已排序样本的分位数（最近秩法）"""
+    if not samples:
+        return 0.0
+    index = min(len(samples) - 1, max(0, int(round(fraction * len(samples))) - 1))
+    return samples[index]
+
+
+def connect_request(target_port):
+    return (b'\x05\x01\x00\x05\x01\x00\x01' + socket.inet_aton('127.0.0.1')
+            + target_port.to_bytes(2, 'big'))
+
+
+async def open_tunnel(proxy_port, target_port):
+    """经代理端口建立到本地目标的隧道，方法协商和 CONNECT 请求一次发出"""
+    reader, writer = await asyncio.open_connection('127.0.0.1', proxy_port)
+    writer.write(connect_request(target_port))
+    reply = await reader.readexactly(2 + CONNECT_REPLY_SIZE)
+    if reply[3] != 0:
+        writer.close()
+        raise ConnectionError(f"CONNECT 失败，应答码 {reply[3]}")
+    return reader, writer
+
+
+class ConnectionStats:
+    def __init__(self):
+        self.completed = 0
+        self.errors = 0
+        self.handshake = []
+        self.ttfb = []
+
+
+async def _connection_client(proxy_port, target_port, payload, deadline, stats):
+    """循环执行 建连 + CONNECT + 发送请求 + 等待首字节，直到 deadline"""
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        writer = None
+        try:
+            reader, writer = await open_tunnel(proxy_port, target_port)
+            connected = time.perf_counter()
+            writer.write(payload)
+            if not await reader.read(1):
+                raise ConnectionError("隧道提前关闭")
+            finished = time.perf_counter()
+        except (OSError, asyncio.IncompleteReadError):
+            stats.errors += 1
+            # 端口拒绝连接时避免空转
+            await asyncio.sleep(0.01)
+            continue
+        finally:
+            if writer is not None:
+                writer.close()
+        stats.completed += 1
+        stats.handshake.append(connected - started)
+        stats.ttfb.append(finished - started)
+
+
+async def connection_phase(proxy_ports, target_port, clients, duration, payload_size=64):
+    """每个端口 clients 个客户端反复建立短连接，duration 秒后汇总"""
+    stats = ConnectionStats()
+    payload = b'x' * payload_size
+    started = time.perf_counter()
+    deadline = started + duration
+    await asyncio.gather(*(
+        _connection_client(port, target_port, payload, deadline, stats)
+        for port in proxy_ports for _ in range(clients)
+    ))
+    elapsed = time.perf_counter() - started
+    stats.handshake.sort()
+    stats.ttfb.sort()
+    return {
+        'connections': stats.completed,
+        'errors': stats.errors,
+        'conns_per_sec': round(stats.completed / elapsed, 1),
+        'handshake_p50_ms': round(percentile(stats.handshake, 0.50) * 1000, 3),
+        'handshake_p99_ms': round(percentile(stats.handshake, 0.99) * 1000, 3),
+        'ttfb_p50_ms': round(percentile(stats.ttfb, 0.50) * 1000, 3),
+        'ttfb_p99_ms': round(percentile(stats.ttfb, 0.99) * 1000, 3),
+    }
+
+
+async def _stream_client(proxy_port, target_port, echo, deadline, counters):
+    """在一条隧道上持续发送数据到 deadline；echo 为 True 时同时读回回显的数据"""
+    try:
+        reader, writer = await open_tunnel(proxy_port, target_port)
+    except (OSError, asyncio.IncompleteReadError):
+        counters['errors'] += 1
+        return
+    chunk = b'x' * CHUNK_SIZE
+
+    async def send():
+        while time.perf_counter() < deadline:
+            writer.write(chunk)
+            await writer.drain()
+            counters['sent'] += len(chunk)
+        writer.write_eof()
+
+    async def receive():
+        while True:
+            data = await reader.read(CHUNK_SIZE)
+            if not data:
+                break
+            if echo:
+                counters['received'] += len(data)
+
+    try:
+        await asyncio.gather(send(), receive())
+    except (OSError, asyncio.IncompleteReadError):
+        counters['errors'] += 1
+    finally:
+        writer.close()
+
+
+async def throughput_phase(proxy_ports, target_port, clients, duration, echo=True):
+    """每个端口 clients 条隧道持续传输 duration 秒，吞吐按经过隧道的双向字节数计算"""
+    counters = {'sent': 0, 'received': 0, 'errors': 0}
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        _stream_client(port, target_port, echo, started + duration, counters)
+        for port in proxy_ports for _ in range(clients)
+    ))
+    elapsed = time.perf_counter() - started
+    transferred = counters['sent'] + counters['received']
+    return {
+        'streams': len(proxy_ports) * clients,
+        'errors': counters['errors'],
+        'bytes': transferred,
+        'gbps': round(transferred * 8 / elapsed / 1e9, 3),
+    }
@@ -0,0 +1,182 @@
+"""本地控制接口：在 localhost 的 HTTP 端口或 UNIX 套接字上批量增删、切换端口映射
+
+    GET  /ports    列出运行中的端口、上游和实时连接数
+    POST /ports    {"remove": [10001], "add": [映射, ...], "retarget": [映射, ...]}
+    POST /drain    {"ports": [10002], "timeout": 30}
+
+映射为 {"port": 10000, "upstream": "host:port[:username:password]", "backups": ["host:port", ...]}，
+upstream 和 backups 中的元素也可以是 {"host", "port", "username", "password"} 对象。
+add 启动新端口（已运行的端口直接切换上游），retarget 只切换已运行端口的上游；
+一次请求中的全部端口按事件循环分批，在各循环上一次完成。
+例如：curl -d '{"retarget": [{"port": 10000, "upstream": "1.2.3.4:1080"}]}' http://127.0.0.1:9465/ports
+"""
+import json
+import os
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from logger import logger
+
+MAX_BODY_SIZE = 16 * 1024 * 1024
+
+
+class ControlError(ValueError):
+    """请求内容无效，返回 400"""
+
+
+class _ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        socketserver.UnixStreamServer.server_bind(self)
+        # BaseHTTPRequestHandler 需要这两个属性
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+class ControlServer:
+    """控制接口服务，在独立线程中处理请求；同一时间只执行一个修改操作"""
+
+    def __init__(self, manager, host='127.0.0.1', port=9465, unix_path=None):
+        self.manager = manager
+        self.host = host
+        self.port = port
+        self.unix_path = unix_path
+        self.httpd = None
+        self.thread = None
+        self._lock = threading.Lock()
+
+    def parse_upstream(self, value):
+        if isinstance(value, str):
+            return self.manager.parse_proxy_info(value)
+        if isinstance(value, dict) and value.get('host') and value.get('port'):
+            return value['host'], int(value['port']), value.get('username'), value.get('password')
+        raise ControlError(f"无效的上游: {value!r}")
+
+    def parse_mapping(self, entry):
+        """映射 -> start_ports 使用的 (port, host, port, username, password, upstreams)"""
+        try:
+            port = int(entry['port'])
+            upstream = self.parse_upstream(entry['upstream'])
+            backups = tuple(self.parse_upstream(backup) for backup in entry.get('backups') or ())
+        except (KeyError, TypeError, ValueError) as e:
+            raise ControlError(f"无效的端口映射 {entry!r}: {e}") from None
+        return (port,) + tuple(upstream) + (backups,)
+
+    @staticmethod
+    def parse_list(request, key):
+        value = request.get(key) or []
+        if not isinstance(value, list):
+            raise ControlError(f"{key} 必须是数组: {value!r}")
+        return value
+
+    def update_ports(self, request):
+        """先停止 remove 中的端口，再把 add 和 retarget 合并为一次 start_ports"""
+        remove = self.parse_list(request, 'remove')
+        try:
+            remove = [int(port) for port in remove]
+        except (TypeError, ValueError) as e:
+            raise ControlError(f"无效的 remove 端口: {e}") from None
+        add = [self.parse_mapping(entry) for entry in self.parse_list(request, 'add')]
+        retarget = [self.parse_mapping(entry) for entry in self.parse_list(request, 'retarget')]
+        with self._lock:
+            if remove:
+                self.manager.stop_ports(remove)
+            running = self.manager.running_ports()
+            results = {}
+            for assignment in retarget:
+                if assignment[0] not in running:
+                    results[assignment[0]] = False
+            assignments = add + [assignment for assignment in retarget if assignment[0] in running]
+            if assignments:
+                results.update(self.manager.start_ports(assignments))
+        return {'removed': remove, 'results': {str(port): ok for port, ok in sorted(results.items())}}
+
+    def drain(self, request):
+        ports = self.parse_list(request, 'ports')
+        try:
+            ports = [int(port) for port in ports]
+            timeout = float(request.get('timeout', 30.0))
+        except (TypeError, ValueError) as e:
+            raise ControlError(f"无效的排空请求: {e}") from None
+        with self._lock:
+            return {'draining': self.manager.drain_ports(ports, timeout)}
+
+    def handle(self, method, path, body):
+        """返回 (状态码, 响应对象)"""
+        if path == '/ports' and method == 'GET':
+            return 200, {'ports': self.manager.list_ports()}
+        if method != 'POST' or path not in ('/ports', '/drain'):
+            return 404, {'error': f"未知的接口 {method} {path}"}
+        try:
+            request = json.loads(body or b'{}')
+            if not isinstance(request, dict):
+                raise ControlError("请求体必须是 JSON 对象")
+            if path == '/ports':
+                return 200, self.update_ports(request)
+            return 200, self.drain(request)
+        except (ControlError, ValueError) as e:
+            return 400, {'error': str(e)}
+
+    def start(self):
+        control = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # 保持连接，编排程序可以在同一连接上连续发送请求
+            protocol_version = 'HTTP/1.1'
+
+            def respond(self, method):
+                length = int(self.headers.get('Content-Length') or 0)
+                if length > MAX_BODY_SIZE:
+                    status, result = 413, {'error': "请求体过大"}
+                    self.close_connection = True
+                else:
+                    body = self.rfile.read(length) if length else b''
+                    try:
+                        status, result = control.handle(method, self.path.split('?', 1)[0], body)
+                    except Exception as e:
+                        logger.error(None, "处理控制请求 %s %s 出错: %r", method, self.path, e)
+                        status, result = 500, {'error': str(e)}
+                data = json.dumps(result, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self.respond('GET')
+
+            def do_POST(self):
+                self.respond('POST')
+
+            def log_message(self, format, *args):
+                pass
+
+        if self.unix_path:
+            # 清理上次运行残留的套接字文件
+            if os.path.exists(self.unix_path):
+                os.unlink(self.unix_path)
+            self.httpd = _ThreadingUnixHTTPServer(self.unix_path, Handler)
+            os.chmod(self.unix_path, 0o600)
+            address = f"unix:{self.unix_path}"
+        else:
+            self.httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+            self.httpd.daemon_threads = True
+            # 响应很小，关闭 Nagle 算法避免与客户端的延迟确认叠加
+            Handler.disable_nagle_algorithm = True
+            self.port = self.httpd.server_address[1]
+            address = f"http://{self.host}:{self.port}"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='uniproxy-control', daemon=True)
+        self.thread.start()
+        logger.info(None, "控制接口启动在 %s", address)
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+            self.thread.join(timeout=2)
+            if self.unix_path and os.path.exists(self.unix_path):
+                os.unlink(self.unix_path)
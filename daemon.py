@@ -0,0 +1,290 @@
+"""无界面运行 Uniproxy：python daemon.py -c uniproxy.json（或 python main.py -c uniproxy.json）
+
+配置文件为 JSON，例如：
+
+    {
+        "manager": {"loop_count": 2, "worker_count": 1, "loop_policy": "auto", "global_max_connections": 20000},
+        "server": {"relay_mode": "auto", "pool_size": 2, "max_connections": 1000, "idle_timeout": 300},
+        "health_check": {"test_host": "www.gstatic.com", "interval": 60},
+        "log": {"level": "info", "json_format": false},
+        "metrics": {"host": "127.0.0.1", "port": 9464},
+        "control": {"host": "127.0.0.1", "port": 9465},
+        "state": {"path": "uniproxy-state.json", "min_interval": 1.0},
+        "drain_timeout": 30,
+        "groups": [
+            {"start_port": 10000, "port_count": 100, "proxies": ["1.2.3.4:1080:user:pass"], "group_size": 1},
+            {"start_port": 20000, "port_count": 50, "api": "https://example.com/api?num=50",
+             "refresh_interval": 300, "group_size": 2, "resolve_mode": "local"}
+        ]
+    }
+
+manager 段为 ProxyManager 的参数，server 段为每个端口的 Socks5Server 参数，health_check 段为
+ProxyHealthChecker 的参数（省略则不探测）；这三段和 state 段的修改需要重启进程才能生效。
+收到 SIGTERM/SIGINT 时停止接受新连接，等待已有连接结束（最多 drain_timeout 秒）后退出；
+收到 SIGHUP 时重新读取配置，只启停或切换有变化的端口。
+control 段启用本地控制接口（见 control_api.py，可用 {"unix_path": "/run/uniproxy.sock"}），
+经控制接口修改的端口不属于任何端口段，重新加载配置时不受影响。
+state 段启用状态快照（见 state_store.py）：端口映射和上游健康状态变化时写入 path；启动时先按快照
+一次性恢复全部端口，API 端口段随后在后台刷新，不必等待 API 和健康探测。快照中不属于任何端口段的端口
+（例如经控制接口添加的）同样会恢复
+"""
+import argparse
+import inspect
+import json
+import signal
+import sys
+import threading
+
+from control_api import ControlServer
+from dns_cache import RESOLVE_MODES
+from health_check import ProxyHealthChecker
+from logger import logger
+from proxy_manager import ProxyManager
+
+# 修改后需要重启进程才能生效的配置段
+RESTART_SECTIONS = ('manager', 'server', 'health_check', 'state')
+CONFIG_KEYS = RESTART_SECTIONS + ('log', 'metrics', 'control', 'drain_timeout', 'groups')
+GROUP_KEYS = ('start_port', 'port_count', 'proxies', 'api', 'refresh_interval', 'group_size', 'resolve_mode')
+DEFAULT_DRAIN_TIMEOUT = 30.0
+# 配置段 -> (接收该段参数的函数, 由程序自身传入、不能写在配置文件中的参数)
+SECTION_TARGETS = {
+    'manager': (ProxyManager, ('health_checker', 'dns_cache', 'server_options')),
+    'server': (ProxyManager.Socks5Server, ('local_port', 'upstream_host', 'upstream_port', 'username', 'password',
+                                           'upstreams', 'resolver', 'buffer_budget', 'connection_limiter',
+                                           'global_bandwidth')),
+    'health_check': (ProxyHealthChecker, ()),
+    'log': (logger.configure, ()),
+    'metrics': (ProxyManager.start_metrics_server, ('self',)),
+    'control': (ControlServer, ('manager',)),
+}
+
+
+class ConfigError(ValueError):
+    pass
+
+
+def load_config(path):
+    """读取并校验配置文件，返回配置字典"""
+    try:
+        with open(path, encoding='utf-8') as f:
+            config = json.load(f)
+    except (OSError, ValueError) as e:
+        raise ConfigError(f"无法读取配置文件 {path}: {e}") from e
+    if not isinstance(config, dict):
+        raise ConfigError("配置文件的顶层必须是对象")
+    unknown = set(config) - set(CONFIG_KEYS)
+    if unknown:
+        raise ConfigError(f"未知的配置项: {', '.join(sorted(unknown))}")
+    for section, (target, internal) in SECTION_TARGETS.items():
+        options = config.get(section)
+        if options is None:
+            continue
+        if not isinstance(options, dict):
+            raise ConfigError(f"配置段 {section} 必须是对象")
+        unknown = set(options) - (set(inspect.signature(target).parameters) - set(internal))
+        if unknown:
+            raise ConfigError(f"配置段 {section} 中有未知的配置项: {', '.join(sorted(unknown))}")
+    used = {}
+    for group in config.setdefault('groups', []):
+        unknown = set(group) - set(GROUP_KEYS)
+        if unknown:
+            raise ConfigError(f"端口段中有未知的配置项: {', '.join(sorted(unknown))}")
+        if not isinstance(group.get('start_port'), int) or not isinstance(group.get('port_count'), int):
+            raise ConfigError(f"端口段缺少整数 start_port 或 port_count: {group}")
+        if ('proxies' in group) == ('api' in group):
+            raise ConfigError(f"端口段 {group['start_port']} 必须且只能提供 proxies 或 api 之一")
+        if 'proxies' in group and not group['proxies']:
+            raise ConfigError(f"端口段 {group['start_port']} 的 proxies 为空")
+        if group.get('resolve_mode', 'remote') not in RESOLVE_MODES:
+            raise ConfigError(f"端口段 {group['start_port']} 的解析方式无效: {group['resolve_mode']}")
+        for port in group_ports(group):
+            if port in used:
+                raise ConfigError(f"端口 {port} 同时属于端口段 {used[port]} 和 {group['start_port']}")
+            used[port] = group['start_port']
+    return config
+
+
+def group_ports(group):
+    return range(group['start_port'], group['start_port'] + group['port_count'])
+
+
+class Daemon:
+    """按配置文件运行 ProxyManager，重新加载配置时只应用差异"""
+
+    def __init__(self, path):
+        self.path = path
+        self.config = load_config(path)
+        self.manager = None
+        self.control_server = None
+        # 起始端口 -> 已应用的端口段配置
+        self.groups = {}
+        # 直接给出上游的端口 -> (host, port, username, password, 备用上游)
+        self.static = {}
+        self.stopping = False
+        self.reload_requested = False
+        self.wakeup = threading.Event()
+
+    def create_manager(self):
+        config = self.config
+        health_checker = None
+        if config.get('health_check') is not None:
+            health_checker = ProxyHealthChecker(**config['health_check'])
+        return ProxyManager(health_checker=health_checker, **config.get('manager', {}),
+                            **config.get('server', {}))
+
+    def static_assignments(self, groups):
+        assignments = {}
+        for group in groups.values():
+            if 'proxies' not in group:
+                continue
+            proxies = [self.manager.parse_proxy_info(proxy) for proxy in group['proxies']]
+            for assignment in self.manager.build_assignments(proxies, group['start_port'], group['port_count'],
+                                                             group.get('group_size', 1)):
+                assignments[assignment[0]] = assignment[1:]
+        return assignments
+
+    def apply(self, config, previous=None, restored=()):
+        """把配置应用到运行中的 ProxyManager，只处理与 previous 不同的部分
+
+        restored 为已从状态快照恢复的端口：全部端口都已恢复的 API 端口段不再同步请求 API，改为在后台立即刷新
+        """
+        previous = previous or {}
+        manager = self.manager
+        logger.configure(**config.get('log', {}))
+        groups = {group['start_port']: group for group in config['groups']}
+        static = self.static_assignments(groups)
+        wanted = {port for group in groups.values() for port in group_ports(group)}
+        current = {port for group in self.groups.values() for port in group_ports(group)}
+
+        # 不再需要的端口段：停止定时刷新，端口等待已有连接结束后关闭
+        for start, group in self.groups.items():
+            if 'api' in group and groups.get(start) != group:
+                manager.stop_auto_refresh(start)
+                manager.stop_health_watch(start)
+        removed = sorted(current - wanted)
+        if removed:
+            manager.stop_ports(removed, drain_timeout=config.get('drain_timeout', DEFAULT_DRAIN_TIMEOUT))
+
+        # 解析方式先于启动端口设置，新建的服务器直接使用
+        default_mode = config.get('server', {}).get('resolve_mode', 'remote')
+        modes = {}
+        for start, group in groups.items():
+            mode = group.get('resolve_mode', default_mode)
+            old = self.groups.get(start)
+            if old is None or old.get('resolve_mode', default_mode) != mode or old['port_count'] != group['port_count']:
+                modes.setdefault(mode, []).extend(group_ports(group))
+        for mode, ports in modes.items():
+            manager.set_resolve_mode(ports, mode)
+
+        changed = [(port,) + assignment for port, assignment in sorted(static.items())
+                   if self.static.get(port) != assignment]
+        if changed:
+            manager.start_ports(changed)
+        for start, group in groups.items():
+            if 'api' not in group or self.groups.get(start) == group:
+                continue
+            if restored and all(port in restored for port in group_ports(group)):
+                manager.start_auto_refresh(group['api'], start, group['port_count'], group.get('refresh_interval'),
+                                           group.get('group_size', 1), immediate=True)
+            else:
+                manager.start_proxies(None, group['api'], start, group['port_count'], group.get('group_size', 1),
+                                      group.get('refresh_interval'))
+
+        # 之前启动失败的指标服务或控制接口在下次应用配置时重试
+        if config.get('metrics') != previous.get('metrics') or \
+                (config.get('metrics') is not None and manager.metrics_server is None):
+            manager.stop_metrics_server()
+            if config.get('metrics') is not None:
+                manager.start_metrics_server(**config['metrics'])
+        if config.get('control') != previous.get('control') or \
+                (config.get('control') is not None and self.control_server is None):
+            if self.control_server is not None:
+                self.control_server.stop()
+                self.control_server = None
+            if config.get('control') is not None:
+                control_server = ControlServer(manager, **config['control'])
+                control_server.start()
+                self.control_server = control_server
+        self.groups = groups
+        self.static = static
+        logger.info(None, "配置已应用：%d 个端口段，新增或切换 %d 个直接配置的端口，停止 %d 个端口",
+                    len(groups), len(changed), len(removed))
+
+    def reload(self):
+        try:
+            config = load_config(self.path)
+        except ConfigError as e:
+            logger.error(None, "重新加载配置失败，保持当前配置: %s", e)
+            return
+        for section in RESTART_SECTIONS:
+            if config.get(section) != self.config.get(section):
+                logger.warning(None, "配置段 %s 的修改需要重启进程才能生效", section)
+                config[section] = self.config.get(section)
+        # 应用失败（例如指标或控制端口已被占用）时保持进程运行，记录的配置回到之前的版本
+        previous, self.config = self.config, config
+        try:
+            self.apply(config, previous)
+        except Exception as e:
+            self.config = previous
+            logger.error(None, "应用配置失败，保持之前的配置: %r", e)
+
+    def request_stop(self, signum=None, frame=None):
+        self.stopping = True
+        self.wakeup.set()
+
+    def request_reload(self, signum=None, frame=None):
+        self.reload_requested = True
+        self.wakeup.set()
+
+    def install_signal_handlers(self):
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+        # Windows 没有 SIGHUP
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, self.request_reload)
+
+    def run(self):
+        self.manager = self.create_manager()
+        self.install_signal_handlers()
+        try:
+            restored = set()
+            if self.config.get('state') is not None:
+                self.manager.enable_state_store(**self.config['state'])
+                restored = {port for port, ok in self.manager.restore_state().items() if ok}
+            self.apply(self.config, restored=restored)
+            while not self.stopping:
+                # 带超时等待，Windows 上 Ctrl+C 才能及时生效
+                self.wakeup.wait(1.0)
+                self.wakeup.clear()
+                if self.reload_requested and not self.stopping:
+                    self.reload_requested = False
+                    logger.info(None, "收到 SIGHUP，重新加载配置 %s", self.path)
+                    self.reload()
+        finally:
+            drain_timeout = self.config.get('drain_timeout', DEFAULT_DRAIN_TIMEOUT)
+            logger.info(None, "正在停止，最多等待 %s 秒让已有连接结束", drain_timeout)
+            if self.control_server is not None:
+                self.control_server.stop()
+            self.manager.stop_all_proxies(drain_timeout=drain_timeout)
+            logger.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="无界面运行 Uniproxy（配置格式见 daemon.py）")
+    parser.add_argument('-c', '--config', required=True, help="JSON 配置文件路径")
+    parser.add_argument('--check', action='store_true', help="只校验配置文件后退出")
+    args = parser.parse_args(argv)
+    try:
+        daemon = Daemon(args.config)
+    except ConfigError as e:
+        print(e, file=sys.stderr)
+        return 2
+    if args.check:
+        print("配置文件有效")
+        return 0
+    daemon.run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,119 @@
+import asyncio
+import collections
+import functools
+import ipaddress
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# remote：域名原样交给上游解析；local：本地解析后把 IP 发给上游
+RESOLVE_MODES = ('remote', 'local')
+
+
+class DnsCache:
+    """本地 DNS 解析缓存：按 TTL 过期的 LRU 缓存，失败结果也缓存一段时间
+
+    同一域名同时只有一个解析请求在进行，其他等待者共享结果。
+    解析在专用线程池中执行，结果可被多个事件循环线程共享
+    """
+
+    def __init__(self, max_size=4096, ttl=300.0, negative_ttl=30.0, max_workers=8):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # host -> (过期时间, 地址列表或异常)，右端为最近使用
+        self.entries = collections.OrderedDict()
+        # host -> 进行中的 concurrent.futures.Future
+        self.pending = {}
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.resolve_count = 0
+        self.resolve_time = 0.0
+        self.resolve_time_max = 0.0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='uniproxy-dns')
+
+    def stats(self):
+        """缓存命中率和解析耗时统计"""
+        lookups = self.hits + self.negative_hits + self.misses + self.coalesced
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'hit_rate': (self.hits + self.negative_hits + self.coalesced) / lookups if lookups else 0.0,
+            'resolves': self.resolve_count,
+            'resolve_avg_ms': round(self.resolve_time / self.resolve_count * 1000, 2) if self.resolve_count else 0.0,
+            'resolve_max_ms': round(self.resolve_time_max * 1000, 2),
+        }
+
+    async def resolve(self, host):
+        """返回 host 的 IP 地址列表（字符串），解析失败时抛出 socket.gaierror
+
+        IP 字面量直接返回，不进入缓存
+        """
+        try:
+            return [str(ipaddress.ip_address(host))]
+        except ValueError:
+            pass
+        now = time.monotonic()
+        with self._lock:
+            entry = self.entries.get(host)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(host)
+                if isinstance(entry[1], Exception):
+                    self.negative_hits += 1
+                    # 每次抛出新的异常对象，避免缓存的异常不断累积 traceback
+                    raise type(entry[1])(*entry[1].args)
+                self.hits += 1
+                return entry[1]
+            future = self.pending.get(host)
+            if future is None:
+                self.misses += 1
+                future = self._executor.submit(self._lookup, host)
+                self.pending[host] = future
+                # 解析结束（包括被取消）时才移除，避免后续请求加入一个已取消的解析
+                future.add_done_callback(functools.partial(self._lookup_done, host))
+            else:
+                self.coalesced += 1
+        # 某个等待者被取消（握手超时、客户端断开）时不能取消共享的解析
+        return await asyncio.shield(asyncio.wrap_future(future))
+
+    def _lookup_done(self, host, future):
+        with self._lock:
+            if self.pending.get(host) is future:
+                del self.pending[host]
+
+    def _lookup(self, host):
+        """在线程池中执行的实际解析，结果写入缓存"""
+        started = time.monotonic()
+        try:
+            infos = socket.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+            addresses = list(dict.fromkeys(info[4][0] for info in infos))
+            result, ttl = addresses, self.ttl
+        except OSError as e:
+            addresses = None
+            result, ttl = e, self.negative_ttl
+        elapsed = time.monotonic() - started
+        with self._lock:
+            self.resolve_count += 1
+            self.resolve_time += elapsed
+            self.resolve_time_max = max(self.resolve_time_max, elapsed)
+            self.entries[host] = (time.monotonic() + ttl, result)
+            self.entries.move_to_end(host)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        if addresses is None:
+            raise result
+        return addresses
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+    def close(self):
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,112 @@
+import asyncio
+import time
+
+from logger import logger
+from socks5_client import Socks5Error, open_socks5_connection
+
+
+class ProxyHealthChecker:
+    """并发探测上游代理是否可用，并在后台定期复查
+
+    探测方式是通过代理完成一次完整的 SOCKS5 握手并 CONNECT 到测试目标，
+    成功即视为健康，耗时即为探测延迟
+    """
+
+    def __init__(self, test_host='www.gstatic.com', test_port=80, timeout=5.0,
+                 concurrency=500, interval=60.0):
+        self.test_host = test_host
+        self.test_port = test_port
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.interval = interval
+        # (host, port, username, password) -> 最近一次探测结果
+        self.results = {}
+        # 后台复查的代理：调用方的 key（例如端口段的起始端口）-> 代理列表
+        self.watched = {}
+        self.on_update = None
+        self._task = None
+
+    async def probe(self, proxy):
+        """探测单个代理，返回结果字典"""
+        host, port, username, password = proxy
+        started = time.monotonic()
+        try:
+            _, writer = await open_socks5_connection(
+                host, port, self.test_host, self.test_port, username, password, timeout=self.timeout
+            )
+        except Socks5Error as e:
+            result = {'healthy': False, 'latency': None, 'error': str(e)}
+        else:
+            writer.close()
+            result = {'healthy': True, 'latency': time.monotonic() - started, 'error': None}
+        result['checked_at'] = time.time()
+        self.results[tuple(proxy)] = result
+        return result
+
+    async def probe_all(self, proxies):
+        """以受限并发探测全部代理，返回 {proxy: 结果}"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def bounded(proxy):
+            async with semaphore:
+                return tuple(proxy), await self.probe(proxy)
+
+        started = time.monotonic()
+        unique = dict.fromkeys(tuple(proxy) for proxy in proxies)
+        results = dict(await asyncio.gather(*(bounded(proxy) for proxy in unique)))
+        healthy = [r['latency'] for r in results.values() if r['healthy']]
+        average = sum(healthy) / len(healthy) * 1000 if healthy else 0.0
+        logger.info(None, "代理探测完成：健康 %d/%d，平均延迟 %.0f ms，耗时 %.1f 秒",
+                    len(healthy), len(results), average, time.monotonic() - started)
+        return results
+
+    def rank(self, proxies):
+        """只保留探测健康的代理，并按延迟从低到高排序"""
+        healthy = [proxy for proxy in proxies
+                   if self.results.get(tuple(proxy), {}).get('healthy')]
+        return sorted(healthy, key=lambda proxy: self.results[tuple(proxy)]['latency'])
+
+    def report(self):
+        """按延迟排序的探测结果列表，不健康的排在最后"""
+        rows = []
+        for (host, port, _, _), result in self.results.items():
+            latency = result['latency']
+            rows.append({
+                'proxy': f"{host}:{port}",
+                'healthy': result['healthy'],
+                'latency_ms': round(latency * 1000, 1) if latency is not None else None,
+                'error': result['error'],
+            })
+        return sorted(rows, key=lambda row: (not row['healthy'], row['latency_ms'] or 0))
+
+    def watch(self, proxies, on_update=None, key=None):
+        """在当前事件循环中后台定期复查这些代理，每轮结束后调用 on_update(results)
+
+        每个 key 各自保存一份代理列表，同一 key 再次调用时替换，每轮探测全部列表的并集
+        """
+        self.watched[key] = [tuple(proxy) for proxy in proxies]
+        self.on_update = on_update
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._watch_loop())
+
+    def unwatch(self, key):
+        """不再复查 key 对应的代理列表"""
+        self.watched.pop(key, None)
+
+    async def _watch_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            proxies = list(dict.fromkeys(proxy for watched in self.watched.values() for proxy in watched))
+            if not proxies:
+                continue
+            try:
+                results = await self.probe_all(proxies)
+                if self.on_update:
+                    self.on_update(results)
+            except Exception as e:
+                logger.warning(None, "后台代理探测出错: %s", e)
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
@@ -0,0 +1,328 @@
+import asyncio
+import time
+
+from logger import logger
+from relay import DEFAULT_BUFFER_SIZE, relay
+from shaping import throttle_delay
+from socks5_client import REP_TTL_EXPIRED, Socks5Error
+
+# 请求头的最大长度，超过视为无效请求
+MAX_HEAD_SIZE = 64 * 1024
+# 换目标主机时，等待旧连接把响应发完的最长时间（秒）
+SWITCH_TIMEOUT = 10.0
+# 不转发给目标服务器的代理专用请求头（小写）
+_PROXY_HEADERS = (b'proxy-connection', b'proxy-authorization')
+
+# 预先生成的代理响应
+RESPONSE_ESTABLISHED = b'HTTP/1.1 200 Connection Established\r\n\r\n'
+RESPONSE_BAD_REQUEST = b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+RESPONSE_BAD_GATEWAY = b'HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+RESPONSE_GATEWAY_TIMEOUT = b'HTTP/1.1 504 Gateway Timeout\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+
+
+def looks_like_http(data):
+    """连接的首个字节是大写字母时按 HTTP 代理请求处理（SOCKS5 的首字节为 0x05）"""
+    return 0x41 <= data[0] <= 0x5A
+
+
+class HttpProxyError(Exception):
+    """无法处理的 HTTP 代理请求，response 为返回给客户端的响应"""
+
+    def __init__(self, message, response=RESPONSE_BAD_REQUEST):
+        super().__init__(message)
+        self.response = response
+
+
+def split_host_port(authority, default_port):
+    """拆分 host[:port]，支持 [IPv6]:port 形式"""
+    if authority.startswith('['):
+        end = authority.find(']')
+        if end < 0:
+            raise HttpProxyError(f"无效的主机地址: {authority}")
+        host, rest = authority[1:end], authority[end + 1:]
+        port = rest[1:] if rest.startswith(':') else ''
+    else:
+        host, _, port = authority.rpartition(':') if authority.count(':') == 1 else (authority, '', '')
+    if not host:
+        raise HttpProxyError(f"无效的主机地址: {authority}")
+    try:
+        return host, int(port) if port else default_port
+    except ValueError:
+        raise HttpProxyError(f"无效的端口: {authority}") from None
+
+
+def parse_request_head(head):
+    """解析请求头，返回 (method, target, version, [(name, value), ...])，name 和 value 均为 bytes"""
+    lines = head.split(b'\r\n')
+    parts = lines[0].split(b' ')
+    if len(parts) != 3 or not parts[2].startswith(b'HTTP/'):
+        raise HttpProxyError(f"无效的请求行: {lines[0][:100]!r}")
+    headers = []
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, sep, value = line.partition(b':')
+        if not sep:
+            raise HttpProxyError(f"无效的请求头: {line[:100]!r}")
+        headers.append((name.strip(), value.strip()))
+    return parts[0].decode('ascii', 'replace'), parts[1].decode('ascii', 'replace'), parts[2], headers
+
+
+def rewrite_request(method, target, version, headers):
+    """把绝对 URI 请求改写为发给目标服务器的形式，返回 (host, port, 请求头 bytes)"""
+    if not target.startswith('http://'):
+        raise HttpProxyError(f"不支持的请求目标: {target[:100]}")
+    authority, slash, path = target[7:].partition('/')
+    host, port = split_host_port(authority, 80)
+    lines = [f"{method} /{path if slash else ''} ".encode('ascii') + version]
+    has_host = False
+    for name, value in headers:
+        lower = name.lower()
+        if lower in _PROXY_HEADERS:
+            continue
+        has_host = has_host or lower == b'host'
+        lines.append(name + b': ' + value)
+    if not has_host:
+        lines.append(b'Host: ' + authority.encode('ascii'))
+    return host, port, b'\r\n'.join(lines) + b'\r\n\r\n'
+
+
+class HttpProxySession:
+    """同一本地端口上的 HTTP 代理：支持 CONNECT 隧道和绝对 URI 的普通请求
+
+    普通请求按请求头改写后经上游 SOCKS5 连接转发，响应原样回传；
+    同一客户端连接上发往同一目标的后续请求复用这条上游连接（keep-alive）
+    """
+
+    def __init__(self, reader, writer, open_connection, relay_options=None, label=''):
+        self.reader = reader
+        self.writer = writer
+        # open_connection(host, port) -> (reader, writer, upstream)
+        self.open_connection = open_connection
+        # 传给 relay() 的关键字参数（mode、buffer_size、水位、预算等）
+        self.relay_options = relay_options or {}
+        self.read_size = self.relay_options.get('buffer_size', DEFAULT_BUFFER_SIZE)
+        self.idle_timeout = self.relay_options.get('idle_timeout')
+        self.metrics = self.relay_options.get('metrics')
+        # 普通请求的请求体和响应同样受端口的带宽限制（CONNECT 隧道由 relay() 限速）
+        shaping = self.relay_options.get('shaping')
+        self.upload_buckets, self.download_buckets = shaping.connection() if shaping is not None else ((), ())
+        self.label = label
+        # 已读取但尚未处理的客户端数据
+        self.buffer = bytearray()
+        self.target = None
+        self.upstream_writer = None
+        self.response_task = None
+        self.response_activity = 0.0
+        # finish_target 主动结束当前目标时为 True，此时目标关闭连接是预期的，客户端连接继续使用
+        self.finishing = False
+
+    async def run(self, initial):
+        """处理客户端连接，initial 为已读取的首段数据"""
+        self.buffer += initial
+        try:
+            while True:
+                head = await self.read_head()
+                if head is None:
+                    break
+                method, target, version, headers = parse_request_head(head)
+                if method == 'CONNECT':
+                    await self.finish_target()
+                    await self.tunnel(target)
+                    return
+                host, port, request = rewrite_request(method, target, version, headers)
+                if self.response_task is not None and self.response_task.done():
+                    # 目标服务器已关闭连接，客户端可能依赖连接关闭来判断响应结束
+                    break
+                if self.target != (host, port):
+                    await self.finish_target()
+                    await self.connect_target(host, port)
+                self.write_upstream(request)
+                await self.forward_body(headers)
+                await self.upstream_writer.drain()
+            await self.finish_target()
+        except HttpProxyError as e:
+            logger.debug(self.label, "%s", e)
+            if self.response_task is None and e.response:
+                self.writer.write(e.response)
+                await self.writer.drain()
+        finally:
+            if self.response_task is not None:
+                self.response_task.cancel()
+            if self.upstream_writer is not None:
+                self.upstream_writer.close()
+
+    async def read_head(self):
+        """读取一个完整的请求头（不含结尾的空行），客户端关闭连接时返回 None"""
+        while True:
+            end = self.buffer.find(b'\r\n\r\n')
+            if end >= 0:
+                head = bytes(self.buffer[:end])
+                del self.buffer[:end + 4]
+                return head
+            if len(self.buffer) > MAX_HEAD_SIZE:
+                raise HttpProxyError("请求头过长")
+            data = await self.read(MAX_HEAD_SIZE)
+            if not data:
+                if self.buffer:
+                    raise HttpProxyError("请求头不完整")
+                return None
+            self.buffer += data
+
+    async def read_line(self):
+        while True:
+            end = self.buffer.find(b'\r\n')
+            if end >= 0:
+                line = bytes(self.buffer[:end + 2])
+                del self.buffer[:end + 2]
+                return line
+            if len(self.buffer) > MAX_HEAD_SIZE:
+                raise HttpProxyError("分块长度行过长")
+            await self.fill()
+
+    async def read(self, size):
+        """读取客户端数据，idle_timeout 秒内没有数据时结束会话"""
+        if not self.idle_timeout:
+            return await self.reader.read(size)
+        while True:
+            try:
+                return await asyncio.wait_for(self.reader.read(size), self.idle_timeout)
+            except asyncio.TimeoutError:
+                # 响应仍在回传时客户端不发送数据是正常的
+                if (self.response_task is not None and not self.response_task.done()
+                        and time.monotonic() - self.response_activity < self.idle_timeout):
+                    continue
+                raise HttpProxyError(f"连接空闲超过 {self.idle_timeout} 秒", b'') from None
+
+    async def fill(self):
+        data = await self.read(self.read_size)
+        if not data:
+            raise HttpProxyError("请求体不完整")
+        self.buffer += data
+
+    async def forward_exactly(self, size):
+        """把接下来的 size 字节请求体原样转发给目标服务器"""
+        while size:
+            if not self.buffer:
+                await self.fill()
+            chunk = self.buffer[:size]
+            del self.buffer[:len(chunk)]
+            size -= len(chunk)
+            self.write_upstream(chunk)
+            await self.upstream_writer.drain()
+            if self.upload_buckets:
+                await self.throttle(self.upload_buckets, len(chunk))
+
+    def write_upstream(self, data):
+        """把请求数据写给目标服务器并计入上传字节数（CONNECT 隧道由 relay() 计数）"""
+        self.upstream_writer.write(data)
+        if self.metrics is not None:
+            self.metrics.bytes_up += len(data)
+
+    async def throttle(self, buckets, nbytes):
+        delay = throttle_delay(buckets, nbytes)
+        if delay > 0:
+            if self.metrics is not None:
+                self.metrics.throttled += 1
+            await asyncio.sleep(delay)
+
+    async def forward_body(self, headers):
+        """按 Content-Length 或 chunked 编码转发请求体，保证下一个请求头从正确位置开始"""
+        length = 0
+        chunked = False
+        for name, value in headers:
+            lower = name.lower()
+            if lower == b'transfer-encoding':
+                chunked = value.lower().endswith(b'chunked')
+            elif lower == b'content-length':
+                try:
+                    length = int(value)
+                except ValueError:
+                    raise HttpProxyError(f"无效的 Content-Length: {value[:20]!r}") from None
+        if not chunked:
+            await self.forward_exactly(length)
+            return
+        while True:
+            line = await self.read_line()
+            self.write_upstream(line)
+            try:
+                size = int(line.split(b';', 1)[0], 16)
+            except ValueError:
+                raise HttpProxyError(f"无效的分块长度: {line[:20]!r}") from None
+            if size == 0:
+                break
+            # 数据块之后紧跟 CRLF
+            await self.forward_exactly(size + 2)
+        # 尾部字段，以空行结束
+        while True:
+            line = await self.read_line()
+            self.write_upstream(line)
+            if line == b'\r\n':
+                break
+
+    async def open_upstream(self, host, port):
+        try:
+            upstream_reader, upstream_writer, upstream = await self.open_connection(host, port)
+        except Socks5Error as e:
+            response = RESPONSE_GATEWAY_TIMEOUT if e.reply_code == REP_TTL_EXPIRED else RESPONSE_BAD_GATEWAY
+            raise HttpProxyError(f"连接 {host}:{port} 失败: {e}", response) from e
+        logger.debug(self.label, "HTTP 请求经上游 %s:%s 连接 %s:%s", upstream.host, upstream.port, host, port)
+        return upstream_reader, upstream_writer
+
+    async def tunnel(self, authority):
+        """CONNECT：返回 200 后在客户端和目标之间双向转发"""
+        host, port = split_host_port(authority, 443)
+        upstream_reader, self.upstream_writer = await self.open_upstream(host, port)
+        self.writer.write(RESPONSE_ESTABLISHED)
+        if self.buffer:
+            self.write_upstream(bytes(self.buffer))
+            self.buffer.clear()
+        await self.writer.drain()
+        await relay(self.reader, self.writer, upstream_reader, self.upstream_writer,
+                    label=self.label, **self.relay_options)
+
+    async def connect_target(self, host, port):
+        upstream_reader, self.upstream_writer = await self.open_upstream(host, port)
+        self.target = (host, port)
+        self.response_task = asyncio.ensure_future(self.forward_responses(upstream_reader))
+
+    async def forward_responses(self, upstream_reader):
+        """把目标服务器的响应原样回传给客户端，直到目标关闭连接
+
+        目标主动关闭时（例如以关闭连接表示结束的 HTTP/1.0 响应）同时关闭客户端连接，
+        客户端立即收到 EOF，run() 中等待下一个请求的读取随之结束
+        """
+        try:
+            while True:
+                data = await upstream_reader.read(self.read_size)
+                if not data:
+                    break
+                self.response_activity = time.monotonic()
+                self.writer.write(data)
+                if self.metrics is not None:
+                    self.metrics.bytes_down += len(data)
+                await self.writer.drain()
+                if self.download_buckets:
+                    await self.throttle(self.download_buckets, len(data))
+        except (ConnectionError, OSError):
+            pass
+        if not self.finishing:
+            self.writer.close()
+
+    async def finish_target(self):
+        """结束当前的普通请求目标：发送 EOF 并等待已发出请求的响应回传完毕"""
+        if self.response_task is None:
+            return
+        self.finishing = True
+        if not self.upstream_writer.is_closing() and self.upstream_writer.can_write_eof():
+            self.upstream_writer.write_eof()
+        try:
+            await asyncio.wait_for(asyncio.shield(self.response_task), SWITCH_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.response_task.cancel()
+        finally:
+            self.finishing = False
+        self.upstream_writer.close()
+        self.upstream_writer = None
+        self.response_task = None
+        self.target = None
@@ -0,0 +1,183 @@
+import atexit
+import json
+import queue
+import sys
+import threading
+import time
+
+# 日志级别，off 表示不输出任何日志
+LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40, 'off': 100}
+_LEVEL_NAMES = {number: name.upper() for name, number in LEVELS.items()}
+# 低于该级别的日志（即每个连接的 debug 日志）参与按端口抽样，其余只受速率限制
+_SAMPLED_BELOW = LEVELS['info']
+
+
+class Logger:
+    """在后台线程中输出的日志
+
+    调用方只做级别判断、抽样和限速，然后把 (时间, 级别, 端口, 消息, 参数, 字段) 放入队列；
+    消息格式化和写入 stdout 都在后台线程完成，事件循环不会因控制台缓慢而阻塞。
+
+    默认级别为 info：每个连接的正常流程和预期内的失败都记为 debug，默认不输出。
+    sample_rate 为 debug 日志的抽样比例（port_sample_rates 可按端口单独设置），
+    rate_limit 为每个端口每秒最多输出的条数，超出的条数在该端口之后的第一条日志前汇总报告；
+    队列中积压超过 max_queue 条时新日志直接丢弃并计数
+    """
+
+    def __init__(self, level='info', json_format=False, sample_rate=1.0, port_sample_rates=None,
+                 rate_limit=50, max_queue=10000, stream=None):
+        self.queue = queue.SimpleQueue()
+        self.stream = stream
+        self.dropped = 0
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        # 端口 -> 抽样计数，端口 -> [当前秒, 本秒已输出条数, 本秒被抑制条数]
+        self._sample_counters = {}
+        self._windows = {}
+        self.configure(level, json_format, sample_rate, port_sample_rates, rate_limit, max_queue)
+
+    def configure(self, level='info', json_format=False, sample_rate=1.0, port_sample_rates=None,
+                  rate_limit=50, max_queue=10000):
+        if level not in LEVELS:
+            raise ValueError(f"未知的日志级别: {level}")
+        self.level = level
+        self.levelno = LEVELS[level]
+        self.json_format = json_format
+        self.sample_rate = sample_rate
+        self.port_sample_rates = dict(port_sample_rates or {})
+        self.rate_limit = rate_limit
+        self.max_queue = max_queue
+
+    def config(self):
+        """当前配置，可传给工作进程中的 configure()"""
+        return {
+            'level': self.level,
+            'json_format': self.json_format,
+            'sample_rate': self.sample_rate,
+            'port_sample_rates': dict(self.port_sample_rates),
+            'rate_limit': self.rate_limit,
+            'max_queue': self.max_queue,
+        }
+
+    def debug(self, port, message, *args, **fields):
+        if self.levelno <= 10:
+            self._log(10, port, message, args, fields)
+
+    def info(self, port, message, *args, **fields):
+        if self.levelno <= 20:
+            self._log(20, port, message, args, fields)
+
+    def warning(self, port, message, *args, **fields):
+        if self.levelno <= 30:
+            self._log(30, port, message, args, fields)
+
+    def error(self, port, message, *args, **fields):
+        if self.levelno <= 40:
+            self._log(40, port, message, args, fields)
+
+    def _sampled_out(self, port):
+        rate = self.port_sample_rates.get(port, self.sample_rate)
+        if rate >= 1.0:
+            return False
+        if rate <= 0.0:
+            return True
+        count = self._sample_counters.get(port, 0) + 1
+        self._sample_counters[port] = count
+        # 按计数确定性抽样：每 1/rate 条保留一条
+        return count % max(int(round(1.0 / rate)), 1) != 0
+
+    def _log(self, levelno, port, message, args, fields):
+        """各端口只在所在的事件循环中记录日志，抽样和限速状态无需加锁"""
+        if levelno < _SAMPLED_BELOW and self._sampled_out(port):
+            return
+        now = time.time()
+        if self.rate_limit:
+            second = int(now)
+            window = self._windows.get(port)
+            if window is None or window[0] != second:
+                if window is not None and window[2] and self.levelno <= 30:
+                    self._enqueue((now, 30, port, "过去 1 秒内有 %d 条日志因限速未输出", (window[2],), None))
+                window = self._windows[port] = [second, 0, 0]
+            if window[1] >= self.rate_limit:
+                window[2] += 1
+                return
+            window[1] += 1
+        self._enqueue((now, levelno, port, message, args, fields))
+
+    def _enqueue(self, record):
+        if self.queue.qsize() >= self.max_queue:
+            self.dropped += 1
+            return
+        self.queue.put(record)
+        if self._thread is None:
+            self._start_thread()
+
+    def _start_thread(self):
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='uniproxy-logger', daemon=True)
+                self._thread.start()
+
+    def format(self, record):
+        timestamp, levelno, port, message, args, fields = record
+        if args:
+            try:
+                message = message % args
+            except (TypeError, ValueError):
+                message = f"{message} {args!r}"
+        if self.json_format:
+            entry = {'ts': round(timestamp, 3), 'level': _LEVEL_NAMES[levelno].lower(), 'port': port,
+                     'msg': message}
+            if fields:
+                entry.update(fields)
+            return json.dumps(entry, ensure_ascii=False, default=str)
+        text = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+        text = f"{text} {_LEVEL_NAMES[levelno]} "
+        if port is not None:
+            text += f"端口 {port}："
+        text += message
+        if fields:
+            text += ' ' + ' '.join(f"{key}={value}" for key, value in fields.items())
+        return text
+
+    def _run(self):
+        while True:
+            records = [self.queue.get()]
+            # 一次取出队列中已有的全部日志，合并为一次写入
+            try:
+                while len(records) < 1024:
+                    records.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            stop = None in records
+            lines = [self.format(record) for record in records if record is not None]
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                lines.append(self.format((time.time(), 30, None, "日志队列已满，丢弃了 %d 条日志", (dropped,), None)))
+            self._write(lines)
+            if stop:
+                return
+
+    def _write(self, lines):
+        # 运行时再取 sys.stdout，兼容被重定向的情况；无控制台的打包程序中 stdout 可能为 None
+        stream = self.stream or sys.stdout
+        if stream is None or not lines:
+            return
+        try:
+            stream.write('\n'.join(lines) + '\n')
+            stream.flush()
+        except (OSError, ValueError):
+            pass
+
+    def close(self, timeout=2.0):
+        """输出队列中剩余的日志并结束后台线程"""
+        with self._thread_lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self.queue.put(None)
+            thread.join(timeout)
+
+
+# 进程内共享的日志实例
+logger = Logger()
+atexit.register(logger.close)
@@ -0,0 +1,118 @@
+import asyncio
+import threading
+
+from logger import logger
+
+# asyncio：标准库事件循环；uvloop：基于 libuv 的事件循环（需安装 uvloop，不支持 Windows）；
+# auto：可用时使用 uvloop，否则使用 asyncio
+LOOP_POLICIES = ('asyncio', 'uvloop', 'auto')
+
+
+def resolve_loop_policy(policy):
+    """返回 (实际使用的事件循环实现名称, 创建事件循环的函数)，uvloop 不可用时退回 asyncio"""
+    if policy not in LOOP_POLICIES:
+        raise ValueError(f"未知的事件循环实现: {policy}")
+    if policy != 'asyncio':
+        try:
+            import uvloop
+        except ImportError:
+            if policy == 'uvloop':
+                logger.warning(None, "未安装 uvloop，退回标准 asyncio 事件循环")
+        else:
+            return 'uvloop', uvloop.new_event_loop
+    return 'asyncio', asyncio.new_event_loop
+
+
+class LoopEngine:
+    """固定数量的共享事件循环，所有端口的 SOCKS5 监听器都运行在这些循环上"""
+
+    def __init__(self, loop_count=1, loop_policy='asyncio'):
+        if loop_count < 1:
+            raise ValueError("事件循环数量必须至少为 1")
+        self.loop_count = loop_count
+        # 实际使用的事件循环实现（请求 uvloop 但未安装时为 asyncio）
+        self.loop_policy, self.loop_factory = resolve_loop_policy(loop_policy)
+        self.loops = []
+        self.threads = []
+        # 每个事件循环上承载的端口数，用于挑选负载最小的循环
+        self.loop_load = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        """启动全部事件循环线程（重复调用无副作用）"""
+        with self._lock:
+            if self.loops:
+                return
+            for index in range(self.loop_count):
+                loop = self.loop_factory()
+                ready = threading.Event()
+                thread = threading.Thread(
+                    target=self._run_loop, args=(loop, ready),
+                    name=f"uniproxy-loop-{index}", daemon=True
+                )
+                thread.start()
+                ready.wait()
+                self.loops.append(loop)
+                self.threads.append(thread)
+                self.loop_load[loop] = 0
+
+    @staticmethod
+    def _run_loop(loop, ready):
+        asyncio.set_event_loop(loop)
+        loop.call_soon(ready.set)
+        try:
+            loop.run_forever()
+        finally:
+            # 取消仍在运行的连接任务，再关闭事件循环
+            pending = asyncio.all_tasks(loop)
+            for task in pending:
+                task.cancel()
+            if pending:
+                loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            loop.close()
+
+    @property
+    def running(self):
+        return bool(self.loops)
+
+    def control_loop(self):
+        """运行管理类后台任务（健康探测等）的事件循环"""
+        self.start()
+        return self.loops[0]
+
+    def acquire_loop(self):
+        """挑选承载端口最少的事件循环，并计入一个端口"""
+        self.start()
+        with self._lock:
+            loop = min(self.loops, key=lambda l: self.loop_load[l])
+            self.loop_load[loop] += 1
+            return loop
+
+    def release_loop(self, loop):
+        """端口从事件循环上移除后调用"""
+        with self._lock:
+            if loop in self.loop_load and self.loop_load[loop] > 0:
+                self.loop_load[loop] -= 1
+
+    def run_coroutine(self, coro, loop, timeout=None):
+        """在指定事件循环上执行协程，并在当前线程同步等待结果"""
+        future = asyncio.run_coroutine_threadsafe(coro, loop)
+        try:
+            return future.result(timeout=timeout)
+        except BaseException:
+            future.cancel()
+            raise
+
+    def stop(self, timeout=3.0):
+        """停止所有事件循环线程"""
+        with self._lock:
+            loops, threads = self.loops, self.threads
+            self.loops, self.threads = [], []
+            self.loop_load = {}
+        for loop in loops:
+            if loop.is_running():
+                loop.call_soon_threadsafe(loop.stop)
+        for thread in threads:
+            thread.join(timeout=timeout)
+            if thread.is_alive():
+                logger.warning(None, "事件循环线程 %s 未正常终止", thread.name)
@@ -1,12 +1,20 @@
-import os
+import multiprocessing
 import sys
-import tkinter as tk
-from ui import UniproxyApp
 
 def main():
+    # 图形界面的依赖只在需要时导入，无界面模式不加载 tkinter
+    import tkinter as tk
+    from ui import UniproxyApp
+
     root = tk.Tk()
     app = UniproxyApp(root)
     root.mainloop()
 
 if __name__ == "__main__":
+    # 打包后的程序在多进程模式下启动工作进程时需要
+    multiprocessing.freeze_support()
+    if len(sys.argv) > 1:
+        # 带参数启动时按配置文件无界面运行，例如 main.py -c uniproxy.json
+        from daemon import main as daemon_main
+        sys.exit(daemon_main())
     main()
@@ -0,0 +1,211 @@
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from logger import logger
+
+# 延迟直方图的桶上限（秒）
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram:
+    """固定桶的直方图，只在所属事件循环线程中更新，无需加锁"""
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # 最后一个元素对应 +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        return {'buckets': list(self.buckets), 'counts': list(self.counts), 'sum': self.sum, 'count': self.count}
+
+
+class PortMetrics:
+    """单个端口的计数器和直方图
+
+    只由端口所在的事件循环线程更新（普通的整数加法，没有锁），
+    抓取时由其他线程读取 snapshot()，各数值之间可能相差正在进行的几次更新
+    """
+
+    __slots__ = ('accepts', 'rejected', 'handshake_errors', 'tunnels', 'bytes_up', 'bytes_down',
+                 'connect_failures', 'throttled', 'error_replies', 'handshake_time', 'connect_time')
+
+    def __init__(self):
+        self.accepts = 0
+        self.rejected = 0
+        self.handshake_errors = 0
+        # 正在转发的隧道数
+        self.tunnels = 0
+        # 客户端 -> 上游、上游 -> 客户端方向转发的字节数
+        self.bytes_up = 0
+        self.bytes_down = 0
+        self.connect_failures = 0
+        # 因超出带宽限制而暂停转发的次数
+        self.throttled = 0
+        # SOCKS5 应答码 -> 返回给客户端的错误应答次数
+        self.error_replies = {}
+        self.handshake_time = Histogram()
+        self.connect_time = Histogram()
+
+    def error_reply(self, code):
+        self.error_replies[code] = self.error_replies.get(code, 0) + 1
+
+    def snapshot(self, connections=0):
+        """可跨进程传递的数值快照，connections 为当前的客户端连接数"""
+        return {
+            'accepts': self.accepts,
+            'rejected': self.rejected,
+            'handshake_errors': self.handshake_errors,
+            'connections': connections,
+            'tunnels': self.tunnels,
+            'bytes_up': self.bytes_up,
+            'bytes_down': self.bytes_down,
+            'connect_failures': self.connect_failures,
+            'throttled': self.throttled,
+            'error_replies': dict(self.error_replies),
+            'handshake_time': self.handshake_time.snapshot(),
+            'connect_time': self.connect_time.snapshot(),
+        }
+
+
+def merge_snapshots(first, second):
+    """合并同一端口在多个工作进程中的快照（reuseport 模式）"""
+    merged = {}
+    for key, value in first.items():
+        other = second.get(key)
+        if isinstance(value, dict) and 'counts' in value:
+            merged[key] = dict(value, counts=[a + b for a, b in zip(value['counts'], other['counts'])],
+                               sum=value['sum'] + other['sum'], count=value['count'] + other['count'])
+        elif isinstance(value, dict):
+            merged[key] = dict(value)
+            for code, count in other.items():
+                merged[key][code] = merged[key].get(code, 0) + count
+        else:
+            merged[key] = value + other
+    return merged
+
+
+# (快照字段, 指标名, 类型, 说明)
+_SIMPLE_METRICS = (
+    ('accepts', 'uniproxy_accepts_total', 'counter', '接受的客户端连接数'),
+    ('rejected', 'uniproxy_rejected_total', 'counter', '因连接数上限被拒绝的连接数'),
+    ('handshake_errors', 'uniproxy_handshake_errors_total', 'counter', '握手失败或超时的连接数'),
+    ('connections', 'uniproxy_connections', 'gauge', '当前的客户端连接数'),
+    ('tunnels', 'uniproxy_active_tunnels', 'gauge', '正在转发数据的隧道数'),
+    ('connect_failures', 'uniproxy_upstream_connect_failures_total', 'counter', '经上游连接目标失败的次数'),
+    ('throttled', 'uniproxy_throttled_total', 'counter', '因超出带宽限制而暂停转发的次数'),
+)
+_HISTOGRAMS = (
+    ('handshake_time', 'uniproxy_handshake_seconds', '从接受连接到解析完客户端请求的耗时'),
+    ('connect_time', 'uniproxy_upstream_connect_seconds', '经上游连接目标的耗时'),
+)
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_prometheus(snapshots, extra=None):
+    """把 {port: 快照} 渲染为 Prometheus 文本格式；extra 为 [(指标名, 类型, 说明, 数值)] 形式的进程级指标"""
+    ports = sorted(snapshots)
+    lines = []
+    for field, name, kind, help_text in _SIMPLE_METRICS:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for port in ports:
+            lines.append(f'{name}{{port="{port}"}} {snapshots[port][field]}')
+
+    name = 'uniproxy_relay_bytes_total'
+    lines.append(f'# HELP {name} 隧道转发的字节数')
+    lines.append(f'# TYPE {name} counter')
+    for port in ports:
+        lines.append(f'{name}{{port="{port}",direction="up"}} {snapshots[port]["bytes_up"]}')
+        lines.append(f'{name}{{port="{port}",direction="down"}} {snapshots[port]["bytes_down"]}')
+
+    name = 'uniproxy_error_replies_total'
+    lines.append(f'# HELP {name} 按 SOCKS5 应答码统计的错误应答数')
+    lines.append(f'# TYPE {name} counter')
+    for port in ports:
+        for code, count in sorted(snapshots[port]['error_replies'].items()):
+            lines.append(f'{name}{{port="{port}",code="{code:#04x}"}} {count}')
+
+    for field, name, help_text in _HISTOGRAMS:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} histogram')
+        for port in ports:
+            histogram = snapshots[port][field]
+            cumulative = 0
+            for bound, count in zip(list(histogram['buckets']) + ['+Inf'], histogram['counts']):
+                cumulative += count
+                le = bound if bound == '+Inf' else _format_value(bound)
+                lines.append(f'{name}_bucket{{port="{port}",le="{le}"}} {cumulative}')
+            lines.append(f'{name}_sum{{port="{port}"}} {_format_value(histogram["sum"])}')
+            lines.append(f'{name}_count{{port="{port}"}} {histogram["count"]}')
+
+    for name, kind, help_text, value in extra or ():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        lines.append(f'{name} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    """在独立线程中提供 /metrics 的本地 HTTP 服务，抓取不占用代理的事件循环
+
+    collect() 返回 Prometheus 文本，每次抓取时调用
+    """
+
+    def __init__(self, collect, host='127.0.0.1', port=9464):
+        self.collect = collect
+        self.host = host
+        self.port = port
+        self.httpd = None
+        self.thread = None
+
+    def start(self):
+        collect = self.collect
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                try:
+                    body = collect().encode('utf-8')
+                except Exception as e:
+                    self.send_error(500, str(e))
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # 不为每次抓取打印访问日志
+                pass
+
+        self.httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.httpd.daemon_threads = True
+        # 端口为 0 时记录实际绑定的端口
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='uniproxy-metrics', daemon=True)
+        self.thread.start()
+        logger.info(None, "监控指标服务启动在 http://%s:%s/metrics", self.host, self.port)
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+            self.thread.join(timeout=2)
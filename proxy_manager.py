@@ -1,188 +1,632 @@
 import asyncio
+import json
+import os
 import socket
-import threading
+import sys
 import time
 import requests
-import socks
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from admission import ConnectionLimiter
+from dns_cache import RESOLVE_MODES, DnsCache
+from http_proxy import HttpProxySession, looks_like_http
+from logger import logger
+from loop_engine import LoopEngine
+from metrics import MetricsServer, PortMetrics, render_prometheus
+from proxy_source import ProxyListSource
+from relay import DEFAULT_BUFFER_BUDGET, DEFAULT_BUFFER_SIZE, BufferBudget, relay
+from shaping import BandwidthLimits, TokenBucket
+from socks5_client import (CMD_CONNECT, CMD_UDP_ASSOCIATE, REP_COMMAND_NOT_SUPPORTED, REP_GENERAL_FAILURE,
+                           REP_HOST_UNREACHABLE, REP_SUCCEEDED, Socks5Error, socks5_bound_reply, socks5_reply)
+from socks5_parser import Socks5ProtocolError, Socks5RequestParser
+from state_store import StateStore
+from udp_relay import UdpAssociation
+from upstream_group import UpstreamGroup
+from workers import WorkerSupervisor
+
+# 监听队列长度，与 asyncio.start_server 的默认值相同
+LISTEN_BACKLOG = 100
+# 握手阶段每次读取的最大字节数
+HANDSHAKE_READ_SIZE = 4096
+
 
 class ProxyManager:
-    def __init__(self):
-        # 存储每个端口对应的代理服务器任务和事件循环
+    def __init__(self, loop_count=1, worker_count=1, sharding='auto', health_checker=None, dns_cache=None,
+                 buffer_budget_bytes=DEFAULT_BUFFER_BUDGET, global_max_connections=None, loop_policy='asyncio',
+                 global_upload_rate=None, global_download_rate=None, **server_options):
+        # 存储每个端口对应的代理服务器和所在的事件循环
         self.port_to_server = {}
         self.port_to_loop = {}
-        self.port_to_thread = {}
+        # 其余关键字参数（如 relay_mode）原样传给每个 Socks5Server
+        self.server_options = server_options
+        # 所有端口共享固定数量的事件循环线程，而不是每个端口一个线程；
+        # loop_policy 选择事件循环实现（asyncio、uvloop 或 auto）
+        self.engine = LoopEngine(loop_count, loop_policy)
+        # worker_count > 1 时端口在多个工作进程中运行，以利用多个 CPU 核心
+        self.workers = None
+        if worker_count > 1:
+            # 每个工作进程各自使用 buffer_budget_bytes 大小的预算
+            self.workers = WorkerSupervisor(worker_count, sharding, loop_count,
+                                            buffer_budget_bytes=buffer_budget_bytes,
+                                            global_max_connections=global_max_connections,
+                                            global_upload_rate=global_upload_rate,
+                                            global_download_rate=global_download_rate,
+                                            loop_policy=loop_policy, **server_options)
+        # 可选的 ProxyHealthChecker：API 返回的代理先探测，只把健康的分配给端口
+        self.health_checker = health_checker
+        # API 链接 -> ProxyListSource，以及各端口段（起始端口 -> 任务）的定时刷新任务
+        self.proxy_sources = {}
+        self.refresh_tasks = {}
+        # API 端口段：起始端口 -> (port_count, group_size)，后台复查时用于给上游全部失效的端口换上健康的代理
+        self.api_groups = {}
+        # resolve_mode 为 local 的端口共享同一个 DNS 缓存；个别端口的解析方式可单独设置
+        self.dns_cache = dns_cache or DnsCache()
+        self.resolve_modes = {}
+        # 本进程全部隧道共享的写缓冲区预算，buffer_budget_bytes 为 None 或 0 时不限制
+        self.buffer_budget = BufferBudget(buffer_budget_bytes) if buffer_budget_bytes else None
+        # 本进程所有端口共享的并发连接上限（多进程模式下每个工作进程各自限制）
+        self.connection_limiter = None
+        if global_max_connections:
+            self.connection_limiter = ConnectionLimiter(
+                global_max_connections, server_options.get('admission', 'queue'),
+                queue_timeout=server_options.get('queue_timeout', 5.0)
+            )
+        # 本进程所有端口共享的上传、下载带宽上限（字节/秒），多进程模式下由各工作进程平分
+        self.global_bandwidth = (TokenBucket(global_upload_rate) if global_upload_rate else None,
+                                 TokenBucket(global_download_rate) if global_download_rate else None)
+        # 可选的 Prometheus 指标服务，由 start_metrics_server 启动
+        self.metrics_server = None
+        # 可选的状态快照，由 enable_state_store 启用，端口映射或健康状态变化时写入磁盘
+        self.state_store = None
 
     class Socks5Server:
-        def __init__(self, local_port, upstream_host, upstream_port, username=None, password=None):
+        def __init__(self, local_port, upstream_host, upstream_port, username=None, password=None, connect_timeout=10.0,
+                     relay_mode='auto', relay_buffer_size=DEFAULT_BUFFER_SIZE, reuse_port=False,
+                     pool_size=2, pool_idle_timeout=30.0, upstreams=None, max_attempts=3,
+                     udp_idle_timeout=60.0, max_udp_associations=256, resolve_mode='remote', resolver=None,
+                     write_buffer_high=None, write_buffer_low=None, buffer_budget=None,
+                     max_connections=None, admission='queue', queue_timeout=5.0, connection_limiter=None,
+                     handshake_timeout=10.0, idle_timeout=300.0, upload_rate=None, download_rate=None,
+                     connection_upload_rate=None, connection_download_rate=None, global_bandwidth=(None, None),
+                     race_count=1, race_delay=0.25):
             self.local_port = local_port
             self.upstream_host = upstream_host
             self.upstream_port = upstream_port
             self.username = username
             self.password = password
+            self.connect_timeout = connect_timeout
+            self.relay_mode = relay_mode
+            self.relay_buffer_size = relay_buffer_size
+            # 本端口的计数器和直方图，只在所在的事件循环中更新
+            self.metrics = PortMetrics()
+            # 带宽限制（字节/秒）：upload_rate、download_rate 由本端口的全部连接共享，
+            # connection_* 限制单个连接，global_bandwidth 为 ProxyManager 传入的进程级令牌桶
+            shaping = BandwidthLimits(upload_rate, download_rate, connection_upload_rate, connection_download_rate,
+                                      global_bandwidth)
+            # 每条隧道转发时使用的参数：读取大小上限、写缓冲区水位、进程级缓冲区预算、指标和限速
+            self.relay_options = {
+                'mode': relay_mode,
+                'buffer_size': relay_buffer_size,
+                'write_buffer_high': write_buffer_high,
+                'write_buffer_low': write_buffer_low,
+                'budget': buffer_budget,
+                'idle_timeout': idle_timeout,
+                'metrics': self.metrics,
+                'shaping': shaping if shaping.enabled else None,
+            }
+            self.reuse_port = reuse_port
+            # 本端口对应的上游组：首选上游在前，upstreams 中的其他上游用于负载均衡和故障切换。
+            # 每个上游各有一个预先完成问候和认证的连接池，新客户端只需等待 CONNECT 往返。
+            # pool_size 是每个上游的空闲连接上限，一个端口最多保留 上游数 × pool_size 个空闲连接。
+            # race_count > 1 时错开 race_delay 秒并行连接前 race_count 个上游（上游主机名的多个地址同样如此）
+            self.upstreams = UpstreamGroup(
+                [(upstream_host, upstream_port, username, password)] + list(upstreams or []),
+                max_attempts=max_attempts, race_count=race_count, race_delay=race_delay, max_size=pool_size,
+                idle_timeout=pool_idle_timeout, connect_timeout=connect_timeout,
+                happy_eyeballs_delay=race_delay if race_count > 1 else None
+            )
+            # 进行中的 UDP ASSOCIATE 会话，数量受 max_udp_associations 限制
+            self.udp_idle_timeout = udp_idle_timeout
+            self.max_udp_associations = max_udp_associations
+            self.udp_associations = set()
+            # 域名目标的解析方式，local 模式使用共享的 DnsCache
+            if resolve_mode not in RESOLVE_MODES:
+                raise ValueError(f"未知的解析模式: {resolve_mode}")
+            self.resolve_mode = resolve_mode
+            self.resolver = resolver
+            # 准入控制：本端口的并发连接上限，以及 ProxyManager 传入的进程级 connection_limiter
+            self.port_limiter = ConnectionLimiter(max_connections, admission, queue_timeout=queue_timeout) \
+                if max_connections else None
+            self.connection_limiter = connection_limiter
+            self.handshake_timeout = handshake_timeout
+            # 当前连接的 writer -> 处理任务，停止端口时用于关闭连接
+            self.connections = {}
             self.server = None
             self.running = False
 
         async def handle_client(self, reader, writer):
             client_addr = writer.get_extra_info('peername')
-            print(f"客户端连接到端口 {self.local_port}，来自 {client_addr}")
+            metrics = self.metrics
+            metrics.accepts += 1
+            if not await self.admit():
+                metrics.rejected += 1
+                writer.transport.abort()
+                logger.debug(self.local_port, "连接数已达上限，拒绝来自 %s 的连接", client_addr)
+                return
+            self.connections[writer] = asyncio.current_task()
+            logger.debug(self.local_port, "客户端连接，来自 %s", client_addr)
             try:
-                data = await reader.read(1024)
-                if not data or len(data) < 3 or data[0] != 5:
-                    print(f"端口 {self.local_port}：无效的 SOCKS5 握手，数据: {data}")
+                started = time.monotonic()
+                try:
+                    request = await asyncio.wait_for(self.read_request(reader, writer), self.handshake_timeout)
+                except asyncio.TimeoutError:
+                    metrics.handshake_errors += 1
+                    logger.debug(self.local_port, "握手超时（%s 秒）", self.handshake_timeout)
                     return
-                
-                writer.write(b'\x05\x00')
-                await writer.drain()
-                print(f"端口 {self.local_port}：完成 SOCKS5 握手")
-
-                data = await reader.read(1024)
-                if len(data) < 4 or data[0] != 5:
-                    print(f"端口 {self.local_port}：无效的 SOCKS5 请求，数据: {data}")
+                if request is None:
+                    metrics.handshake_errors += 1
                     return
-
-                cmd = data[1]
-                if cmd != 1:
-                    writer.write(b'\x05\x07\x00\x01\x00\x00\x00\x00\x00\x00')
-                    await writer.drain()
-                    print(f"端口 {self.local_port}：不支持的命令 {cmd}")
+                metrics.handshake_time.observe(time.monotonic() - started)
+                if isinstance(request, bytes):
+                    session = HttpProxySession(reader, writer, self.open_target,
+                                               relay_options=self.relay_options, label=self.local_port)
+                    await session.run(request)
                     return
+                parser = request
 
-                addr_type = data[3]
-                if addr_type == 1:
-                    if len(data) < 10:
-                        print(f"端口 {self.local_port}：IPv4 数据长度不足，数据: {data}")
-                        return
-                    target_ip = socket.inet_ntoa(data[4:8])
-                    target_port = int.from_bytes(data[8:10], 'big')
-                elif addr_type == 3:
-                    domain_len = data[4]
-                    if len(data) < 5 + domain_len + 2:
-                        print(f"端口 {self.local_port}：域名数据长度不足，数据: {data}")
-                        return
-                    target_ip = data[5:5 + domain_len].decode('utf-8')
-                    target_port = int.from_bytes(data[5 + domain_len:5 + domain_len + 2], 'big')
-                else:
-                    writer.write(b'\x05\x08\x00\x01\x00\x00\x00\x00\x00\x00')
+                if parser.command == CMD_UDP_ASSOCIATE:
+                    await self.handle_udp_associate(reader, writer)
+                    return
+                if parser.command != CMD_CONNECT:
+                    metrics.error_reply(REP_COMMAND_NOT_SUPPORTED)
+                    writer.write(socks5_reply(REP_COMMAND_NOT_SUPPORTED))
                     await writer.drain()
-                    print(f"端口 {self.local_port}：不支持的地址类型 {addr_type}")
+                    logger.debug(self.local_port, "不支持的命令 %s", parser.command)
                     return
+                target_ip, target_port = parser.host, parser.port
 
-                print(f"端口 {self.local_port}：连接目标 {target_ip}:{target_port}")
+                logger.debug(self.local_port, "连接目标 %s:%s", target_ip, target_port)
 
                 try:
-                    upstream_sock = socks.socksocket()
-                    upstream_sock.set_proxy(
-                        socks.SOCKS5,
-                        self.upstream_host,
-                        self.upstream_port,
-                        username=self.username if self.username else "",
-                        password=self.password if self.password else ""
-                    )
-                    upstream_sock.connect((target_ip, target_port))
-                    print(f"端口 {self.local_port}：成功连接上游服务器 {self.upstream_host}:{self.upstream_port}")
-                except Exception as e:
-                    writer.write(b'\x05\x05\x00\x01\x00\x00\x00\x00\x00\x00')
+                    upstream_reader, upstream_writer, upstream = await self.open_target(target_ip, target_port)
+                    logger.debug(self.local_port, "成功连接上游服务器 %s:%s", upstream.host, upstream.port)
+                except Socks5Error as e:
+                    metrics.error_reply(e.reply_code)
+                    writer.write(socks5_reply(e.reply_code))
                     await writer.drain()
-                    print(f"端口 {self.local_port}：连接上游服务器失败: {e}")
+                    logger.debug(self.local_port, "连接上游服务器失败: %s", e)
                     return
 
-                writer.write(b'\x05\x00\x00\x01\x00\x00\x00\x00\x00\x00')
-                await writer.drain()
-                print(f"端口 {self.local_port}：通知客户端连接成功")
-
-                upstream_reader, upstream_writer = await asyncio.open_connection(sock=upstream_sock)
+                # 上游连接建立后，无论通知客户端还是转发过程中出错都要关闭上游连接
+                try:
+                    writer.write(socks5_reply(REP_SUCCEEDED))
+                    # 客户端在请求之后紧接着发送的数据直接转给上游
+                    if parser.leftover:
+                        upstream_writer.write(parser.leftover)
+                        metrics.bytes_up += len(parser.leftover)
+                    await writer.drain()
+                    logger.debug(self.local_port, "通知客户端连接成功")
 
-                async def forward(reader, writer, direction):
-                    try:
-                        while True:
-                            data = await reader.read(4096)
-                            if not data:
-                                print(f"端口 {self.local_port}：{direction} 连接关闭")
-                                break
-                            writer.write(data)
-                            await writer.drain()
-                    except Exception as e:
-                        print(f"端口 {self.local_port}：{direction} 转发异常: {e}")
-
-                tasks = [
-                    forward(reader, upstream_writer, "客户端->上游"),
-                    forward(upstream_reader, writer, "上游->客户端")
-                ]
-                await asyncio.gather(*tasks)
+                    await relay(reader, writer, upstream_reader, upstream_writer,
+                                label=self.local_port, **self.relay_options)
+                finally:
+                    upstream_writer.close()
 
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                # 客户端或上游重置连接很常见，高负载下按 ERROR 记录会淹没日志队列
+                logger.debug(self.local_port, "连接中断: %r", e)
             except Exception as e:
-                print(f"处理客户端连接时出错（端口 {self.local_port}）：{e}")
+                logger.error(self.local_port, "处理客户端连接时出错: %r", e)
             finally:
+                self.connections.pop(writer, None)
+                self.release()
                 writer.close()
-                await writer.wait_closed()
-                print(f"端口 {self.local_port}：客户端连接关闭")
+                try:
+                    await writer.wait_closed()
+                except (ConnectionError, OSError):
+                    pass
+                logger.debug(self.local_port, "客户端连接关闭")
 
-        async def start(self):
+        async def admit(self):
+            """依次取得端口级和进程级的连接名额，被拒绝时返回 False"""
+            if self.port_limiter is not None and not await self.port_limiter.acquire():
+                return False
+            if self.connection_limiter is None:
+                return True
             try:
-                self.server = await asyncio.start_server(
-                    self.handle_client, '0.0.0.0', self.local_port
-                )
-                self.running = True
-                print(f"SOCKS5 服务器启动在端口 {self.local_port}")
-                async with self.server:
-                    await self.server.serve_forever()
-            except Exception as e:
-                print(f"启动 SOCKS5 服务器时出错（端口 {self.local_port}）：{e}")
-                self.running = False
+                if await self.connection_limiter.acquire():
+                    return True
+            except BaseException:
+                if self.port_limiter is not None:
+                    self.port_limiter.release()
+                raise
+            if self.port_limiter is not None:
+                self.port_limiter.release()
+            return False
+
+        def release(self):
+            if self.port_limiter is not None:
+                self.port_limiter.release()
+            if self.connection_limiter is not None:
+                self.connection_limiter.release()
+
+        async def read_request(self, reader, writer):
+            """读取客户端请求：HTTP 代理请求返回已读取的首段数据，SOCKS5 返回完成解析的
+            Socks5RequestParser，连接已结束或请求无效时返回 None
+            """
+            data = await reader.read(HANDSHAKE_READ_SIZE)
+            if not data:
+                logger.debug(self.local_port, "握手未完成客户端即关闭连接")
+                return None
+            # 按首字节区分协议：0x05 为 SOCKS5，大写字母开头为 HTTP 代理请求
+            if looks_like_http(data):
+                return data
+
+            # 问候与请求可能分片到达，也可能与后续载荷一起到达，统一交给增量解析器
+            parser = Socks5RequestParser()
+            while True:
+                try:
+                    response = parser.feed(data)
+                except Socks5ProtocolError as e:
+                    if e.reply:
+                        self.metrics.error_reply(e.reply_code)
+                        writer.write(e.reply)
+                        await writer.drain()
+                    logger.debug(self.local_port, "%s", e)
+                    return None
+                if response:
+                    writer.write(response)
+                if parser.done:
+                    return parser
+                data = await reader.read(HANDSHAKE_READ_SIZE)
+                if not data:
+                    logger.debug(self.local_port, "握手未完成客户端即关闭连接")
+                    return None
+
+        async def open_target(self, host, port):
+            """经上游组连接目标，local 模式下先在本地解析域名，返回 (reader, writer, upstream)"""
+            started = time.monotonic()
+            try:
+                if self.resolve_mode == 'local' and self.resolver is not None:
+                    try:
+                        addresses = await self.resolver.resolve(host)
+                    except OSError as e:
+                        raise Socks5Error(f"本地解析 {host} 失败: {e}", REP_HOST_UNREACHABLE,
+                                          target_error=True) from e
+                    host = addresses[0]
+                connection = await self.upstreams.open_connection(host, port)
+            except Socks5Error:
+                self.metrics.connect_failures += 1
+                raise
+            self.metrics.connect_time.observe(time.monotonic() - started)
+            return connection
+
+        async def handle_udp_associate(self, reader, writer):
+            """处理 UDP ASSOCIATE：经上游的 UDP 会话转发数据报，直到控制连接关闭或空闲超时"""
+            if len(self.udp_associations) >= self.max_udp_associations:
+                self.metrics.error_reply(REP_GENERAL_FAILURE)
+                writer.write(socks5_reply(REP_GENERAL_FAILURE))
+                await writer.drain()
+                logger.warning(self.local_port, "UDP 会话数已达上限 %s", self.max_udp_associations)
+                return
+            try:
+                upstream_reader, upstream_writer, relay_address, upstream = \
+                    await self.upstreams.open_association()
+            except Socks5Error as e:
+                self.metrics.connect_failures += 1
+                self.metrics.error_reply(e.reply_code)
+                writer.write(socks5_reply(e.reply_code))
+                await writer.drain()
+                logger.debug(self.local_port, "建立上游 UDP 会话失败: %s", e)
+                return
+            association = UdpAssociation(reader, writer, upstream_reader, upstream_writer, relay_address,
+                                         upstream.host, idle_timeout=self.udp_idle_timeout)
+            try:
+                bound_host, bound_port = await association.start()
+            except OSError as e:
+                association.close()
+                self.metrics.error_reply(REP_GENERAL_FAILURE)
+                writer.write(socks5_reply(REP_GENERAL_FAILURE))
+                await writer.drain()
+                logger.warning(self.local_port, "创建 UDP 端点失败: %s", e)
+                return
+            self.udp_associations.add(association)
+            try:
+                writer.write(socks5_bound_reply(bound_host, bound_port))
+                await writer.drain()
+                logger.debug(self.local_port, "UDP 会话经上游 %s:%s 中继，本地端点 %s:%s",
+                             upstream.host, upstream.port, bound_host, bound_port)
+                await association.run()
+            finally:
+                self.udp_associations.discard(association)
+                association.close()
+
+        def retarget(self, upstreams, health=None):
+            """原子地切换本端口的上游组（须在服务器所在的事件循环中调用）
+
+            监听套接字保持绑定，之后接入的连接立即使用新上游，
+            已建立的隧道继续使用原来的上游连接直到自然结束；health 为可选的健康探测结果
+            """
+            old = self.upstreams
+            if [member.key for member in old.members] == [tuple(u) for u in upstreams]:
+                # 上游未变化时保留连接池和统计数据
+                if health:
+                    old.apply_health(health)
+                return
+            self.upstreams = UpstreamGroup(upstreams, max_attempts=old.max_attempts, race_count=old.race_count,
+                                           race_delay=old.race_delay, **old.pool_options)
+            if health:
+                self.upstreams.apply_health(health)
+            self.upstream_host, self.upstream_port, self.username, self.password = upstreams[0]
+            # 旧上游组只需关闭空闲的预建连接
+            old.close()
+
+        def bind(self):
+            """同步创建并绑定监听套接字，绑定失败时直接抛出 OSError"""
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                # 与 asyncio.start_server 的默认行为一致：仅在 POSIX 系统上设置 SO_REUSEADDR
+                if os.name == 'posix' and sys.platform != 'cygwin':
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                if self.reuse_port:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+                sock.bind(('0.0.0.0', self.local_port))
+                sock.listen(LISTEN_BACKLOG)
+                sock.setblocking(False)
+            except BaseException:
+                sock.close()
+                raise
+            return sock
+
+        async def start(self):
+            """在当前事件循环上绑定监听端口，绑定失败时直接抛出异常"""
+            self.server = await asyncio.start_server(self.handle_client, sock=self.bind())
+            self.running = True
+            logger.info(self.local_port, "SOCKS5 服务器已启动")
 
         async def stop(self):
             if self.server and self.running:
                 self.running = False
+                self.upstreams.close()
+                for association in list(self.udp_associations):
+                    association.close()
                 self.server.close()
+                # 中止仍在进行的连接，让各处理任务正常结束而不是在事件循环关闭时被取消
+                tasks = list(self.connections.values())
+                for writer in list(self.connections):
+                    writer.transport.abort()
+                if tasks:
+                    await asyncio.wait(tasks, timeout=1.0)
                 await self.server.wait_closed()
-                print(f"SOCKS5 服务器停止在端口 {self.local_port}")
+                logger.info(self.local_port, "SOCKS5 服务器已停止")
+
+        async def drain(self, timeout):
+            """停止接受新连接，等待已有连接自然结束（最多 timeout 秒）后停止服务器"""
+            if self.server and self.running:
+                # 只关闭监听套接字，已建立的连接继续转发
+                self.server.close()
+                tasks = list(self.connections.values())
+                if tasks:
+                    logger.info(self.local_port, "停止接受新连接，等待 %d 个连接结束", len(tasks))
+                    await asyncio.wait(tasks, timeout=timeout)
+            await self.stop()
 
-    def stop_proxy_on_port(self, port):
+    def stop_proxy_on_port(self, port, timeout=2.0):
         """停止指定端口的代理服务器"""
-        if port in self.port_to_server:
-            server = self.port_to_server[port]
-            loop = self.port_to_loop[port]
-            thread = self.port_to_thread[port]
+        if self.workers:
+            self.workers.stop_ports([port])
+            self._state_changed()
+            return
+        server = self.port_to_server.pop(port, None)
+        if server is None:
+            return
+        self._state_changed()
+        loop = self.port_to_loop.pop(port)
+        if loop.is_running():
+            try:
+                self.engine.run_coroutine(server.stop(), loop, timeout=timeout)
+            except Exception as e:
+                logger.warning(port, "停止服务器超时或出错: %s", e)
+        self.engine.release_loop(loop)
+        logger.info(port, "已停止代理服务器")
+
+    def stop_ports(self, ports, timeout=10.0, drain_timeout=None):
+        """批量停止端口，每个事件循环上的端口在一个协程中一起关闭
+
+        提供 drain_timeout（秒）时先停止接受新连接，等待已有连接结束或超时后再关闭
+        """
+        if self.workers:
+            self.workers.stop_ports(ports, drain_timeout)
+            self._state_changed()
+            return
+        if drain_timeout:
+            timeout += drain_timeout
+        batches = {}
+        for port in ports:
+            server = self.port_to_server.pop(port, None)
+            if server is not None:
+                batches.setdefault(self.port_to_loop.pop(port), []).append(server)
+        if batches:
+            self._state_changed()
+        futures = {}
+        for loop, servers in batches.items():
             if loop.is_running():
-                future = asyncio.run_coroutine_threadsafe(server.stop(), loop)
+                futures[loop] = asyncio.run_coroutine_threadsafe(self._stop_batch(servers, drain_timeout), loop)
+        for loop, servers in batches.items():
+            if loop in futures:
                 try:
-                    future.result(timeout=2.0)
-                except asyncio.TimeoutError:
-                    print(f"停止端口 {port} 的服务器超时")
-            loop.call_soon_threadsafe(loop.stop)
-            thread.join(timeout=3.0)
-            if thread.is_alive():
-                print(f"线程在端口 {port} 未正常终止")
-            del self.port_to_server[port]
-            del self.port_to_loop[port]
-            del self.port_to_thread[port]
-            time.sleep(0.5)
-            print(f"已停止端口 {port} 的代理服务器")
-
-    def start_proxy_for_port(self, port, upstream_host, upstream_port, username=None, password=None, retries=3, retry_delay=1):
-        """为指定端口启动 SOCKS5 代理服务器，带有重试机制"""
-        self.stop_proxy_on_port(port)
+                    futures[loop].result(timeout=timeout)
+                except Exception as e:
+                    logger.warning(None, "批量停止端口超时或出错: %s", e)
+            for _ in servers:
+                self.engine.release_loop(loop)
+        if batches:
+            logger.info(None, "已停止 %d 个端口的代理服务器", sum(len(servers) for servers in batches.values()))
+
+    @staticmethod
+    async def _stop_batch(servers, drain_timeout=None):
+        if drain_timeout:
+            stops = (server.drain(drain_timeout) for server in servers)
+        else:
+            stops = (server.stop() for server in servers)
+        await asyncio.gather(*stops, return_exceptions=True)
+
+    def drain_ports(self, ports, timeout=30.0):
+        """让这些端口停止接受新连接，已有连接结束或 timeout 秒后关闭
+
+        不等待排空完成，立即返回开始排空的端口列表；排空中的端口不再出现在 port_to_server 中
+        """
+        if self.workers:
+            draining = self.workers.drain_ports(ports, timeout)
+            self._state_changed()
+            return draining
+        draining = []
+        for port in ports:
+            server = self.port_to_server.pop(port, None)
+            if server is None:
+                continue
+            loop = self.port_to_loop.pop(port)
+            future = asyncio.run_coroutine_threadsafe(server.drain(timeout), loop)
+            future.add_done_callback(lambda _, loop=loop: self.engine.release_loop(loop))
+            draining.append(port)
+        if draining:
+            self._state_changed()
+        return draining
+
+    def list_ports(self):
+        """运行中端口的上游和实时连接数，返回按端口排序的字典列表（不含上游密码）"""
+        if self.workers:
+            return self.workers.list_ports()
+        ports = []
+        for port, server in sorted(self.port_to_server.items()):
+            ports.append({
+                'port': port,
+                'upstreams': [[member.host, member.port, member.username] for member in server.upstreams.members],
+                'connections': len(server.connections),
+                'tunnels': server.metrics.tunnels,
+                'resolve_mode': server.resolve_mode,
+            })
+        return ports
+
+    def running_ports(self):
+        if self.workers:
+            return set(self.workers.assignments)
+        return set(self.port_to_server)
+
+    def retarget_port(self, port, upstream_host, upstream_port, username=None, password=None, upstreams=None,
+                      timeout=2.0):
+        """切换运行中端口的上游而不重启监听；端口未运行时返回 False"""
+        if self.workers:
+            if port not in self.workers.assignments:
+                return False
+            return self.start_ports([(port, upstream_host, upstream_port, username, password, upstreams)])[port]
+        server = self.port_to_server.get(port)
+        loop = self.port_to_loop.get(port)
+        if server is None or not server.running:
+            return False
+        group = [(upstream_host, upstream_port, username, password)] + list(upstreams or [])
+
+        async def apply():
+            server.retarget(group)
+
+        self.engine.run_coroutine(apply(), loop, timeout=timeout)
+        self._state_changed()
+        logger.info(port, "上游已切换为 %s:%s", upstream_host, upstream_port)
+        return True
+
+    def start_proxy_for_port(self, port, upstream_host, upstream_port, username=None, password=None, retries=3, retry_delay=1,
+                             upstreams=None):
+        """为指定端口启动 SOCKS5 代理服务器，带有重试机制；upstreams 为备用上游列表
+
+        端口已在运行时只切换上游，不重启监听
+        """
+        if self.workers:
+            return self.start_ports([(port, upstream_host, upstream_port, username, password, upstreams)])[port]
+        if self.retarget_port(port, upstream_host, upstream_port, username, password, upstreams):
+            return True
         for attempt in range(retries):
+            loop = self.engine.acquire_loop()
+            server = self.Socks5Server(port, upstream_host, upstream_port, username, password,
+                                       upstreams=upstreams, **self._server_options(port))
             try:
-                server = self.Socks5Server(port, upstream_host, upstream_port, username, password)
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                loop.create_task(server.start())
-                thread = threading.Thread(target=loop.run_forever, daemon=True)
-                thread.start()
-                self.port_to_server[port] = server
-                self.port_to_loop[port] = loop
-                self.port_to_thread[port] = thread
-                return True
+                # 绑定在共享事件循环上完成，结果同步返回
+                self.engine.run_coroutine(server.start(), loop, timeout=5.0)
             except Exception as e:
-                print(f"尝试 {attempt+1}/{retries} 启动端口 {port} 失败: {e}")
+                self.engine.release_loop(loop)
+                logger.warning(port, "尝试 %d/%d 启动失败: %s", attempt + 1, retries, e)
                 if attempt < retries - 1:
                     time.sleep(retry_delay)
                 continue
-        print(f"无法在端口 {port} 上启动代理服务器，已重试 {retries} 次")
+            self.port_to_server[port] = server
+            self.port_to_loop[port] = loop
+            self._state_changed()
+            return True
+        logger.error(port, "无法启动代理服务器，已重试 %d 次", retries)
         return False
 
+    def _server_options(self, port):
+        """创建某个端口的 Socks5Server 时使用的关键字参数"""
+        options = dict(self.server_options, resolver=self.dns_cache, buffer_budget=self.buffer_budget,
+                       connection_limiter=self.connection_limiter, global_bandwidth=self.global_bandwidth)
+        if port in self.resolve_modes:
+            options['resolve_mode'] = self.resolve_modes[port]
+        return options
+
+    def set_resolve_mode(self, ports, mode):
+        """设置这些端口的域名解析方式（remote 或 local），对运行中的端口立即生效"""
+        if mode not in RESOLVE_MODES:
+            raise ValueError(f"未知的解析模式: {mode}")
+        if self.workers:
+            self.workers.set_resolve_mode(ports, mode)
+        else:
+            for port in ports:
+                self.resolve_modes[port] = mode
+                server = self.port_to_server.get(port)
+                if server is not None:
+                    server.resolve_mode = mode
+        self._state_changed()
+
+    def dns_stats(self):
+        """本地 DNS 缓存的命中率和解析耗时（多进程模式下为各工作进程的统计列表）"""
+        if self.workers:
+            return self.workers.dns_stats()
+        return self.dns_cache.stats()
+
+    def metrics_snapshot(self):
+        """各端口指标的快照 {port: dict}（多进程模式下合并各工作进程的数据）"""
+        if self.workers:
+            return self.workers.metrics_snapshot()
+        return {port: server.metrics.snapshot(len(server.connections))
+                for port, server in list(self.port_to_server.items())}
+
+    def render_metrics(self):
+        """Prometheus 文本格式的全部指标"""
+        extra = []
+        if not self.workers:
+            if self.buffer_budget is not None:
+                budget = self.buffer_budget.stats()
+                extra.append(('uniproxy_buffered_bytes', 'gauge', '全部隧道写缓冲区中积压的字节数', budget['buffered']))
+                extra.append(('uniproxy_budget_paused_tunnels', 'gauge', '因超出缓冲区预算而暂停读取的隧道数',
+                              budget['paused_tunnels']))
+            dns = self.dns_cache.stats()
+            extra.append(('uniproxy_dns_cache_hits_total', 'counter', 'DNS 缓存命中次数（含失败结果和合并的请求）',
+                          dns['hits'] + dns['negative_hits'] + dns['coalesced']))
+            extra.append(('uniproxy_dns_cache_misses_total', 'counter', 'DNS 缓存未命中次数', dns['misses']))
+        return render_prometheus(self.metrics_snapshot(), extra)
+
+    def start_metrics_server(self, host='127.0.0.1', port=9464):
+        """在本地 HTTP 端口上以 Prometheus 文本格式提供 /metrics，返回实际监听的端口"""
+        if self.metrics_server is None:
+            # 监听失败（例如端口已被占用）时不保留未启动的服务
+            server = MetricsServer(self.render_metrics, host, port)
+            server.start()
+            self.metrics_server = server
+        return self.metrics_server.port
+
+    def stop_metrics_server(self):
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
+
     def parse_proxy_info(self, proxy_input):
         """解析用户输入的 SOCKS5 代理信息"""
         parts = proxy_input.strip().split(':')
@@ -202,127 +646,458 @@ class ProxyManager:
         
         return host, port, username, password
 
+    def start_ports(self, assignments, timeout=30.0):
+        """批量启动端口，各事件循环同时绑定各自分到的端口，返回 {port: 是否成功}
+
+        assignments 为 (port, host, port, username, password[, upstreams]) 列表；
+        已在运行的端口只切换上游，不重启监听
+        """
+        if self.workers:
+            results = self.workers.start_ports(assignments)
+            self._state_changed()
+            return results
+        # 同一端口出现多次时以最后一次为准
+        by_port = {assignment[0]: assignment for assignment in assignments}
+        # 事件循环 -> ([待启动的服务器], [(待切换的服务器, 上游列表)])
+        batches = {}
+        for port, assignment in by_port.items():
+            upstream_host, upstream_port, username, password = assignment[1:5]
+            upstreams = assignment[5] if len(assignment) > 5 else None
+            server = self.port_to_server.get(port)
+            if server is not None and server.running:
+                group = [(upstream_host, upstream_port, username, password)] + list(upstreams or [])
+                batches.setdefault(self.port_to_loop[port], ([], []))[1].append((server, group))
+            else:
+                server = self.Socks5Server(port, upstream_host, upstream_port, username, password,
+                                           upstreams=upstreams, **self._server_options(port))
+                batches.setdefault(self.engine.acquire_loop(), ([], []))[0].append(server)
+
+        futures = {
+            loop: asyncio.run_coroutine_threadsafe(self._start_batch(starts, retargets), loop)
+            for loop, (starts, retargets) in batches.items()
+        }
+        results = {}
+        for loop, future in futures.items():
+            starts, retargets = batches[loop]
+            try:
+                outcomes = future.result(timeout=timeout)
+            except Exception as e:
+                future.cancel()
+                outcomes = [e] * len(starts)
+            for server, outcome in zip(starts, outcomes):
+                port = server.local_port
+                if outcome is None:
+                    self.port_to_server[port] = server
+                    self.port_to_loop[port] = loop
+                    results[port] = True
+                else:
+                    self.engine.release_loop(loop)
+                    logger.warning(port, "启动失败: %s", outcome)
+                    results[port] = False
+            for server, _ in retargets:
+                results[server.local_port] = True
+        success = sum(1 for ok in results.values() if ok)
+        if success:
+            self._state_changed()
+        logger.info(None, "批量启动完成：成功 %d/%d 个端口", success, len(results))
+        return results
+
+    @staticmethod
+    async def _start_batch(servers, retargets):
+        """在单个事件循环中绑定一批端口，返回与 servers 对应的异常或 None
+
+        绑定本身是同步的系统调用，逐个执行比为每个端口创建任务再 gather 更快
+        """
+        for server, group in retargets:
+            server.retarget(group)
+        outcomes = []
+        for server in servers:
+            try:
+                await server.start()
+            except Exception as e:
+                outcomes.append(e)
+            else:
+                outcomes.append(None)
+        return outcomes
+
+    def parse_api_response(self, text, content_type=''):
+        """解析 API 返回的代理列表（JSON 或每行一个代理的文本）"""
+        text = text.strip()
+        if 'json' in content_type or text.startswith('{') or text.startswith('['):
+            data = json.loads(text)
+            # 检查返回数据是否有效
+            if data.get("success") is False or data.get("data") is None:
+                error_msg = data.get("msg", "API 返回数据无效")
+                raise ValueError(f"API 返回错误: {error_msg}")
+
+            # 如果是批量请求，data 可能是列表
+            if isinstance(data.get("data"), list):
+                proxies = []
+                for item in data["data"]:
+                    host = item.get('host') or item.get('ip') or item.get('server')
+                    port = item.get('port')
+                    username = item.get('username') or item.get('user')
+                    password = item.get('password') or item.get('pass')
+                    if host and port:
+                        proxies.append((host, int(port), username, password))
+                return proxies
+            else:
+                host = data.get('host') or data.get('ip') or data.get('server')
+                port = data.get('port')
+                username = data.get('username') or data.get('user')
+                password = data.get('password') or data.get('pass')
+
+                if not host or not port:
+                    raise ValueError("API 返回的 JSON 中未找到 host 或 port 字段")
+                return [(host, int(port), username, password)]
+        else:
+            lines = text.split('\n')
+            proxies = []
+            for line in lines:
+                if line.strip():
+                    try:
+                        host, port, username, password = self.parse_proxy_info(line.strip())
+                        proxies.append((host, port, username, password))
+                    except ValueError as e:
+                        logger.warning(None, "解析文本行失败: %s, 错误: %s", line, e)
+                        continue
+            if proxies:
+                return proxies
+            else:
+                raise ValueError("无法从文本中解析有效的代理信息")
+
+    def proxy_source(self, api_link):
+        """返回 API 链接对应的 ProxyListSource（复用 keep-alive 连接和缓存）"""
+        source = self.proxy_sources.get(api_link)
+        if source is None:
+            source = self.proxy_sources[api_link] = ProxyListSource(api_link, self.parse_api_response)
+        return source
+
     def fetch_proxy_from_api(self, api_link, retries=2, retry_delay=2):
         """从 API 链接获取代理信息，支持重试机制"""
+        source = self.proxy_source(api_link)
         for attempt in range(retries):
             try:
-                print(f"正在请求 API 获取代理信息: {api_link} (尝试 {attempt+1}/{retries})")
-                response = requests.get(api_link, timeout=30)
-                response.raise_for_status()
-                content_type = response.headers.get('Content-Type', '').lower()
-                text = response.text.strip()
-
-                print(f"API 响应内容: {text[:200]}... (截断)")
-
-                if 'json' in content_type or text.startswith('{') or text.startswith('['):
-                    data = response.json()
-                    # 检查返回数据是否有效
-                    if data.get("success") is False or data.get("data") is None:
-                        error_msg = data.get("msg", "API 返回数据无效")
-                        raise ValueError(f"API 返回错误: {error_msg}")
-                    
-                    # 如果是批量请求，data 可能是列表
-                    if isinstance(data.get("data"), list):
-                        proxies = []
-                        for item in data["data"]:
-                            host = item.get('host') or item.get('ip') or item.get('server')
-                            port = item.get('port')
-                            username = item.get('username') or item.get('user')
-                            password = item.get('password') or item.get('pass')
-                            if host and port:
-                                proxies.append((host, int(port), username, password))
-                        return proxies
-                    else:
-                        host = data.get('host') or data.get('ip') or data.get('server')
-                        port = data.get('port')
-                        username = data.get('username') or data.get('user')
-                        password = data.get('password') or data.get('pass')
-                        
-                        if not host or not port:
-                            raise ValueError("API 返回的 JSON 中未找到 host 或 port 字段")
-                        return [(host, int(port), username, password)]
-                else:
-                    lines = text.split('\n')
-                    proxies = []
-                    for line in lines:
-                        if line.strip():
-                            try:
-                                host, port, username, password = self.parse_proxy_info(line.strip())
-                                proxies.append((host, port, username, password))
-                            except ValueError as e:
-                                print(f"解析文本行失败: {line}, 错误: {e}")
-                                continue
-                    if proxies:
-                        return proxies
-                    else:
-                        raise ValueError("无法从文本中解析有效的代理信息")
-
+                logger.info(None, "正在请求 API 获取代理信息: %s (尝试 %d/%d)", api_link, attempt + 1, retries)
+                return source.fetch()
             except requests.exceptions.RequestException as e:
                 error_msg = f"从 API 获取代理信息失败，请求异常: {str(e)}"
-                print(error_msg)
+                logger.warning(None, "%s", error_msg)
                 if attempt < retries - 1:
                     time.sleep(retry_delay)
                     continue
                 raise ValueError(error_msg)
             except Exception as e:
                 error_msg = f"从 API 获取代理信息失败，解析错误: {str(e)}"
-                print(error_msg)
+                logger.warning(None, "%s", error_msg)
                 if attempt < retries - 1:
                     time.sleep(retry_delay)
                     continue
                 raise ValueError(error_msg)
 
-    def start_proxies(self, proxy_input, api_link, start_port, port_count):
-        """启动多个代理，支持单次 API 请求获取多个代理信息"""
-        success_count = 0
+    def start_proxies(self, proxy_input, api_link, start_port, port_count, group_size=1, refresh_interval=None):
+        """启动多个代理，支持单次 API 请求获取多个代理信息
+
+        group_size > 1 时每个端口以 proxies[i] 为首选上游，并依次带上后续的代理作为备用上游；
+        group_size 为 0 时每个端口都使用 API 返回的全部代理；
+        提供 refresh_interval（秒）时按该间隔定期从 API 刷新并替换各端口的上游
+        """
+        assignments = []
         failed_ports = []
 
         if api_link:
+            self.api_groups[start_port] = (port_count, group_size)
             try:
                 proxies = self.fetch_proxy_from_api(api_link)
+                if self.health_checker:
+                    proxies = self.check_proxies(proxies, start_port)
                 if len(proxies) >= port_count:
                     # 成功获取足够数量的代理
-                    print(f"一次性请求成功，获取了 {len(proxies)} 个代理")
-                    for i in range(port_count):
-                        port = start_port + i
-                        upstream_host, upstream_port, username, password = proxies[i]
-                        print(f"使用获取的代理信息用于端口 {port}: {upstream_host}:{upstream_port}")
-                        if self.start_proxy_for_port(port, upstream_host, upstream_port, username, password):
-                            success_count += 1
-                        else:
-                            failed_ports.append(port)
+                    logger.info(None, "一次性请求成功，获取了 %d 个代理", len(proxies))
                 else:
                     # 获取数量不足
-                    print(f"获取的代理数量不足 ({len(proxies)}/{port_count})")
-                    for i in range(min(len(proxies), port_count)):
-                        port = start_port + i
-                        upstream_host, upstream_port, username, password = proxies[i]
-                        print(f"使用获取的代理信息用于端口 {port}: {upstream_host}:{upstream_port}")
-                        if self.start_proxy_for_port(port, upstream_host, upstream_port, username, password):
-                            success_count += 1
-                        else:
-                            failed_ports.append(port)
-                    for i in range(len(proxies), port_count):
-                        failed_ports.append(start_port + i)
+                    logger.warning(None, "获取的代理数量不足 (%d/%d)", len(proxies), port_count)
+                for i in range(min(len(proxies), port_count)):
+                    port = start_port + i
+                    upstream_host, upstream_port, username, password = proxies[i]
+                    backups = self._backup_upstreams(proxies, i, group_size)
+                    assignments.append((port, upstream_host, upstream_port, username, password, backups))
+                for i in range(len(proxies), port_count):
+                    failed_ports.append(start_port + i)
             except ValueError as e:
-                print(f"从 API 获取代理信息失败: {e}")
+                logger.error(None, "从 API 获取代理信息失败: %s", e)
                 failed_ports.extend(range(start_port, start_port + port_count))
         else:
             try:
                 upstream_host, upstream_port, username, password = self.parse_proxy_info(proxy_input)
-                print(f"使用直接输入的代理信息: {upstream_host}:{upstream_port}")
+                logger.info(None, "使用直接输入的代理信息: %s:%s", upstream_host, upstream_port)
                 for i in range(port_count):
-                    port = start_port + i
-                    if self.start_proxy_for_port(port, upstream_host, upstream_port, username, password):
-                        success_count += 1
-                    else:
-                        failed_ports.append(port)
+                    assignments.append((start_port + i, upstream_host, upstream_port, username, password))
             except ValueError as e:
                 raise ValueError(e)
 
+        # 所有端口一次性并发绑定
+        results = self.start_ports(assignments)
+        success_count = sum(1 for ok in results.values() if ok)
+        failed_ports = sorted(failed_ports + [port for port, ok in results.items() if not ok])
+        # 首次请求失败或代理不足时同样定时刷新，之后获得的代理会启动尚未运行的端口
+        if api_link and refresh_interval:
+            self.start_auto_refresh(api_link, start_port, port_count, refresh_interval, group_size)
+
         return success_count, failed_ports
 
-    def stop_all_proxies(self):
-        """关闭所有运行的代理服务器"""
-        for port in list(self.port_to_server.keys()):
-            self.stop_proxy_on_port(port)
+    def build_assignments(self, proxies, start_port, port_count, group_size=1):
+        """按代理列表为端口段生成 start_ports 使用的 (port, host, port, username, password, upstreams) 列表
+
+        代理数量少于端口数时循环使用，备用上游的选取规则同 start_proxies
+        """
+        assignments = []
+        for i in range(port_count):
+            index = i % len(proxies)
+            backups = tuple(tuple(proxy) for proxy in self._backup_upstreams(proxies, index, group_size))
+            assignments.append((start_port + i,) + tuple(proxies[index]) + (backups,))
+        return assignments
+
+    def apply_proxies(self, proxies, start_port, port_count, group_size=1, health=None):
+        """把新的代理列表换入端口段：已运行的端口只切换上游（不重启监听），尚未运行的端口
+        （例如启动时 API 不可用）直接启动，返回更新或启动的端口数
+        """
+        updated = 0
+        assignments = []
+        for i in range(port_count):
+            port = start_port + i
+            # 代理数量少于端口数时循环使用
+            index = i % len(proxies)
+            upstreams = [proxies[index]] + self._backup_upstreams(proxies, index, group_size)
+            server = self.port_to_server.get(port)
+            loop = self.port_to_loop.get(port)
+            if self.workers or server is None or loop is None:
+                # 工作进程中的端口由 start_ports 切换上游或启动
+                assignments.append((port,) + tuple(upstreams[0]) + (upstreams[1:],))
+                continue
+            loop.call_soon_threadsafe(server.retarget, upstreams, health)
+            updated += 1
+        if assignments:
+            updated += sum(self.start_ports(assignments).values())
+            if health:
+                self.apply_health(health)
+        elif updated:
+            self._state_changed()
+        return updated
+
+    def start_auto_refresh(self, api_link, start_port, port_count, interval=300, group_size=1, immediate=False):
+        """定期从 API 刷新代理列表，并在不重启监听的情况下替换各端口的上游
+
+        每个端口段（以 start_port 区分）各有一个刷新任务，同一端口段重复调用时替换原任务；
+        immediate 为 True 时先在后台立即刷新一次（例如从快照恢复端口之后），interval 为 None 时只刷新这一次
+        """
+        self.stop_auto_refresh(start_port)
+        self.api_groups[start_port] = (port_count, group_size)
+        loop = self.engine.control_loop()
+        self.refresh_tasks[start_port] = asyncio.run_coroutine_threadsafe(
+            self._refresh_loop(api_link, start_port, port_count, interval, group_size, immediate), loop
+        )
+
+    def stop_auto_refresh(self, start_port=None):
+        """停止 start_port 端口段的定时刷新，start_port 为 None 时停止全部"""
+        starts = list(self.refresh_tasks) if start_port is None else [start_port]
+        for start in starts:
+            task = self.refresh_tasks.pop(start, None)
+            if task is not None:
+                task.cancel()
+
+    async def _refresh_loop(self, api_link, start_port, port_count, interval, group_size, immediate=False):
+        source = self.proxy_source(api_link)
+        if immediate:
+            await self._refresh_once(source, start_port, port_count, group_size)
+        while interval:
+            await asyncio.sleep(interval)
+            await self._refresh_once(source, start_port, port_count, group_size)
+
+    async def _refresh_once(self, source, start_port, port_count, group_size):
+        health = None
+        try:
+            proxies = await source.fetch_async()
+            if self.health_checker:
+                health = await self.health_checker.probe_all(proxies)
+                self.health_checker.watch(proxies, self._on_health_update, start_port)
+                proxies = self.health_checker.rank(proxies)
+        except Exception as e:
+            logger.warning(None, "定时刷新代理列表失败: %s", e)
+            return
+        if not proxies:
+            logger.warning(None, "定时刷新未获得可用代理，保留当前上游")
+            return
+        # 多进程模式下需要与工作进程通信，放到线程池中执行
+        updated = await asyncio.get_running_loop().run_in_executor(
+            None, self.apply_proxies, proxies, start_port, port_count, group_size, health
+        )
+        logger.info(None, "定时刷新完成：%d 个代理，已更新 %d 个端口的上游", len(proxies), updated)
+
+    def check_proxies(self, proxies, start_port=None):
+        """探测代理列表，返回健康的代理（按延迟排序），并在后台持续复查
+
+        后台复查按 start_port 区分端口段，不同端口段的代理列表互不替换
+        """
+        loop = self.engine.control_loop()
+        checker = self.health_checker
+        timeout = checker.timeout * (len(proxies) / checker.concurrency + 1) + 5
+        self.engine.run_coroutine(checker.probe_all(proxies), loop, timeout=timeout)
+        loop.call_soon_threadsafe(checker.watch, proxies, self._on_health_update, start_port)
+        return checker.rank(proxies)
+
+    def stop_health_watch(self, start_port):
+        """停止后台复查 start_port 端口段的代理"""
+        self.api_groups.pop(start_port, None)
+        if self.health_checker and self.engine.running:
+            self.engine.control_loop().call_soon_threadsafe(self.health_checker.unwatch, start_port)
+
+    def _on_health_update(self, results):
+        """后台复查每轮结束后在控制循环中调用；切换上游需要等待各事件循环或工作进程，放到线程池中执行"""
+        asyncio.get_running_loop().run_in_executor(None, self._handle_health_update, results)
+
+    def _handle_health_update(self, results):
+        try:
+            self._replace_dead_upstreams(results)
+            self.apply_health(results)
+        except Exception as e:
+            logger.warning(None, "应用后台探测结果出错: %r", e)
+
+    def _port_upstreams(self, port):
+        """端口当前的上游列表 [(host, port, username, password), ...]，端口未运行时为空列表"""
+        if self.workers:
+            assignment = self.workers.assignments.get(port)
+            if assignment is None:
+                return []
+            return [tuple(assignment[:4])] + [tuple(upstream) for upstream in assignment[4] or ()]
+        server = self.port_to_server.get(port)
+        return [member.key for member in server.upstreams.members] if server is not None else []
+
+    def _replace_dead_upstreams(self, results):
+        """把上游全部探测为不健康的端口换到所在端口段中健康的代理上（优先选用没有端口在用的代理），
+        返回换过上游的端口数
+        """
+        assignments = []
+        for start_port, (port_count, group_size) in list(self.api_groups.items()):
+            healthy = self.health_checker.rank(list(self.health_checker.watched.get(start_port, ())))
+            if not healthy:
+                continue
+            ports = range(start_port, start_port + port_count)
+            current = {port: self._port_upstreams(port) for port in ports}
+            in_use = {upstreams[0] for upstreams in current.values() if upstreams}
+            spares = [proxy for proxy in healthy if proxy not in in_use] or healthy
+            replaced = 0
+            for port, upstreams in current.items():
+                if not upstreams or not all(results.get(upstream, {}).get('healthy') is False
+                                            for upstream in upstreams):
+                    continue
+                index = replaced % len(spares)
+                backups = tuple(self._backup_upstreams(spares, index, group_size))
+                assignments.append((port,) + tuple(spares[index]) + (backups,))
+                replaced += 1
+        if not assignments:
+            return 0
+        logger.warning(None, "%d 个端口的上游已全部不健康，换用健康的代理", len(assignments))
+        return sum(self.start_ports(assignments).values())
+
+    def apply_health(self, results):
+        """把健康探测结果同步到运行中端口的上游组（多进程模式下发给各工作进程）"""
+        if self.workers:
+            self.workers.apply_health(results)
+        for server in list(self.port_to_server.values()):
+            server.upstreams.apply_health(results)
+        self._state_changed()
+
+    def enable_state_store(self, path, min_interval=1.0):
+        """把端口映射、解析方式和上游健康状态保存到 path，之后每次变化时（合并 min_interval 秒内的变化）原子地重写"""
+        if self.state_store is None:
+            self.state_store = StateStore(path, self.collect_state, min_interval)
+        return self.state_store
+
+    def _state_changed(self):
+        if self.state_store is not None:
+            self.state_store.mark_dirty()
+
+    def collect_state(self):
+        """当前状态的可序列化字典，在 StateStore 的后台线程中调用
+
+        ports 中每项为 [本地端口, host, port, username, password, [备用上游, ...]]，
+        health 中每项为 [host, port, username, password, healthy, latency, checked_at]
+        """
+        ports = []
+        if self.workers:
+            for port, assignment in sorted(self.workers.assignments.items()):
+                backups = [list(upstream) for upstream in assignment[4] or ()]
+                ports.append([port] + list(assignment[:4]) + [backups])
+            resolve_modes = dict(self.workers.resolve_modes)
+        else:
+            for port, server in sorted(self.port_to_server.items()):
+                members = [list(member.key) for member in server.upstreams.members]
+                ports.append([port] + members[0] + [members[1:]])
+            resolve_modes = dict(self.resolve_modes)
+        health = []
+        if self.health_checker:
+            for proxy, result in list(self.health_checker.results.items()):
+                health.append(list(proxy) + [result['healthy'], result['latency'], result.get('checked_at')])
+        return {
+            'ports': ports,
+            'resolve_modes': {str(port): mode for port, mode in sorted(resolve_modes.items())},
+            'health': health,
+        }
+
+    def restore_state(self):
+        """从状态快照恢复：先设置解析方式和健康状态，再用一次 start_ports 启动全部端口
+
+        返回 start_ports 的结果 {port: 是否成功}，没有可用快照时返回空字典；
+        恢复后的上游可能已过期，调用方应在后台再从 API 刷新
+        """
+        state = self.state_store.load() if self.state_store is not None else None
+        if not state:
+            return {}
+        try:
+            assignments = [(int(entry[0]), entry[1], int(entry[2]), entry[3], entry[4],
+                            tuple(tuple(upstream) for upstream in entry[5]))
+                           for entry in state.get('ports', ())]
+            modes = {}
+            for port, mode in state.get('resolve_modes', {}).items():
+                if mode in RESOLVE_MODES:
+                    modes.setdefault(mode, []).append(int(port))
+            health = {tuple(entry[:4]): {'healthy': entry[4], 'latency': entry[5], 'error': None,
+                                         'checked_at': entry[6]}
+                      for entry in state.get('health', ())}
+        except (IndexError, KeyError, TypeError, ValueError, AttributeError) as e:
+            logger.warning(None, "状态快照内容无效，忽略: %s", e)
+            return {}
+        for mode, ports in modes.items():
+            self.set_resolve_mode(ports, mode)
+        if self.health_checker and health:
+            self.health_checker.results.update(health)
+        results = self.start_ports(assignments) if assignments else {}
+        if health:
+            self.apply_health(health)
+        success = sum(1 for ok in results.values() if ok)
+        logger.info(None, "已从状态快照恢复 %d/%d 个端口", success, len(assignments))
+        return results
+
+    @staticmethod
+    def _backup_upstreams(proxies, index, group_size):
+        """端口 index 的备用上游：从 proxies[index] 之后循环取 group_size - 1 个"""
+        count = len(proxies) if group_size == 0 else min(group_size, len(proxies))
+        return [proxies[(index + offset) % len(proxies)] for offset in range(1, count)]
+
+    def stop_all_proxies(self, drain_timeout=None):
+        """关闭所有运行的代理服务器；提供 drain_timeout 时先等待已有连接结束（最多 drain_timeout 秒）"""
+        # 先写入最后的状态并停用快照，关闭端口的过程不会把空映射保存下来
+        if self.state_store is not None:
+            self.state_store.close()
+            self.state_store = None
+        self.stop_auto_refresh()
+        if self.workers:
+            if drain_timeout:
+                self.workers.stop_ports(list(self.workers.assignments), drain_timeout)
+            self.workers.stop()
+        if self.health_checker and self.engine.running:
+            self.engine.control_loop().call_soon_threadsafe(self.health_checker.stop)
+        self.stop_ports(list(self.port_to_server.keys()), drain_timeout=drain_timeout)
+        self.engine.stop()
+        self.stop_metrics_server()
@@ -0,0 +1,66 @@
+import asyncio
+import time
+
+import requests
+
+from logger import logger
+
+
+class ProxyListSource:
+    """代理 API 来源：复用 keep-alive 连接，支持 ETag/If-Modified-Since 条件请求，
+    并缓存最近一次成功获取的代理列表
+    """
+
+    def __init__(self, api_link, parse, timeout=10, cache_ttl=600):
+        self.api_link = api_link
+        # parse(text, content_type) -> [(host, port, username, password), ...]
+        self.parse = parse
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        # Session 内部的连接池会保持与 API 服务器的长连接
+        self.session = requests.Session()
+        self.etag = None
+        self.last_modified = None
+        self.cached = None
+        self.cached_at = 0.0
+
+    def cache_valid(self):
+        return self.cached is not None and time.monotonic() - self.cached_at < self.cache_ttl
+
+    def fetch(self):
+        """获取代理列表；内容未变化时直接返回缓存，请求失败时在 TTL 内退回缓存"""
+        headers = {}
+        if self.cached is not None:
+            if self.etag:
+                headers['If-None-Match'] = self.etag
+            if self.last_modified:
+                headers['If-Modified-Since'] = self.last_modified
+        try:
+            response = self.session.get(self.api_link, headers=headers, timeout=self.timeout)
+            if response.status_code == 304 and self.cached is not None:
+                self.cached_at = time.monotonic()
+                return list(self.cached)
+            response.raise_for_status()
+            text = response.text.strip()
+            logger.debug(None, "API 响应内容: %s... (截断)", text[:200])
+            proxies = self.parse(text, response.headers.get('Content-Type', '').lower())
+            if not proxies:
+                raise ValueError("API 返回的代理列表为空")
+        except Exception as e:
+            if self.cache_valid():
+                logger.warning(None, "获取代理列表失败，继续使用缓存的 %d 个代理: %s", len(self.cached), e)
+                return list(self.cached)
+            raise
+        self.etag = response.headers.get('ETag')
+        self.last_modified = response.headers.get('Last-Modified')
+        self.cached = list(proxies)
+        self.cached_at = time.monotonic()
+        return proxies
+
+    async def fetch_async(self):
+        """在线程池中执行 fetch，不阻塞事件循环"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.fetch)
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,478 @@
+import asyncio
+import threading
+import time
+
+from logger import logger
+from shaping import throttle_delay
+
+# auto：优先使用缓冲区复用的协议转发，不可用时退回 streams 方式
+RELAY_MODES = ('auto', 'buffered', 'streams')
+# 读取大小在 MIN_BUFFER_SIZE 与 buffer_size（上限）之间自适应：
+# 连续读满时翻倍，连续多次只读到很少数据时减半
+MIN_BUFFER_SIZE = 4 * 1024
+DEFAULT_BUFFER_SIZE = 256 * 1024
+SHRINK_AFTER = 4
+# 默认的进程级转发缓冲区预算
+DEFAULT_BUFFER_BUDGET = 256 * 1024 * 1024
+
+
+def next_read_size(size, nbytes, small_reads, max_size):
+    """根据本次读取量计算下一次的读取大小，返回 (size, small_reads)"""
+    if nbytes >= size:
+        return min(size * 2, max_size), 0
+    if nbytes <= size // 8 and size > MIN_BUFFER_SIZE:
+        small_reads += 1
+        if small_reads >= SHRINK_AFTER:
+            return max(size // 2, MIN_BUFFER_SIZE), 0
+        return size, small_reads
+    return size, 0
+
+
+class BufferBudget:
+    """进程级的转发缓冲区预算：所有隧道写缓冲区中积压的数据总量超过 limit 时，
+    暂停积压最多的隧道的读取，使总量保持在 limit 附近
+
+    积压量在每次写入时增量估计；只有超出预算时才重新统计全部隧道，
+    且两次统计至少间隔 check_interval 秒，正常情况下没有定时器。
+    每条隧道在被暂停前还可能多写入一次读取的数据，因此实际上限约为 limit + 隧道数 * 单次读取上限
+    """
+
+    def __init__(self, limit=DEFAULT_BUFFER_BUDGET, resume_ratio=0.75, check_interval=0.05):
+        self.limit = limit
+        self.resume_level = int(limit * resume_ratio)
+        self.check_interval = check_interval
+        self.tunnels = set()
+        self.paused = set()
+        # 积压总量的估计值，多个事件循环线程并发更新时可能略有偏差，每次重新统计时校正
+        self.total = 0
+        self.pause_count = 0
+        self._next_check = 0.0
+        self._check_scheduled = False
+        self._lock = threading.Lock()
+
+    def stats(self):
+        return {
+            'limit': self.limit,
+            'buffered': self.total,
+            'tunnels': len(self.tunnels),
+            'paused_tunnels': len(self.paused),
+            'pause_count': self.pause_count,
+        }
+
+    def register(self, tunnel):
+        # rebalance 可能正在其他事件循环线程中遍历 tunnels
+        with self._lock:
+            self.tunnels.add(tunnel)
+
+    def unregister(self, tunnel):
+        with self._lock:
+            self.tunnels.discard(tunnel)
+            self.paused.discard(tunnel)
+            self.total -= tunnel.buffered()
+
+    def update(self, tunnel, delta):
+        self.total += delta
+        if self.total > self.limit:
+            self.rebalance(tunnel)
+
+    def rebalance(self, growing=None):
+        """超出预算时暂停积压超过平均份额（limit / 隧道数）的隧道
+
+        被暂停的隧道在自身积压排空后恢复，总量回落到 resume_level 以下时全部恢复；
+        这样长期不读取的客户端占住的积压不会拖住其他正常读取的隧道。
+        距上次统计不足 check_interval 时不重新统计，只检查正在增长的隧道 growing
+        """
+        now = time.monotonic()
+        with self._lock:
+            share = self.limit / max(len(self.tunnels), 1)
+            if now < self._next_check:
+                if (growing is not None and growing in self.tunnels and growing not in self.paused
+                        and growing.buffered() > share):
+                    self._pause(growing)
+            else:
+                self._next_check = now + self.check_interval
+                sizes = [(tunnel.measure(), tunnel) for tunnel in self.tunnels]
+                total = sum(size for size, _ in sizes)
+                self.total = total
+                if total <= self.resume_level:
+                    resumed = list(self.paused)
+                else:
+                    resumed = [tunnel for tunnel in self.paused if tunnel.buffered() <= share / 2]
+                for tunnel in resumed:
+                    self.paused.discard(tunnel)
+                    tunnel.set_budget_paused(False)
+                if total > self.limit:
+                    excess = total - self.resume_level
+                    sizes.sort(key=lambda item: item[0], reverse=True)
+                    for size, tunnel in sizes:
+                        if excess <= 0 or size <= share:
+                            break
+                        if tunnel not in self.paused:
+                            self._pause(tunnel)
+                        excess -= size
+            schedule = bool(self.paused) and not self._check_scheduled
+            if schedule:
+                self._check_scheduled = True
+        if schedule:
+            # 有隧道被暂停时定期复查，积压排空后恢复它们
+            asyncio.get_running_loop().call_later(self.check_interval, self._scheduled_check)
+
+    def _pause(self, tunnel):
+        self.paused.add(tunnel)
+        self.pause_count += 1
+        tunnel.set_budget_paused(True)
+
+    def _scheduled_check(self):
+        self._check_scheduled = False
+        self.rebalance()
+
+
+class IdleTimer:
+    """空闲超时：有数据时只调用 touch() 更新时间戳，定时器到期时才决定触发还是顺延"""
+
+    def __init__(self, loop, timeout, on_idle):
+        self.loop = loop
+        self.timeout = timeout
+        self.on_idle = on_idle
+        self.last_activity = time.monotonic()
+        self._handle = loop.call_later(timeout, self._check)
+
+    def touch(self):
+        self.last_activity = time.monotonic()
+
+    def _check(self):
+        remaining = self.last_activity + self.timeout - time.monotonic()
+        if remaining <= 0:
+            self._handle = None
+            self.on_idle()
+        else:
+            self._handle = self.loop.call_later(remaining, self._check)
+
+    def cancel(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+
+class _RelayProtocol(asyncio.BufferedProtocol):
+    """把本传输收到的数据直接写入对端传输，接收缓冲区按流量自适应大小并重复使用"""
+
+    def __init__(self, tunnel, max_size, upload, buckets=()):
+        self.tunnel = tunnel
+        # 读取方向：True 为客户端 -> 上游
+        self.upload = upload
+        # 本方向的限速令牌桶；超出限速时暂停读取，到期由一次性的 call_later 恢复
+        self.buckets = buckets
+        self.throttled = False
+        self.throttle_handle = None
+        self.transport = None
+        self.peer = None
+        self.max_size = max_size
+        self.view = memoryview(bytearray(MIN_BUFFER_SIZE))
+        self.small_reads = 0
+        # 本传输写缓冲区中最近一次记录的积压字节数
+        self.buffered = 0
+        # 对端写缓冲区已满（对端的 pause_writing）
+        self.peer_full = False
+        self.eof = False
+        self.closed = False
+
+    def get_buffer(self, sizehint):
+        return self.view
+
+    def buffer_updated(self, nbytes):
+        if self.tunnel.idle_timer is not None:
+            self.tunnel.idle_timer.touch()
+        metrics = self.tunnel.metrics
+        if metrics is not None:
+            if self.upload:
+                metrics.bytes_up += nbytes
+            else:
+                metrics.bytes_down += nbytes
+        peer = self.peer
+        peer.transport.write(self.view[:nbytes])
+        pending = peer.transport.get_write_buffer_size()
+        peer.note_buffered(pending)
+        if self.buckets:
+            self.charge(nbytes)
+        size = len(self.view)
+        new_size, self.small_reads = next_read_size(size, nbytes, self.small_reads, self.max_size)
+        if new_size != size or pending:
+            # 大小变化，或未能一次写入内核时传输可能仍引用这块内存，换一块新的缓冲区
+            self.view = memoryview(bytearray(new_size))
+
+    def charge(self, nbytes):
+        """从令牌桶中扣除已转发的 nbytes，令牌不足时暂停读取到令牌恢复为止"""
+        delay = throttle_delay(self.buckets, nbytes)
+        if delay <= 0 or self.throttled:
+            return
+        self.throttled = True
+        if self.tunnel.metrics is not None:
+            self.tunnel.metrics.throttled += 1
+        self.update_reading()
+        self.throttle_handle = self.tunnel.loop.call_later(delay, self.end_throttle)
+
+    def end_throttle(self):
+        self.throttle_handle = None
+        self.throttled = False
+        self.update_reading()
+
+    def note_buffered(self, size):
+        delta = size - self.buffered
+        if delta:
+            self.buffered = size
+            if self.tunnel.budget is not None:
+                self.tunnel.budget.update(self.tunnel, delta)
+
+    def update_reading(self):
+        """对端写缓冲区已满、超出全局预算或超出限速时暂停读取，否则恢复"""
+        if self.closed or self.transport.is_closing():
+            return
+        if self.peer_full or self.tunnel.budget_paused or self.throttled:
+            self.transport.pause_reading()
+        else:
+            self.transport.resume_reading()
+
+    def eof_received(self):
+        self.eof = True
+        if self.peer.eof or not self.peer.transport.can_write_eof():
+            self.tunnel.close()
+            return False
+        # 半关闭：把 EOF 传给对端，另一方向继续转发
+        self.peer.transport.write_eof()
+        return True
+
+    def pause_writing(self):
+        # 本端写缓冲区已满，暂停读取对端
+        self.peer.peer_full = True
+        self.peer.update_reading()
+
+    def resume_writing(self):
+        self.note_buffered(self.transport.get_write_buffer_size())
+        self.peer.peer_full = False
+        self.peer.update_reading()
+
+    def connection_lost(self, exc):
+        if self.closed:
+            return
+        self.closed = True
+        if self.throttle_handle is not None:
+            self.throttle_handle.cancel()
+            self.throttle_handle = None
+        self.tunnel.protocol_lost(self)
+
+
+class _Tunnel:
+    """客户端与上游之间的一对转发协议"""
+
+    def __init__(self, loop, buffer_size, budget=None, metrics=None, upload_buckets=(), download_buckets=()):
+        self.loop = loop
+        self.done = loop.create_future()
+        self.budget = budget
+        self.budget_paused = False
+        self.idle_timer = None
+        self.metrics = metrics
+        # 客户端协议读取的是上传方向的数据，上游协议读取的是下载方向的数据
+        self.client = _RelayProtocol(self, buffer_size, True, upload_buckets)
+        self.upstream = _RelayProtocol(self, buffer_size, False, download_buckets)
+        self.client.peer = self.upstream
+        self.upstream.peer = self.client
+
+    def buffered(self):
+        return self.client.buffered + self.upstream.buffered
+
+    def measure(self):
+        """读取两端写缓冲区的实际积压量并更新记录"""
+        for protocol in (self.client, self.upstream):
+            if not protocol.closed:
+                protocol.buffered = protocol.transport.get_write_buffer_size()
+        return self.buffered()
+
+    def set_budget_paused(self, paused):
+        """由 BufferBudget 调用，可能来自其他事件循环线程"""
+        self.loop.call_soon_threadsafe(self._apply_budget_paused, paused)
+
+    def _apply_budget_paused(self, paused):
+        self.budget_paused = paused
+        self.client.update_reading()
+        self.upstream.update_reading()
+
+    def close(self):
+        self.client.transport.close()
+        self.upstream.transport.close()
+
+    def abort(self):
+        # 空闲超时或取消时直接丢弃未发送的数据，立即释放套接字
+        self.client.transport.abort()
+        self.upstream.transport.abort()
+
+    def protocol_lost(self, protocol):
+        # 一端断开后关闭另一端（close 会先发送完已缓冲的数据）
+        protocol.peer.transport.close()
+        if self.client.closed and self.upstream.closed and not self.done.done():
+            self.done.set_result(None)
+
+
+def buffered_relay_available(*streams):
+    """判断给定的 (reader, writer) 是否可以切换到缓冲区复用的协议转发"""
+    for reader, writer in streams:
+        transport = writer.transport
+        if not hasattr(transport, 'set_protocol') or not hasattr(transport, 'is_reading'):
+            return False
+        if transport.get_extra_info('sslcontext') is not None:
+            return False
+        if not isinstance(getattr(reader, '_buffer', None), bytearray):
+            return False
+    return True
+
+
+async def relay_buffered(client_reader, client_writer, upstream_reader, upstream_writer,
+                         buffer_size=DEFAULT_BUFFER_SIZE, budget=None, idle_timeout=None, metrics=None,
+                         upload_buckets=(), download_buckets=()):
+    """把两端的传输切换为 _RelayProtocol 进行转发，直到两端都关闭或空闲超时"""
+    loop = asyncio.get_running_loop()
+    tunnel = _Tunnel(loop, buffer_size, budget, metrics, upload_buckets, download_buckets)
+    if idle_timeout:
+        tunnel.idle_timer = IdleTimer(loop, idle_timeout, tunnel.abort)
+    switched = []
+    for reader, writer, protocol in ((client_reader, client_writer, tunnel.client),
+                                     (upstream_reader, upstream_writer, tunnel.upstream)):
+        transport = writer.transport
+        # StreamReader 中已缓存但尚未读取的数据（例如客户端提前发送的请求）
+        pending = bytes(reader._buffer)
+        reader._buffer.clear()
+        protocol.transport = transport
+        switched.append((transport.get_protocol(), protocol, pending, reader.at_eof()))
+        transport.set_protocol(protocol)
+    if budget is not None:
+        budget.register(tunnel)
+
+    for old_protocol, protocol, pending, eof in switched:
+        if pending:
+            protocol.peer.transport.write(pending)
+            if metrics is not None:
+                if protocol.upload:
+                    metrics.bytes_up += len(pending)
+                else:
+                    metrics.bytes_down += len(pending)
+            if protocol.buckets:
+                protocol.charge(len(pending))
+        if eof and not protocol.eof:
+            protocol.eof_received()
+        if protocol.transport.is_closing():
+            protocol.connection_lost(None)
+        else:
+            protocol.update_reading()
+
+    try:
+        await tunnel.done
+    except asyncio.CancelledError:
+        tunnel.abort()
+        raise
+    finally:
+        if tunnel.idle_timer is not None:
+            tunnel.idle_timer.cancel()
+        if budget is not None:
+            budget.unregister(tunnel)
+        # 通知原来的 StreamReaderProtocol 连接已结束，使 writer.wait_closed() 能正常返回
+        for old_protocol, _, _, _ in switched:
+            old_protocol.connection_lost(None)
+
+
+async def relay_streams(client_reader, client_writer, upstream_reader, upstream_writer,
+                        buffer_size=DEFAULT_BUFFER_SIZE, label=None, idle_timeout=None, metrics=None,
+                        upload_buckets=(), download_buckets=()):
+    """基于 StreamReader/StreamWriter 的转发方式（兼容所有传输）
+
+    一个方向读到 EOF 时向对端发送 EOF（半关闭），另一方向继续转发直到同样结束；
+    任一方向出错或空闲超时则立即中止两端
+    """
+
+    def abort():
+        client_writer.transport.abort()
+        upstream_writer.transport.abort()
+
+    idle_timer = IdleTimer(asyncio.get_running_loop(), idle_timeout, abort) if idle_timeout else None
+
+    async def forward(reader, writer, direction, upload, buckets):
+        size = MIN_BUFFER_SIZE
+        small_reads = 0
+        try:
+            while True:
+                data = await reader.read(size)
+                if not data:
+                    break
+                if idle_timer is not None:
+                    idle_timer.touch()
+                if metrics is not None:
+                    if upload:
+                        metrics.bytes_up += len(data)
+                    else:
+                        metrics.bytes_down += len(data)
+                writer.write(data)
+                # 写缓冲区为空时 drain 不会等待，省去一次协程切换
+                if writer.transport.get_write_buffer_size():
+                    await writer.drain()
+                if buckets:
+                    delay = throttle_delay(buckets, len(data))
+                    if delay > 0:
+                        if metrics is not None:
+                            metrics.throttled += 1
+                        await asyncio.sleep(delay)
+                size, small_reads = next_read_size(size, len(data), small_reads, buffer_size)
+            if writer.can_write_eof() and not writer.is_closing():
+                writer.write_eof()
+            else:
+                writer.close()
+        except Exception as e:
+            logger.debug(label, "%s 转发异常: %s", direction, e)
+            abort()
+
+    try:
+        await asyncio.gather(
+            forward(client_reader, upstream_writer, "客户端->上游", True, upload_buckets),
+            forward(upstream_reader, client_writer, "上游->客户端", False, download_buckets)
+        )
+    finally:
+        if idle_timer is not None:
+            idle_timer.cancel()
+
+
+def set_write_buffer_limits(writers, high=None, low=None):
+    """设置传输写缓冲区的高低水位，high 为 None 时保持 asyncio 的默认值"""
+    if high is None:
+        return
+    for writer in writers:
+        writer.transport.set_write_buffer_limits(high=high, low=low)
+
+
+async def relay(client_reader, client_writer, upstream_reader, upstream_writer,
+                mode='auto', buffer_size=DEFAULT_BUFFER_SIZE, label=None,
+                write_buffer_high=None, write_buffer_low=None, budget=None, idle_timeout=None, metrics=None,
+                shaping=None):
+    """在客户端与上游之间双向转发数据，按 mode 选择转发方式
+
+    buffer_size 为单次读取大小的上限；budget 为可选的 BufferBudget（仅 buffered 方式使用）；
+    idle_timeout 秒内两个方向都没有数据时中止隧道；metrics 为可选的 PortMetrics，记录隧道数和转发字节数；
+    shaping 为可选的 BandwidthLimits，按令牌桶限制两个方向的转发速率
+    """
+    if mode not in RELAY_MODES:
+        raise ValueError(f"未知的转发模式: {mode}")
+    set_write_buffer_limits((client_writer, upstream_writer), write_buffer_high, write_buffer_low)
+    upload_buckets, download_buckets = shaping.connection() if shaping is not None else ((), ())
+    if metrics is not None:
+        metrics.tunnels += 1
+    try:
+        if mode != 'streams' and buffered_relay_available(
+                (client_reader, client_writer), (upstream_reader, upstream_writer)):
+            await relay_buffered(client_reader, client_writer, upstream_reader, upstream_writer,
+                                 buffer_size, budget, idle_timeout, metrics, upload_buckets, download_buckets)
+            return
+        if mode == 'buffered':
+            logger.warning(label, "当前传输不支持缓冲区转发，退回 streams 方式")
+        await relay_streams(client_reader, client_writer, upstream_reader, upstream_writer,
+                            buffer_size=buffer_size, label=label, idle_timeout=idle_timeout, metrics=metrics,
+                            upload_buckets=upload_buckets, download_buckets=download_buckets)
+    finally:
+        if metrics is not None:
+            metrics.tunnels -= 1
@@ -0,0 +1,74 @@
+import threading
+import time
+
+# 令牌桶默认可积累的令牌量：rate * BURST_SECONDS，且不少于 MIN_BURST 字节
+BURST_SECONDS = 0.25
+MIN_BURST = 64 * 1024
+
+
+class TokenBucket:
+    """令牌桶限速，rate 为每秒字节数
+
+    不用定时器补充令牌：每次消费时按距上次消费经过的时间补充，空闲的隧道没有任何开销。
+    允许透支（先转发已读到的数据，再按欠下的令牌暂停读取），因此长期速率不超过 rate，
+    单次突发不超过 burst 加一次读取的大小。
+    可被多个事件循环线程共享（用作进程级的全局限制）
+    """
+
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError(f"限速必须大于 0: {rate}")
+        self.rate = float(rate)
+        self.burst = burst or max(self.rate * BURST_SECONDS, MIN_BURST)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, nbytes, now):
+        """取走 nbytes 个令牌，返回令牌恢复为非负还需等待的秒数（0 表示无需等待）"""
+        with self._lock:
+            tokens = min(self.tokens + (now - self.updated) * self.rate, self.burst) - nbytes
+            self.tokens = tokens
+            self.updated = now
+        return -tokens / self.rate if tokens < 0 else 0.0
+
+
+def throttle_delay(buckets, nbytes):
+    """从每个令牌桶中取走 nbytes，返回需要暂停读取的秒数（取各桶中最长的等待）"""
+    now = time.monotonic()
+    delay = 0.0
+    for bucket in buckets:
+        wait = bucket.consume(nbytes, now)
+        if wait > delay:
+            delay = wait
+    return delay
+
+
+class BandwidthLimits:
+    """一个端口的带宽限制：上传（客户端 -> 上游）和下载方向各自的端口级、连接级上限，
+    以及 ProxyManager 传入的进程级令牌桶 global_buckets = (上传, 下载)
+
+    端口级令牌桶由该端口的全部连接共享；连接级令牌桶在每个新连接开始转发时创建
+    """
+
+    def __init__(self, upload_rate=None, download_rate=None, connection_upload_rate=None,
+                 connection_download_rate=None, global_buckets=(None, None)):
+        self.connection_upload_rate = connection_upload_rate
+        self.connection_download_rate = connection_download_rate
+        self.port_upload = TokenBucket(upload_rate) if upload_rate else None
+        self.port_download = TokenBucket(download_rate) if download_rate else None
+        self.global_upload, self.global_download = global_buckets
+
+    @property
+    def enabled(self):
+        return any((self.connection_upload_rate, self.connection_download_rate, self.port_upload,
+                    self.port_download, self.global_upload, self.global_download))
+
+    def connection(self):
+        """为一个新连接返回 (上传方向的令牌桶, 下载方向的令牌桶)，不限速的方向为空元组"""
+        upload = (TokenBucket(self.connection_upload_rate) if self.connection_upload_rate else None,
+                  self.port_upload, self.global_upload)
+        download = (TokenBucket(self.connection_download_rate) if self.connection_download_rate else None,
+                    self.port_download, self.global_download)
+        return (tuple(bucket for bucket in upload if bucket is not None),
+                tuple(bucket for bucket in download if bucket is not None))
@@ -0,0 +1,160 @@
+import asyncio
+import ipaddress
+import socket
+
+# SOCKS5 应答码
+REP_SUCCEEDED = 0x00
+REP_GENERAL_FAILURE = 0x01
+REP_NOT_ALLOWED = 0x02
+REP_NETWORK_UNREACHABLE = 0x03
+REP_HOST_UNREACHABLE = 0x04
+REP_CONNECTION_REFUSED = 0x05
+REP_TTL_EXPIRED = 0x06
+REP_COMMAND_NOT_SUPPORTED = 0x07
+REP_ADDRESS_TYPE_NOT_SUPPORTED = 0x08
+
+REPLY_MESSAGES = {
+    REP_SUCCEEDED: "成功",
+    REP_GENERAL_FAILURE: "上游服务器一般性故障",
+    REP_NOT_ALLOWED: "上游规则不允许连接",
+    REP_NETWORK_UNREACHABLE: "网络不可达",
+    REP_HOST_UNREACHABLE: "主机不可达",
+    REP_CONNECTION_REFUSED: "连接被拒绝",
+    REP_TTL_EXPIRED: "TTL 过期",
+    REP_COMMAND_NOT_SUPPORTED: "不支持的命令",
+    REP_ADDRESS_TYPE_NOT_SUPPORTED: "不支持的地址类型",
+}
+
+CMD_CONNECT = 0x01
+CMD_UDP_ASSOCIATE = 0x03
+
+# 预先生成返回给本地客户端的应答（绑定地址固定为 0.0.0.0:0）
+_REPLIES = {code: bytes([5, code, 0, 1, 0, 0, 0, 0, 0, 0]) for code in range(256)}
+
+
+def socks5_reply(code):
+    """返回给本地客户端的 SOCKS5 应答报文"""
+    return _REPLIES[code]
+
+
+def socks5_bound_reply(host, port):
+    """携带实际绑定地址的成功应答（UDP ASSOCIATE 需要告诉客户端中继地址）"""
+    return b'\x05\x00\x00' + encode_address(host, port)
+
+
+class Socks5Error(Exception):
+    """上游 SOCKS5 连接失败，reply_code 为应返回给客户端的应答码
+
+    target_error 为 True 表示上游本身工作正常，只是拒绝或无法连接目标
+    """
+
+    def __init__(self, message, reply_code=REP_GENERAL_FAILURE, target_error=False):
+        super().__init__(message)
+        self.reply_code = reply_code
+        self.target_error = target_error
+
+
+def encode_address(host, port):
+    """按 SOCKS5 规范编码目标地址（ATYP + 地址 + 端口）"""
+    try:
+        ip = ipaddress.ip_address(host)
+    except ValueError:
+        name = host.encode('idna')
+        if len(name) > 255:
+            raise Socks5Error(f"域名过长: {host}", REP_GENERAL_FAILURE)
+        return b'\x03' + bytes([len(name)]) + name + port.to_bytes(2, 'big')
+    if ip.version == 4:
+        return b'\x01' + ip.packed + port.to_bytes(2, 'big')
+    return b'\x04' + ip.packed + port.to_bytes(2, 'big')
+
+
+async def read_address(reader):
+    """读取 SOCKS5 报文中的地址字段，返回 (host, port)"""
+    atyp = (await reader.readexactly(1))[0]
+    if atyp == 1:
+        host = socket.inet_ntoa(await reader.readexactly(4))
+    elif atyp == 4:
+        host = socket.inet_ntop(socket.AF_INET6, await reader.readexactly(16))
+    elif atyp == 3:
+        length = (await reader.readexactly(1))[0]
+        host = (await reader.readexactly(length)).decode('idna')
+    else:
+        raise Socks5Error(f"上游返回未知地址类型 {atyp}", REP_GENERAL_FAILURE)
+    port = int.from_bytes(await reader.readexactly(2), 'big')
+    return host, port
+
+
+async def socks5_handshake(reader, writer, username=None, password=None):
+    """完成与上游的 SOCKS5 问候及用户名/密码认证"""
+    if username:
+        writer.write(b'\x05\x02\x00\x02')
+    else:
+        writer.write(b'\x05\x01\x00')
+    await writer.drain()
+
+    version, method = await reader.readexactly(2)
+    if version != 5:
+        raise Socks5Error(f"上游不是 SOCKS5 服务器（版本 {version}）")
+    if method == 0x02:
+        if not username:
+            raise Socks5Error("上游要求认证，但未提供用户名", REP_NOT_ALLOWED)
+        user = username.encode('utf-8')
+        passwd = (password or "").encode('utf-8')
+        writer.write(b'\x01' + bytes([len(user)]) + user + bytes([len(passwd)]) + passwd)
+        await writer.drain()
+        _, status = await reader.readexactly(2)
+        if status != 0:
+            raise Socks5Error("上游用户名/密码认证失败", REP_NOT_ALLOWED)
+    elif method != 0x00:
+        raise Socks5Error("上游不接受任何可用的认证方式", REP_NOT_ALLOWED)
+
+
+async def socks5_request(reader, writer, command, host, port):
+    """发送 SOCKS5 请求并读取应答，返回上游绑定的 (host, port)"""
+    writer.write(bytes([5, command, 0]) + encode_address(host, port))
+    await writer.drain()
+    version, rep, _ = await reader.readexactly(3)
+    if version != 5:
+        raise Socks5Error(f"上游应答版本错误 {version}")
+    if rep != REP_SUCCEEDED:
+        message = REPLY_MESSAGES.get(rep, f"未知应答码 {rep}")
+        raise Socks5Error(f"上游拒绝请求: {message}", rep, target_error=True)
+    return await read_address(reader)
+
+
+async def open_socks5_connection(proxy_host, proxy_port, target_host, target_port,
+                                 username=None, password=None, timeout=10.0):
+    """通过上游 SOCKS5 代理异步连接到目标，返回 (reader, writer)"""
+    streams = []
+
+    async def connect():
+        reader, writer = await asyncio.open_connection(proxy_host, proxy_port)
+        streams.append(writer)
+        await socks5_handshake(reader, writer, username, password)
+        await socks5_request(reader, writer, CMD_CONNECT, target_host, target_port)
+        return reader, writer
+
+    try:
+        return await asyncio.wait_for(connect(), timeout)
+    except BaseException as e:
+        for writer in streams:
+            writer.close()
+        raise map_connect_error(e, proxy_host, proxy_port)
+
+
+def map_connect_error(error, proxy_host, proxy_port):
+    """把连接上游时的异常转换为带应答码的 Socks5Error（其他异常原样返回）"""
+    if isinstance(error, Socks5Error):
+        return error
+    if isinstance(error, asyncio.TimeoutError):
+        result = Socks5Error(f"连接上游 {proxy_host}:{proxy_port} 超时", REP_TTL_EXPIRED)
+    elif isinstance(error, ConnectionRefusedError):
+        result = Socks5Error(f"上游 {proxy_host}:{proxy_port} 拒绝连接", REP_CONNECTION_REFUSED)
+    elif isinstance(error, asyncio.IncompleteReadError):
+        result = Socks5Error(f"上游 {proxy_host}:{proxy_port} 提前关闭连接")
+    elif isinstance(error, OSError):
+        result = Socks5Error(f"连接上游 {proxy_host}:{proxy_port} 失败: {error}", REP_HOST_UNREACHABLE)
+    else:
+        return error
+    result.__cause__ = error
+    return result
@@ -0,0 +1,112 @@
+import socket
+
+from socks5_client import REP_ADDRESS_TYPE_NOT_SUPPORTED, REP_GENERAL_FAILURE, socks5_reply
+
+# 预先生成的认证方式选择应答
+METHOD_NO_AUTH = 0x00
+METHOD_NO_ACCEPTABLE = 0xFF
+REPLY_NO_AUTH = bytes([5, METHOD_NO_AUTH])
+REPLY_NO_ACCEPTABLE = bytes([5, METHOD_NO_ACCEPTABLE])
+
+# 解析状态
+STATE_GREETING = 0
+STATE_REQUEST = 1
+STATE_DONE = 2
+
+# 各地址类型的固定长度（不含域名），用于判断请求是否已完整到达
+_IPV4_REQUEST_LEN = 4 + 4 + 2
+_IPV6_REQUEST_LEN = 4 + 16 + 2
+
+
+class Socks5ProtocolError(Exception):
+    """客户端发来的 SOCKS5 数据无效；reply 为关闭连接前应发送给客户端的应答（可能为空，
+    也可能排在问候应答之后），reply_code 为其中的应答码（方法协商失败时为 0xFF）
+    """
+
+    def __init__(self, message, reply=b'', reply_code=None):
+        super().__init__(message)
+        self.reply = reply
+        self.reply_code = reply_code
+
+
+class Socks5RequestParser:
+    """基于缓冲区的 SOCKS5 服务端握手解析器
+
+    数据可以任意分片到达，也可以把问候、请求甚至后续载荷放在同一段数据中（粘包）。
+    每次收到数据调用 feed()，返回需要立即发给客户端的应答；
+    解析完成后 command、host、port 为请求内容，leftover 为请求之后已到达的数据。
+    """
+
+    __slots__ = ('buffer', 'state', 'command', 'host', 'port', 'leftover')
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.state = STATE_GREETING
+        self.command = None
+        self.host = None
+        self.port = None
+        self.leftover = b''
+
+    @property
+    def done(self):
+        return self.state == STATE_DONE
+
+    def feed(self, data):
+        """追加收到的数据并尽可能向前解析，返回应发给客户端的字节串"""
+        buffer = self.buffer
+        buffer += data
+        output = b''
+        if self.state == STATE_GREETING:
+            if len(buffer) < 2:
+                return output
+            if buffer[0] != 5:
+                raise Socks5ProtocolError(f"无效的 SOCKS5 握手，版本 {buffer[0]}")
+            end = 2 + buffer[1]
+            if len(buffer) < end:
+                return output
+            if METHOD_NO_AUTH not in buffer[2:end]:
+                raise Socks5ProtocolError("客户端未提供可用的认证方式（仅支持无认证）", REPLY_NO_ACCEPTABLE,
+                                          METHOD_NO_ACCEPTABLE)
+            del buffer[:end]
+            self.state = STATE_REQUEST
+            output = REPLY_NO_AUTH
+
+        if self.state == STATE_REQUEST:
+            if len(buffer) < 4:
+                return output
+            if buffer[0] != 5:
+                raise Socks5ProtocolError(f"无效的 SOCKS5 请求，版本 {buffer[0]}",
+                                          output + socks5_reply(REP_GENERAL_FAILURE), REP_GENERAL_FAILURE)
+            atyp = buffer[3]
+            if atyp == 1:
+                end = _IPV4_REQUEST_LEN
+                if len(buffer) < end:
+                    return output
+                host = socket.inet_ntoa(bytes(buffer[4:8]))
+            elif atyp == 3:
+                if len(buffer) < 5:
+                    return output
+                end = 5 + buffer[4] + 2
+                if len(buffer) < end:
+                    return output
+                try:
+                    host = bytes(buffer[5:end - 2]).decode('utf-8')
+                except UnicodeDecodeError:
+                    raise Socks5ProtocolError("无效的目标域名", output + socks5_reply(REP_GENERAL_FAILURE),
+                                              REP_GENERAL_FAILURE) from None
+            elif atyp == 4:
+                end = _IPV6_REQUEST_LEN
+                if len(buffer) < end:
+                    return output
+                host = socket.inet_ntop(socket.AF_INET6, bytes(buffer[4:20]))
+            else:
+                raise Socks5ProtocolError(f"不支持的地址类型 {atyp}",
+                                          output + socks5_reply(REP_ADDRESS_TYPE_NOT_SUPPORTED),
+                                          REP_ADDRESS_TYPE_NOT_SUPPORTED)
+            self.command = buffer[1]
+            self.host = host
+            self.port = (buffer[end - 2] << 8) | buffer[end - 1]
+            self.leftover = bytes(buffer[end:])
+            buffer.clear()
+            self.state = STATE_DONE
+        return output
@@ -0,0 +1,98 @@
+import json
+import os
+import tempfile
+import threading
+import time
+
+from logger import logger
+
+SNAPSHOT_VERSION = 1
+
+
+class StateStore:
+    """端口映射和上游健康状态的磁盘快照
+
+    状态变化时只调用 mark_dirty()，由后台线程合并 min_interval 秒内的多次变化后写一次；
+    写入先落到同目录的临时文件并 fsync，再用 os.replace 原子替换，进程崩溃时不会留下半个文件。
+    collect() 返回要保存的状态字典，在后台线程中调用
+    """
+
+    def __init__(self, path, collect, min_interval=1.0):
+        self.path = path
+        self.collect = collect
+        self.min_interval = min_interval
+        self.saves = 0
+        self._last_data = None
+        self._dirty = threading.Event()
+        self._closed = False
+        self._write_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='uniproxy-state', daemon=True)
+        self._thread.start()
+
+    def load(self):
+        """读取快照，文件不存在或无效时返回 None"""
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(None, "读取状态快照 %s 失败，忽略: %s", self.path, e)
+            return None
+        if not isinstance(state, dict) or state.get('version') != SNAPSHOT_VERSION:
+            logger.warning(None, "状态快照 %s 的版本不受支持，忽略", self.path)
+            return None
+        return state
+
+    def mark_dirty(self):
+        self._dirty.set()
+
+    def _run(self):
+        while True:
+            self._dirty.wait()
+            if self._closed:
+                return
+            # 合并短时间内的连续变化（例如批量启动时逐个事件循环的更新）
+            time.sleep(self.min_interval)
+            self._dirty.clear()
+            self.flush()
+
+    def flush(self):
+        """立即写入当前状态，内容与上次写入相同时跳过"""
+        try:
+            state = dict(self.collect(), version=SNAPSHOT_VERSION, saved_at=time.time())
+            data = json.dumps(state, separators=(',', ':'), ensure_ascii=False)
+        except Exception as e:
+            logger.warning(None, "收集状态快照失败: %s", e)
+            return
+        with self._write_lock:
+            # saved_at 每次都不同，比较时忽略
+            content = data[:data.rindex(',"saved_at"')]
+            if content == self._last_data:
+                return
+            directory = os.path.dirname(os.path.abspath(self.path))
+            try:
+                fd, temp_path = tempfile.mkstemp(prefix='.uniproxy-state-', dir=directory)
+                try:
+                    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                        f.write(data)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(temp_path, self.path)
+                except BaseException:
+                    os.unlink(temp_path)
+                    raise
+            except OSError as e:
+                logger.error(None, "写入状态快照 %s 失败: %s", self.path, e)
+                return
+            self._last_data = content
+            self.saves += 1
+
+    def close(self):
+        """写入最后一次状态并结束后台线程"""
+        if self._closed:
+            return
+        self._closed = True
+        self._dirty.set()
+        self._thread.join(timeout=2)
+        self.flush()
@@ -0,0 +1,152 @@
+import asyncio
+import time
+
+# SOCKS5 UDP 报文头：RSV(2) FRAG(1) ATYP(1) DST.ADDR DST.PORT(2)
+_FIXED_HEADER_LENGTHS = {1: 4 + 4 + 2, 4: 4 + 16 + 2}
+
+
+def udp_header_length(data):
+    """返回 SOCKS5 UDP 报文头的长度，不合法或分片的报文返回 0
+
+    只读取头部的几个字节，不复制报文
+    """
+    size = len(data)
+    if size < 4 or data[2] != 0:
+        # 不支持分片（FRAG != 0）的报文，按规范直接丢弃
+        return 0
+    atyp = data[3]
+    if atyp == 3:
+        if size < 5:
+            return 0
+        length = 5 + data[4] + 2
+    else:
+        length = _FIXED_HEADER_LENGTHS.get(atyp, 0)
+    return length if 0 < length <= size else 0
+
+
+class _Endpoint(asyncio.DatagramProtocol):
+    """把收到的数据报交给 UdpAssociation 的回调"""
+
+    def __init__(self, on_datagram):
+        self.on_datagram = on_datagram
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.on_datagram(data, addr)
+
+    def error_received(self, exc):
+        # ICMP 端口不可达等错误只影响单个数据报
+        pass
+
+
+class UdpAssociation:
+    """一个 UDP ASSOCIATE 会话：本地为客户端开一个 UDP 端点，经上游的 UDP ASSOCIATE 会话转发
+
+    客户端和上游使用同样的 SOCKS5 UDP 报文格式，因此报文只校验头部后原样转发，不做任何复制。
+    会话随客户端或上游的 TCP 控制连接关闭而结束，长时间没有数据报时也会结束
+    """
+
+    def __init__(self, client_reader, client_writer, upstream_reader, upstream_writer,
+                 relay_address, upstream_host, idle_timeout=60.0):
+        self.client_reader = client_reader
+        self.client_writer = client_writer
+        self.upstream_reader = upstream_reader
+        self.upstream_writer = upstream_writer
+        relay_host, relay_port = relay_address
+        if relay_host in ('0.0.0.0', '::'):
+            # 上游返回通配地址时，中继就在上游主机本身
+            relay_host = upstream_host
+        self.relay_address = (relay_host, relay_port)
+        self.idle_timeout = idle_timeout
+        # 只接受来自客户端 TCP 连接同一 IP 的数据报，首个数据报确定客户端的 UDP 端口
+        self.client_ip = client_writer.get_extra_info('peername')[0]
+        self.client_address = None
+        self.client_transport = None
+        self.upstream_transport = None
+        self.last_activity = time.monotonic()
+        self.datagrams_sent = 0
+        self.datagrams_received = 0
+        self._idle_handle = None
+        self._closed = None
+
+    async def start(self):
+        """创建本地与上游两个 UDP 端点，返回给客户端的中继地址 (host, port)"""
+        loop = asyncio.get_running_loop()
+        local_host = self.client_writer.get_extra_info('sockname')[0]
+        self.client_transport, _ = await loop.create_datagram_endpoint(
+            lambda: _Endpoint(self._from_client), local_addr=(local_host, 0)
+        )
+        try:
+            self.upstream_transport, _ = await loop.create_datagram_endpoint(
+                lambda: _Endpoint(self._from_upstream), remote_addr=self.relay_address
+            )
+        except BaseException:
+            self.client_transport.close()
+            raise
+        self._closed = loop.create_future()
+        self._idle_handle = loop.call_later(self.idle_timeout, self._check_idle)
+        return self.client_transport.get_extra_info('sockname')[:2]
+
+    def _from_client(self, data, addr):
+        if addr[0] != self.client_ip:
+            return
+        if self.client_address is None:
+            self.client_address = addr
+        elif addr != self.client_address:
+            return
+        if not udp_header_length(data):
+            return
+        self.last_activity = time.monotonic()
+        self.datagrams_sent += 1
+        self.upstream_transport.sendto(data)
+
+    def _from_upstream(self, data, addr):
+        if self.client_address is None or not udp_header_length(data):
+            return
+        self.last_activity = time.monotonic()
+        self.datagrams_received += 1
+        self.client_transport.sendto(data, self.client_address)
+
+    def _check_idle(self):
+        """空闲检查：数据报只更新时间戳，定时器到期时才决定关闭还是顺延"""
+        remaining = self.last_activity + self.idle_timeout - time.monotonic()
+        if remaining <= 0:
+            self.close()
+            return
+        loop = asyncio.get_running_loop()
+        self._idle_handle = loop.call_later(remaining, self._check_idle)
+
+    async def run(self):
+        """等待会话结束：任一 TCP 控制连接关闭、空闲超时或被 close()"""
+        waiters = [asyncio.ensure_future(self._wait_eof(self.client_reader)),
+                   asyncio.ensure_future(self._wait_eof(self.upstream_reader)),
+                   self._closed]
+        try:
+            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for waiter in waiters[:2]:
+                waiter.cancel()
+            self.close()
+
+    @staticmethod
+    async def _wait_eof(reader):
+        # 控制连接上不应再有数据，读到 EOF 或出错即表示会话结束
+        try:
+            while await reader.read(4096):
+                pass
+        except (ConnectionError, OSError):
+            pass
+
+    def close(self):
+        if self._idle_handle is not None:
+            self._idle_handle.cancel()
+            self._idle_handle = None
+        if self._closed is not None and not self._closed.done():
+            self._closed.set_result(None)
+        for transport in (self.client_transport, self.upstream_transport):
+            if transport is not None:
+                transport.close()
+        self.upstream_writer.close()
@@ -0,0 +1,167 @@
+import asyncio
+import functools
+import heapq
+import time
+
+from logger import logger
+from socks5_client import Socks5Error
+from upstream_pool import UpstreamPool, staggered_race
+
+# 延迟与成功率的指数滑动平均系数
+EWMA_ALPHA = 0.3
+# 连续失败后的冷却时间上限（秒）
+MAX_COOLDOWN = 60.0
+
+
+class Upstream:
+    """组内的单个上游，记录近期的连接延迟和成功率"""
+
+    def __init__(self, host, port, username=None, password=None, **pool_options):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.pool = UpstreamPool(host, port, username, password, **pool_options)
+        # 尚未连接过的上游延迟记为 None，排序时优先尝试
+        self.latency = None
+        self.success_rate = 1.0
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        # 后台健康探测的结论，None 表示尚未探测
+        self.healthy = None
+
+    @property
+    def key(self):
+        return (self.host, self.port, self.username, self.password)
+
+    def record_success(self, latency):
+        self.latency = latency if self.latency is None else (
+            EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * self.latency)
+        self.success_rate = EWMA_ALPHA + (1 - EWMA_ALPHA) * self.success_rate
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+
+    def record_slower_than(self, elapsed):
+        """并行连接中输给其他上游而被取消：已等待的 elapsed 秒是真实延迟的下限，只在高于当前估计时计入"""
+        if self.latency is None:
+            self.latency = elapsed
+        elif elapsed > self.latency:
+            self.latency = EWMA_ALPHA * elapsed + (1 - EWMA_ALPHA) * self.latency
+
+    def record_failure(self):
+        self.success_rate = (1 - EWMA_ALPHA) * self.success_rate
+        self.consecutive_failures += 1
+        cooldown = min(2 ** (self.consecutive_failures - 1), MAX_COOLDOWN)
+        self.cooldown_until = time.monotonic() + cooldown
+
+    def score(self, now):
+        """排序依据：探测不健康或冷却中的排在最后，其余按 延迟 / 成功率 从小到大"""
+        latency = self.latency if self.latency is not None else 0.0
+        unavailable = self.healthy is False or self.cooldown_until > now
+        return (unavailable, latency / max(self.success_rate, 0.05))
+
+
+class UpstreamGroup:
+    """一个本地端口对应的一组上游：按近期表现选择上游，失败时自动切换到下一个
+
+    race_count > 1 时并行尝试得分最好的上游：每个错开 race_delay 秒启动，最多同时进行 race_count 个，
+    某个失败时立即开始下一个候选（共尝试 max(race_count, max_attempts) 个）；
+    使用最先完成 CONNECT 的上游，其余尝试取消并关闭
+    """
+
+    def __init__(self, upstreams, max_attempts=3, race_count=1, race_delay=0.25, **pool_options):
+        self.pool_options = pool_options
+        self.max_attempts = max_attempts
+        self.race_count = race_count
+        self.race_delay = race_delay
+        self.members = []
+        seen = set()
+        for host, port, username, password in upstreams:
+            if (host, port, username, password) in seen:
+                continue
+            seen.add((host, port, username, password))
+            self.members.append(Upstream(host, port, username, password, **pool_options))
+        if not self.members:
+            raise ValueError("上游列表不能为空")
+
+    def candidates(self, count):
+        """得分最好的 count 个候选上游，按得分排列（只选出前 count 个，不对整个组排序）"""
+        now = time.monotonic()
+        return heapq.nsmallest(count, self.members, key=lambda upstream: upstream.score(now))
+
+    async def open_connection(self, target_host, target_port):
+        """依次（或按 race_count 并行）尝试得分最好的上游，返回 (reader, writer, upstream)"""
+        if self.race_count > 1 and len(self.members) > 1:
+            return await self._race_connection(target_host, target_port)
+        last_error = None
+        for upstream in self.candidates(self.max_attempts):
+            started = time.monotonic()
+            try:
+                reader, writer = await upstream.pool.open_connection(target_host, target_port)
+            except Socks5Error as e:
+                if e.target_error:
+                    # 上游正常应答，只是目标不可达，换上游也无济于事
+                    raise
+                upstream.record_failure()
+                logger.debug(None, "上游 %s:%s 连接失败，尝试下一个: %s", upstream.host, upstream.port, e)
+                last_error = e
+                continue
+            upstream.record_success(time.monotonic() - started)
+            return reader, writer, upstream
+        raise last_error
+
+    async def _race_connection(self, target_host, target_port):
+        async def attempt(upstream):
+            started = time.monotonic()
+            try:
+                reader, writer = await upstream.pool.open_connection(target_host, target_port)
+            except Socks5Error as e:
+                if not e.target_error:
+                    upstream.record_failure()
+                    logger.debug(None, "上游 %s:%s 连接失败: %s", upstream.host, upstream.port, e)
+                raise
+            except asyncio.CancelledError:
+                upstream.record_slower_than(time.monotonic() - started)
+                raise
+            upstream.record_success(time.monotonic() - started)
+            return reader, writer, upstream
+
+        candidates = self.candidates(max(self.race_count, self.max_attempts))
+        attempts = [functools.partial(attempt, upstream) for upstream in candidates]
+        # 上游正常应答、只是目标不可达时，其他上游也无济于事，立即结束
+        _, connection = await staggered_race(
+            attempts, self.race_delay, close=lambda connection: connection[1].close(),
+            abort_on=lambda e: isinstance(e, Socks5Error) and e.target_error, limit=self.race_count
+        )
+        return connection
+
+    async def open_association(self):
+        """依次在得分最好的上游建立 UDP ASSOCIATE 会话，返回 (reader, writer, 中继地址, upstream)"""
+        last_error = None
+        for upstream in self.candidates(self.max_attempts):
+            try:
+                reader, writer, relay_address = await upstream.pool.open_association()
+            except Socks5Error as e:
+                # 上游明确拒绝 UDP 时只是不支持该命令，不计入连接失败
+                if not e.target_error:
+                    upstream.record_failure()
+                logger.debug(None, "上游 %s:%s 建立 UDP 会话失败，尝试下一个: %s", upstream.host, upstream.port, e)
+                last_error = e
+                continue
+            return reader, writer, relay_address, upstream
+        raise last_error
+
+    def apply_health(self, results):
+        """应用健康探测结果 {(host, port, username, password): 结果}"""
+        for upstream in self.members:
+            result = results.get(upstream.key)
+            if result is None:
+                continue
+            upstream.healthy = result['healthy']
+            if result['healthy'] and upstream.latency is None:
+                # 还没有真实连接数据时用探测延迟作为初始估计
+                upstream.latency = result['latency']
+
+    def close(self):
+        for upstream in self.members:
+            upstream.pool.close()
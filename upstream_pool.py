@@ -0,0 +1,254 @@
+import asyncio
+import collections
+import functools
+import ipaddress
+import socket
+import time
+
+from logger import logger
+from socks5_client import CMD_CONNECT, CMD_UDP_ASSOCIATE, map_connect_error, socks5_handshake, socks5_request
+
+
+async def staggered_race(attempts, delay, close=None, abort_on=None, limit=None):
+    """错开 delay 秒依次启动 attempts 中的尝试，返回最先成功的 (序号, 结果)
+
+    attempts 为按优先顺序排列的无参数协程函数；某个尝试失败时立即启动下一个，不必等满 delay；
+    limit 为同时进行的尝试数上限（None 表示不限），达到上限时等到有尝试失败才启动下一个。
+    第一个成功的尝试胜出，其余仍在进行的尝试被取消，取消前已经成功的结果交给 close() 释放；
+    abort_on(异常) 为真时不再尝试其余候选，直接抛出该异常。全部失败时抛出最后一个失败的异常
+    """
+    tasks = {}
+    next_index = 0
+    last_error = None
+    try:
+        while True:
+            if next_index < len(attempts) and (limit is None or len(tasks) < limit):
+                tasks[asyncio.ensure_future(attempts[next_index]())] = next_index
+                next_index += 1
+            if not tasks:
+                raise last_error
+            can_start = next_index < len(attempts) and (limit is None or len(tasks) < limit)
+            timeout = delay if can_start else None
+            done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            winner = None
+            for task in done:
+                index = tasks.pop(task)
+                error = task.exception()
+                if error is None:
+                    if winner is None:
+                        winner = (index, task.result())
+                    elif close is not None:
+                        close(task.result())
+                    continue
+                if abort_on is not None and abort_on(error):
+                    raise error
+                last_error = error
+            if winner is not None:
+                return winner
+    finally:
+        for task in tasks:
+            task.cancel()
+            task.add_done_callback(functools.partial(_discard_result, close))
+
+
+def _discard_result(close, task):
+    """被取消的尝试结束时调用：已经成功的结果交给 close()，失败的异常只取出不处理"""
+    if task.cancelled():
+        return
+    if task.exception() is None and close is not None:
+        close(task.result())
+
+
+def _interleave_families(infos):
+    """getaddrinfo 的结果去重后按地址族交替排列（RFC 8305），保持各地址族内的原有顺序"""
+    by_family = collections.OrderedDict()
+    for family, _, _, _, address in infos:
+        addresses = by_family.setdefault(family, [])
+        if address[0] not in addresses:
+            addresses.append(address[0])
+    ordered = []
+    queues = list(by_family.values())
+    while any(queues):
+        for addresses in queues:
+            if addresses:
+                ordered.append(addresses.pop(0))
+    return ordered
+
+
+class UpstreamPool:
+    """上游连接池：保存已完成 SOCKS5 问候和认证、尚未发送 CONNECT 的空闲连接
+
+    提供 happy_eyeballs_delay（秒）时，上游主机名解析出多个地址则错开这个时间并行连接各地址，
+    使用最先完成问候和认证的连接
+    """
+
+    def __init__(self, host, port, username=None, password=None, max_size=2,
+                 idle_timeout=30.0, connect_timeout=10.0, happy_eyeballs_delay=None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.happy_eyeballs_delay = happy_eyeballs_delay
+        # 空闲连接 (reader, writer, 放入时间)，右端为最新
+        self.idle = collections.deque()
+        self.hits = 0
+        self.misses = 0
+        self._filling = 0
+        self._fill_tasks = set()
+        self._expire_handle = None
+        self.closed = False
+
+    def stats(self):
+        """连接池统计信息"""
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'idle': len(self.idle),
+            'max_size': self.max_size,
+        }
+
+    async def _authenticate(self):
+        """新建到上游的 TCP 连接并完成问候和认证"""
+        if self.happy_eyeballs_delay is None:
+            return await self._authenticate_address(self.host)
+        addresses = await self._resolve()
+        if len(addresses) == 1:
+            return await self._authenticate_address(addresses[0])
+        attempts = [functools.partial(self._authenticate_address, address) for address in addresses]
+        _, streams = await staggered_race(attempts, self.happy_eyeballs_delay,
+                                          close=lambda streams: streams[1].close())
+        return streams
+
+    async def _resolve(self):
+        try:
+            ipaddress.ip_address(self.host)
+        except ValueError:
+            pass
+        else:
+            return [self.host]
+        infos = await asyncio.get_running_loop().getaddrinfo(self.host, self.port, type=socket.SOCK_STREAM)
+        return _interleave_families(infos)
+
+    async def _authenticate_address(self, host):
+        reader, writer = await asyncio.open_connection(host, self.port)
+        try:
+            await socks5_handshake(reader, writer, self.username, self.password)
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+    def _take_idle(self):
+        """取出一个仍可用的空闲连接，过期或已被上游关闭的直接丢弃"""
+        deadline = time.monotonic() - self.idle_timeout
+        while self.idle:
+            reader, writer, since = self.idle.pop()
+            if since >= deadline and not writer.is_closing() and not reader.at_eof():
+                return reader, writer
+            writer.close()
+        return None
+
+    async def open_connection(self, target_host, target_port):
+        """通过上游连接目标，优先使用池中已认证的连接，返回 (reader, writer)"""
+        reader, writer, _ = await self._request(CMD_CONNECT, target_host, target_port)
+        return reader, writer
+
+    async def open_association(self):
+        """在上游建立 UDP ASSOCIATE 会话，返回 (reader, writer, 上游的 UDP 中继地址)
+
+        返回的 TCP 连接须保持打开，关闭即结束会话
+        """
+        return await self._request(CMD_UDP_ASSOCIATE, '0.0.0.0', 0)
+
+    async def _request(self, command, target_host, target_port):
+        """在（优先取自池中的）已认证连接上发送请求，返回 (reader, writer, 上游绑定地址)"""
+        streams = []
+
+        async def connect():
+            pooled = self._take_idle()
+            if pooled is not None:
+                self.hits += 1
+                reader, writer = pooled
+                streams.append(writer)
+                try:
+                    bound = await socks5_request(reader, writer, command, target_host, target_port)
+                    return reader, writer, bound
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    # 池中的连接可能已被上游关闭，换一条新连接重试
+                    writer.close()
+            else:
+                self.misses += 1
+            reader, writer = await self._authenticate()
+            streams.append(writer)
+            bound = await socks5_request(reader, writer, command, target_host, target_port)
+            return reader, writer, bound
+
+        try:
+            result = await asyncio.wait_for(connect(), self.connect_timeout)
+        except BaseException as e:
+            for writer in streams:
+                writer.close()
+            raise map_connect_error(e, self.host, self.port)
+        # 只在上游可用时补充连接，避免反复连接已失效的上游
+        self._refill()
+        return result
+
+    def _refill(self):
+        """在后台补充空闲连接直到达到 max_size"""
+        if self.closed:
+            return
+        missing = self.max_size - len(self.idle) - self._filling
+        for _ in range(max(missing, 0)):
+            self._filling += 1
+            task = asyncio.ensure_future(self._fill_one())
+            self._fill_tasks.add(task)
+            task.add_done_callback(self._fill_tasks.discard)
+
+    async def _fill_one(self):
+        try:
+            reader, writer = await asyncio.wait_for(self._authenticate(), self.connect_timeout)
+        except Exception as e:
+            logger.warning(None, "预建上游连接 %s:%s 失败: %s", self.host, self.port, e)
+            return
+        finally:
+            self._filling -= 1
+        if self.closed:
+            writer.close()
+            return
+        self.idle.append((reader, writer, time.monotonic()))
+        self._schedule_expire()
+
+    def _schedule_expire(self):
+        """有空闲连接时才安排一次过期检查，空池不占用定时器"""
+        if self._expire_handle is None and self.idle:
+            loop = asyncio.get_running_loop()
+            self._expire_handle = loop.call_later(self.idle_timeout, self._expire)
+
+    def _expire(self):
+        self._expire_handle = None
+        deadline = time.monotonic() - self.idle_timeout
+        # 左端为最早放入的连接
+        while self.idle and self.idle[0][2] <= deadline:
+            _, writer, _ = self.idle.popleft()
+            writer.close()
+        if self.idle:
+            loop = asyncio.get_running_loop()
+            delay = self.idle[0][2] + self.idle_timeout - time.monotonic()
+            self._expire_handle = loop.call_later(max(delay, 0.0), self._expire)
+
+    def close(self):
+        """关闭连接池及全部空闲连接"""
+        self.closed = True
+        if self._expire_handle is not None:
+            self._expire_handle.cancel()
+            self._expire_handle = None
+        for task in list(self._fill_tasks):
+            task.cancel()
+        while self.idle:
+            _, writer, _ = self.idle.pop()
+            writer.close()
@@ -0,0 +1,316 @@
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+
+from logger import logger
+from metrics import merge_snapshots
+
+# reuseport：所有工作进程绑定同一组端口，由内核分发连接（仅 Linux 等支持 SO_REUSEPORT 的系统）
+# split：按端口号把端口分给不同的工作进程
+SHARDING_MODES = ('auto', 'reuseport', 'split')
+
+
+def reuse_port_supported():
+    """当前系统是否支持由内核在多个进程间分发 SO_REUSEPORT 连接"""
+    return hasattr(socket, 'SO_REUSEPORT') and sys.platform.startswith('linux')
+
+
+def _worker_main(conn, loop_count, server_options, log_config):
+    """工作进程入口：运行一个独立的 ProxyManager，按主进程的指令启停端口"""
+    from proxy_manager import ProxyManager
+
+    # 以 spawn 方式启动的工作进程不继承主进程的日志配置
+    logger.configure(**log_config)
+    manager = ProxyManager(loop_count=loop_count, **server_options)
+    try:
+        while True:
+            try:
+                command, args = conn.recv()
+            except (EOFError, OSError):
+                break
+            if command == 'start':
+                conn.send(manager.start_ports(args))
+            elif command == 'stop':
+                ports, drain_timeout = args
+                manager.stop_ports(ports, drain_timeout=drain_timeout)
+                conn.send(None)
+            elif command == 'resolve':
+                ports, mode = args
+                manager.set_resolve_mode(ports, mode)
+                conn.send(None)
+            elif command == 'dns_stats':
+                conn.send(manager.dns_stats())
+            elif command == 'metrics':
+                conn.send(manager.metrics_snapshot())
+            elif command == 'list':
+                conn.send(manager.list_ports())
+            elif command == 'health':
+                manager.apply_health(args)
+                conn.send(None)
+            elif command == 'drain':
+                ports, timeout = args
+                conn.send(manager.drain_ports(ports, timeout))
+            elif command == 'shutdown':
+                break
+    finally:
+        manager.stop_all_proxies()
+        conn.close()
+        # 工作进程退出时不执行 atexit，需要主动输出剩余日志
+        logger.close()
+
+
+class WorkerSupervisor:
+    """多进程模式的主控：启动 N 个工作进程，分发上游配置并协调启停"""
+
+    def __init__(self, worker_count=None, sharding='auto', loop_count=1, **server_options):
+        if sharding not in SHARDING_MODES:
+            raise ValueError(f"未知的分片模式: {sharding}")
+        if sharding == 'auto':
+            sharding = 'reuseport' if reuse_port_supported() else 'split'
+        elif sharding == 'reuseport' and not reuse_port_supported():
+            raise ValueError("当前系统不支持 SO_REUSEPORT，请使用 split 模式")
+        self.worker_count = worker_count or os.cpu_count() or 1
+        self.sharding = sharding
+        self.loop_count = loop_count
+        self.server_options = dict(server_options)
+        if sharding == 'reuseport':
+            self.server_options['reuse_port'] = True
+        # 带宽上限由工作进程平分：进程级上限总是如此，reuseport 模式下每个端口也由全部工作进程共同服务
+        shared_rates = ('global_upload_rate', 'global_download_rate')
+        if sharding == 'reuseport':
+            shared_rates += ('upload_rate', 'download_rate')
+        for key in shared_rates:
+            if self.server_options.get(key):
+                self.server_options[key] = self.server_options[key] / self.worker_count
+        # 主进程保存的端口配置，用于重启崩溃的工作进程后恢复端口
+        self.assignments = {}
+        # 单独设置过解析方式的端口 -> 解析方式，同样在重启工作进程后恢复
+        self.resolve_modes = {}
+        # 最近一次下发的健康探测结果，重启的工作进程同样需要
+        self.health = {}
+        self.processes = []
+        self.connections = []
+        self._lock = threading.Lock()
+
+    def _spawn(self, index):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(
+            target=_worker_main, args=(child_conn, self.loop_count, self.server_options, logger.config()),
+            name=f"uniproxy-worker-{index}", daemon=True
+        )
+        process.start()
+        child_conn.close()
+        return process, parent_conn
+
+    def start(self):
+        """启动全部工作进程（重复调用无副作用）"""
+        with self._lock:
+            while len(self.processes) < self.worker_count:
+                process, conn = self._spawn(len(self.processes))
+                self.processes.append(process)
+                self.connections.append(conn)
+
+    def _workers_for_port(self, port):
+        if self.sharding == 'reuseport':
+            return list(range(self.worker_count))
+        return [port % self.worker_count]
+
+    def _restart_dead_workers(self):
+        """重启已退出的工作进程，并重新下发其负责的端口"""
+        for index, process in enumerate(self.processes):
+            if not process.is_alive():
+                self._restart_worker(index)
+
+    def _restart_worker(self, index):
+        process = self.processes[index]
+        logger.warning(None, "工作进程 %s 已退出（代码 %s），正在重启", process.name, process.exitcode)
+        self.connections[index].close()
+        self.processes[index], self.connections[index] = self._spawn(index)
+        modes = {}
+        for port, mode in self.resolve_modes.items():
+            if index in self._workers_for_port(port):
+                modes.setdefault(mode, []).append(port)
+        for mode, ports in modes.items():
+            self.connections[index].send(('resolve', (ports, mode)))
+            self.connections[index].recv()
+        owned = [(port,) + upstream for port, upstream in self.assignments.items()
+                 if index in self._workers_for_port(port)]
+        if owned:
+            self.connections[index].send(('start', owned))
+            self.connections[index].recv()
+        if self.health:
+            self.connections[index].send(('health', self.health))
+            self.connections[index].recv()
+
+    def _broadcast(self, batches, command):
+        """把每个工作进程的批量指令并行发送出去，再依次收集结果
+
+        无法通信的工作进程（例如在两次调用之间被杀死）不出现在结果中，收集完其他结果后将其重启
+        """
+        failed = set()
+        for index, batch in batches.items():
+            try:
+                self.connections[index].send((command, batch))
+            except OSError:
+                failed.add(index)
+        replies = {}
+        for index in batches:
+            if index in failed:
+                continue
+            try:
+                replies[index] = self.connections[index].recv()
+            except (EOFError, OSError):
+                failed.add(index)
+        for index in sorted(failed):
+            process = self.processes[index]
+            process.join(timeout=1.0)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+            self._restart_worker(index)
+        return replies
+
+    def start_ports(self, assignments):
+        """在工作进程中启动一批端口
+
+        assignments 为 (port, host, port, username, password[, upstreams]) 列表
+        """
+        # 统一补齐为六元组，upstreams 缺省为 None
+        assignments = [tuple(a) + (None,) * (6 - len(a)) for a in assignments]
+        self.start()
+        with self._lock:
+            self._restart_dead_workers()
+            batches = {}
+            for assignment in assignments:
+                for index in self._workers_for_port(assignment[0]):
+                    batches.setdefault(index, []).append(assignment)
+            replies = self._broadcast(batches, 'start')
+
+            results = {}
+            for assignment in assignments:
+                port = assignment[0]
+                results[port] = all(replies.get(index, {}).get(port, False) for index in self._workers_for_port(port))
+            failed = [port for port, ok in results.items() if not ok]
+            if failed:
+                # 部分工作进程绑定失败的端口在所有工作进程上撤销，保持各进程一致
+                stop_batches = {}
+                for port in failed:
+                    for index in self._workers_for_port(port):
+                        stop_batches.setdefault(index, []).append(port)
+                self._broadcast({index: (batch, None) for index, batch in stop_batches.items()}, 'stop')
+            for assignment in assignments:
+                if results[assignment[0]]:
+                    self.assignments[assignment[0]] = assignment[1:]
+            return results
+
+    def set_resolve_mode(self, ports, mode):
+        """在负责这些端口的工作进程中设置域名解析方式"""
+        self.start()
+        with self._lock:
+            self._restart_dead_workers()
+            batches = {}
+            for port in ports:
+                self.resolve_modes[port] = mode
+                for index in self._workers_for_port(port):
+                    batches.setdefault(index, []).append(port)
+            self._broadcast({index: (batch, mode) for index, batch in batches.items()}, 'resolve')
+
+    def apply_health(self, results):
+        """把健康探测结果下发给全部工作进程"""
+        if not self.processes:
+            return
+        with self._lock:
+            self.health.update(results)
+            self._restart_dead_workers()
+            self._broadcast({index: results for index in range(len(self.processes))}, 'health')
+
+    def dns_stats(self):
+        """各工作进程的 DNS 缓存统计"""
+        if not self.processes:
+            return []
+        with self._lock:
+            self._restart_dead_workers()
+            replies = self._broadcast({index: None for index in range(len(self.processes))}, 'dns_stats')
+            return [replies[index] for index in sorted(replies)]
+
+    def metrics_snapshot(self):
+        """各端口的指标快照，reuseport 模式下同一端口在各工作进程中的数据相加"""
+        if not self.processes:
+            return {}
+        with self._lock:
+            self._restart_dead_workers()
+            replies = self._broadcast({index: None for index in range(len(self.processes))}, 'metrics')
+        merged = {}
+        for index in sorted(replies):
+            for port, snapshot in replies[index].items():
+                merged[port] = merge_snapshots(merged[port], snapshot) if port in merged else snapshot
+        return merged
+
+    def list_ports(self):
+        """各端口的上游和连接数，reuseport 模式下同一端口在各工作进程中的连接数相加"""
+        if not self.processes:
+            return []
+        with self._lock:
+            self._restart_dead_workers()
+            replies = self._broadcast({index: None for index in range(len(self.processes))}, 'list')
+        merged = {}
+        for index in sorted(replies):
+            for entry in replies[index]:
+                existing = merged.get(entry['port'])
+                if existing is None:
+                    merged[entry['port']] = entry
+                else:
+                    existing['connections'] += entry['connections']
+                    existing['tunnels'] += entry['tunnels']
+        return [merged[port] for port in sorted(merged)]
+
+    def drain_ports(self, ports, timeout):
+        """在负责这些端口的工作进程中开始排空，不等待排空完成"""
+        if not self.processes:
+            return []
+        with self._lock:
+            batches = {}
+            draining = []
+            for port in ports:
+                if self.assignments.pop(port, None) is None:
+                    continue
+                draining.append(port)
+                for index in self._workers_for_port(port):
+                    batches.setdefault(index, []).append(port)
+            # 先移除端口配置再重启退出的工作进程，重启后不会重新启动这些端口
+            self._restart_dead_workers()
+            self._broadcast({index: (batch, timeout) for index, batch in batches.items()}, 'drain')
+        return draining
+
+    def stop_ports(self, ports, drain_timeout=None):
+        """在所有负责这些端口的工作进程中停止端口，drain_timeout 含义同 ProxyManager.stop_ports"""
+        if not self.processes:
+            return
+        with self._lock:
+            batches = {}
+            for port in ports:
+                self.assignments.pop(port, None)
+                for index in self._workers_for_port(port):
+                    batches.setdefault(index, []).append(port)
+            self._restart_dead_workers()
+            self._broadcast({index: (batch, drain_timeout) for index, batch in batches.items()}, 'stop')
+
+    def stop(self, timeout=5.0):
+        """通知所有工作进程停止端口并退出"""
+        with self._lock:
+            for conn in self.connections:
+                try:
+                    conn.send(('shutdown', None))
+                except OSError:
+                    pass
+            for process in self.processes:
+                process.join(timeout=timeout)
+                if process.is_alive():
+                    logger.warning(None, "工作进程 %s 未正常退出，强制终止", process.name)
+                    process.terminate()
+            for conn in self.connections:
+                conn.close()
+            self.processes, self.connections = [], []
+            self.assignments = {}